@@ -0,0 +1,303 @@
+import argparse
+import collections
+import hashlib
+import os
+import sqlite3
+import threading
+import zlib
+
+import logparser
+
+
+_TRANSLATIONS_SUFFIX = '-translations.json'
+_TWEET_SUFFIX = '.json'
+
+
+def parse_extra_name(extra_name):
+    '''
+    Parse the basename of an extra file, like "user-123.json" (for a tweet) or
+    "user-123-translations.json" (for the translations done for a tweet).
+
+    Return value:
+        A `(kind, tweet_id)` tuple, where `kind` is either 'tweet' or 'translations',
+        or `None` if the name is not in one of the known formats.
+    '''
+    if extra_name.endswith(_TRANSLATIONS_SUFFIX):
+        kind = 'translations'
+        stem = extra_name[:-len(_TRANSLATIONS_SUFFIX)]
+    elif extra_name.endswith(_TWEET_SUFFIX):
+        kind = 'tweet'
+        stem = extra_name[:-len(_TWEET_SUFFIX)]
+    else:
+        return None
+
+    # Screen names cannot contain dashes, so the ID is after the last one.
+    tweet_id = stem.rsplit('-', 1)[-1]
+    if not tweet_id.isdigit():
+        return None
+
+    return kind, int(tweet_id)
+
+
+class ExtrasArchive:
+    '''
+    An append-only archive for the extra files (i.e. the JSON for the original and
+    translated tweets and the intermediate translations), replacing the `extras`
+    directory which, otherwise, ends up with lots of tiny files.
+
+    The archive is an SQLite database. The content is compressed and stored only once
+    even if saved with different names.
+
+    Each entry has a trace ID, that is the ID of the original tweet which caused the
+    entry to be saved, so all the extras for a tweet can be retrieved at once.
+    '''
+
+    BASENAME = 'extras.sqlite'
+
+    def __init__(self, archive_path):
+        '''
+        Initialize an `ExtrasArchive` instance.
+
+        archive_path:
+            The path of the database, created if needed.
+        '''
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(archive_path, check_same_thread=False)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS blobs ('
+            '    hash TEXT PRIMARY KEY,'
+            '    data BLOB NOT NULL,'
+            '    size INTEGER NOT NULL)')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS extras ('
+            '    name TEXT PRIMARY KEY,'
+            '    kind TEXT,'
+            '    tweet_id INTEGER,'
+            '    trace_id INTEGER,'
+            '    hash TEXT NOT NULL REFERENCES blobs (hash))')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS extras_trace_id ON extras (trace_id)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS extras_tweet_id ON extras (tweet_id)')
+        self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _insert(self, extra_name, content, trace_id):
+        data = content.encode('utf-8')
+        content_hash = hashlib.sha256(data).hexdigest()
+
+        self._db.execute(
+            'INSERT OR IGNORE INTO blobs (hash, data, size) VALUES (?, ?, ?)',
+            (content_hash, zlib.compress(data, 9), len(data)))
+
+        parsed = parse_extra_name(extra_name)
+        kind, tweet_id = parsed if parsed is not None else (None, None)
+        if trace_id is None:
+            trace_id = tweet_id
+
+        # Like for files, saving again with the same name replaces the old content.
+        self._db.execute(
+            'INSERT OR REPLACE INTO extras (name, kind, tweet_id, trace_id, hash) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (extra_name, kind, tweet_id, None if trace_id is None else int(trace_id),
+             content_hash))
+
+    def add(self, extra_name, content, trace_id=None):
+        '''
+        Add an entry to the archive.
+
+        extra_name:
+            The name of the entry, in the same format used for files in the `extras`
+            directory.
+        content:
+            The (string) content of the entry.
+        trace_id:
+            The ID of the original tweet this entry is about or `None` to use the ID
+            in `extra_name`.
+        '''
+        with self._lock:
+            self._insert(extra_name, content, trace_id)
+            self._db.commit()
+
+    def add_many(self, entries):
+        '''
+        Add many entries at once, which is much faster than calling `add` for each
+        of them.
+
+        entries:
+            An iterable of `(extra_name, content, trace_id)` tuples.
+        Return value:
+            The number of entries added.
+        '''
+        added = 0
+        with self._lock:
+            for extra_name, content, trace_id in entries:
+                self._insert(extra_name, content, trace_id)
+                added += 1
+            self._db.commit()
+        return added
+
+    @staticmethod
+    def _decompress(data):
+        return zlib.decompress(data).decode('utf-8')
+
+    def get(self, extra_name):
+        '''
+        Get the content of the entry called `extra_name`.
+
+        Return value:
+            The content or `None` if there's no such entry.
+        '''
+        with self._lock:
+            row = self._db.execute(
+                'SELECT data FROM extras JOIN blobs USING (hash) WHERE name = ?',
+                (extra_name,)).fetchone()
+
+        return None if row is None else self._decompress(row[0])
+
+    def get_tweet(self, tweet_id):
+        '''
+        Get the entries whose name contains `tweet_id`.
+
+        Return value:
+            A dictionary mapping the entry names to their content.
+        '''
+        return self._get_where('tweet_id', tweet_id)
+
+    def get_trace(self, trace_id):
+        '''
+        Get all the entries saved while processing the original tweet with ID
+        `trace_id`.
+
+        Return value:
+            A dictionary mapping the entry names to their content.
+        '''
+        return self._get_where('trace_id', trace_id)
+
+    def _get_where(self, column, value):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT name, data FROM extras JOIN blobs USING (hash) '
+                'WHERE {} = ? ORDER BY name'.format(column),
+                (int(value),)).fetchall()
+
+        return collections.OrderedDict(
+            (name, self._decompress(data)) for name, data in rows)
+
+    def names(self):
+        '''
+        Get the names of all the entries.
+        '''
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT name FROM extras ORDER BY name')]
+
+    def stats(self):
+        '''
+        Get the archive counters.
+
+        Return value:
+            A dictionary with the number of entries, the number of distinct contents,
+            and their size before and after compression.
+        '''
+        with self._lock:
+            entries = self._db.execute('SELECT COUNT(*) FROM extras').fetchone()[0]
+            blobs, size, stored_size = self._db.execute(
+                'SELECT COUNT(*), TOTAL(size), TOTAL(LENGTH(data)) FROM blobs').fetchone()
+
+        return collections.OrderedDict([
+            ('entries', entries),
+            ('unique-contents', blobs),
+            ('bytes', int(size)),
+            ('stored-bytes', int(stored_size)),
+            ])
+
+
+def _get_trace_ids(log_path):
+    # Maps the IDs of translated tweets to the IDs of the original ones.
+    trace_ids = {}
+    try:
+        parser = logparser.Parser(log_path, tweets=True)
+    except IOError:
+        return trace_ids
+
+    for log_entry in parser:
+        trace_ids[log_entry['translated-id']] = log_entry['original-id']
+
+    return trace_ids
+
+
+def import_extras_dir(archive, extra_dir, log_path, remove=False):
+    '''
+    Import an existing `extras` directory into an archive.
+
+    archive:
+        The `ExtrasArchive` to import into.
+    extra_dir:
+        The directory with the extra files.
+    log_path:
+        The path of the main log, used to find the original tweet for the files
+        about translated tweets.
+    remove:
+        Whether to delete the files once imported.
+    Return value:
+        The number of files imported.
+    '''
+    trace_ids = _get_trace_ids(log_path)
+
+    def iter_entries():
+        for basename in sorted(os.listdir(extra_dir)):
+            path = os.path.join(extra_dir, basename)
+            if not os.path.isfile(path):
+                continue
+
+            with open(path) as extra_file:
+                content = extra_file.read()
+
+            parsed = parse_extra_name(basename)
+            trace_id = None if parsed is None else trace_ids.get(parsed[1])
+
+            imported_paths.append(path)
+            yield basename, content, trace_id
+
+    imported_paths = []
+    imported = archive.add_many(iter_entries())
+
+    # Files are deleted only once the archive is committed.
+    if remove:
+        for path in imported_paths:
+            os.unlink(path)
+
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Import the extras directory of an account into a packed archive.')
+    parser.add_argument('state_dir',
+                        help='The state directory of an account, for instance '
+                        '~/.transequilibrium/USER-TARGET.')
+    parser.add_argument('--remove', action='store_true',
+                        help='Delete the files once imported.')
+    args = parser.parse_args()
+
+    state_dir = os.path.expanduser(args.state_dir)
+    archive = ExtrasArchive(os.path.join(state_dir, ExtrasArchive.BASENAME))
+    try:
+        imported = import_extras_dir(archive,
+                                     os.path.join(state_dir, 'extras'),
+                                     os.path.join(state_dir, 'log'),
+                                     args.remove)
+        print('Imported {} files.'.format(imported))
+        print(', '.join('{}={}'.format(key, value) for key, value in archive.stats().items()))
+    finally:
+        archive.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 import collections
 import datetime
+import sys
 import textwrap
+import threading
 import time
 import urllib.parse
 import xml.etree.ElementTree
@@ -8,11 +10,17 @@ import xml.etree.ElementTree
 import requests
 
 import escaping
+import httppool
+import metrics
 
 
 Result = collections.namedtuple('Result', ['equilibrium', 'text'])
 
 
+_SERVICE_NAMESPACE = 'http://schemas.datacontract.org/2004/07/Microsoft.MT.Web.Service.V2'
+_ARRAYS_NAMESPACE = 'http://schemas.microsoft.com/2003/10/Serialization/Arrays'
+
+
 class TranslationFailure(Exception):
     pass
 
@@ -20,20 +28,48 @@ class TranslationFailure(Exception):
 class AuthTokenClient:
     '''
     Get a token from the Microsoft API and renews it when needed.
+
+    After the first token is fetched, a background thread renews it before it
+    expires, so callers of `get_token` don't normally need to wait for the
+    token to be fetched.
+
+    This class is thread-safe. If multiple threads need a new token at the same
+    time, only one request is made and the other threads wait for its result.
     '''
 
-    def __init__(self, client_secret):
+    # How long a token can be used for.
+    TOKEN_VALIDITY = datetime.timedelta(minutes=5)
+    # How long before the token expires the background thread renews it.
+    REFRESH_MARGIN = datetime.timedelta(minutes=1)
+    # How long to wait before trying again if the background renewal failed.
+    REFRESH_RETRY_DELAY = datetime.timedelta(seconds=10)
+
+    def __init__(self, client_secret, http_pool=None, background_refresh=True):
         '''
         Initialize a `AuthTokenClient`.
 
         client_secret:
             A client secret for the translation API.
+        http_pool:
+            The `httppool.HTTPPool` to use for requests or `None` to use the default
+            one.
+        background_refresh:
+            Whether to renew the token in a background thread before it expires.
         '''
         self._client_secret = client_secret
+        self._http_pool = http_pool or httppool.get_default_pool()
+        self._background_refresh = background_refresh
+
+        self._lock = threading.Lock()
+        self._refresh_done = threading.Condition(self._lock)
+        self._refreshing = False
 
         self._token = None
         self._token_valid_until = datetime.datetime(1970, 1, 1)
 
+        self._refresh_thread = None
+        self._closed = threading.Event()
+
     @staticmethod
     def _now():
         return datetime.datetime.now()
@@ -44,25 +80,120 @@ class AuthTokenClient:
             'Ocp-Apim-Subscription-Key': self._client_secret
             }
 
-        response = requests.post(url, headers=headers)
+        response = self._http_pool.post(url, headers=headers)
         response.raise_for_status()
         return response.content.decode('utf-8')
 
+    def _is_token_valid(self, now):
+        # Must be called with the lock held.
+        return self._token is not None and now <= self._token_valid_until
+
+    def _refresh(self):
+        '''
+        Fetch a new token.
+
+        The caller must have set `_refreshing` (with the lock held) before calling
+        this.
+        '''
+        assert self._refreshing
+
+        now = self._now()
+        try:
+            token = self._fetch_token()
+        except Exception:
+            with self._lock:
+                self._refreshing = False
+                # The waiting threads will try again themselves.
+                self._refresh_done.notify_all()
+            raise
+
+        with self._lock:
+            self._token = token
+            self._token_valid_until = now + self.TOKEN_VALIDITY
+            self._refreshing = False
+            self._refresh_done.notify_all()
+
+        return token
+
     def get_token(self):
         '''
         Get an authorization token.
 
-        The token is internally cached and fetched again only when it expires.
+        The token is internally cached and fetched again only when it expires (if
+        the background thread didn't manage to renew it already).
 
         Return value:
             A token string which can be used for the translation API.
         '''
-        now = self._now()
-        if now > self._token_valid_until:
-            self._token = self._fetch_token()
-            self._token_valid_until = now + datetime.timedelta(minutes=5)
+        with self._lock:
+            while True:
+                if self._is_token_valid(self._now()):
+                    return self._token
+                if not self._refreshing:
+                    break
+                # Another thread is already fetching a new token.
+                self._refresh_done.wait()
+
+            self._refreshing = True
 
-        return self._token
+        token = self._refresh()
+        self._start_refresh_thread()
+
+        return token
+
+    def remaining_ttl(self):
+        '''
+        Get how long the current token is still valid for.
+
+        Return value:
+            A `datetime.timedelta`, which is zero if there is no valid token.
+        '''
+        with self._lock:
+            remaining = self._token_valid_until - self._now()
+        return max(remaining, datetime.timedelta(0))
+
+    def close(self):
+        '''
+        Stop renewing the token in the background.
+        '''
+        self._closed.set()
+        if self._refresh_thread is not None:
+            self._refresh_thread.join()
+            self._refresh_thread = None
+
+    def _start_refresh_thread(self):
+        with self._lock:
+            if not self._background_refresh or self._refresh_thread is not None:
+                return
+            if self._closed.is_set():
+                return
+            self._refresh_thread = threading.Thread(target=self._refresh_thread_main,
+                                                    name='azure-token-refresh')
+            self._refresh_thread.daemon = True
+            self._refresh_thread.start()
+
+    def _refresh_thread_main(self):
+        delay = self.remaining_ttl() - self.REFRESH_MARGIN
+
+        while not self._closed.wait(max(delay.total_seconds(), 0)):
+            with self._lock:
+                if self._refreshing:
+                    # A caller is already fetching the token.
+                    skip = True
+                else:
+                    self._refreshing = True
+                    skip = False
+
+            if not skip:
+                try:
+                    self._refresh()
+                except Exception as exc:
+                    print('Failed to renew the translator token (will retry): {}'.format(exc),
+                          file=sys.stderr)
+                    delay = self.REFRESH_RETRY_DELAY
+                    continue
+
+            delay = max(self.remaining_ttl() - self.REFRESH_MARGIN, self.REFRESH_RETRY_DELAY)
 
 
 class Translator:
@@ -70,17 +201,55 @@ class Translator:
     Translate text between languages.
     '''
 
-    def __init__(self, client_secret):
+    def __init__(self, client_secret, http_pool=None):
         '''
         Initializes a `Translator`.
 
         client_secret:
             A client secret for the translation API.
+        http_pool:
+            The `httppool.HTTPPool` to use for requests (shared with the token
+            client) or `None` to use the default one.
         '''
-        self._auth = AuthTokenClient(client_secret)
+        self._http_pool = http_pool or httppool.get_default_pool()
+        self._auth = AuthTokenClient(client_secret, self._http_pool)
 
         self.name = 'azure'
 
+    def close(self):
+        '''
+        Release the resources used by the translator.
+        '''
+        self._auth.close()
+
+    def _get_auth_headers(self):
+        return {
+            'Authorization': 'Bearer ' + self._auth.get_token(),
+            }
+
+    def _request_with_retries(self, method, url, **kwargs):
+        last_connection_error = None
+
+        for retry in range(4):
+            try:
+                return self._http_pool.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as exc:
+                # Sometimes there seems to be some transient flakiness, so we retry.
+                last_connection_error = exc
+                metrics.TRANSLATOR_RETRIES.inc(translator=self.name)
+                time.sleep(retry)
+                continue
+
+        assert last_connection_error is not None
+        # pylint: disable=raising-bad-type
+        raise last_connection_error
+
+    @staticmethod
+    def _translation_failure(response):
+        return TranslationFailure(
+            'Failed to translate the text. Got:\n{}.'.format(
+                textwrap.indent(response.text, ' ' * 4)))
+
     def translate(self, from_lang, to_lang, text):
         '''
         Translate `text` from `from_lang` to `to_lang`.
@@ -88,11 +257,6 @@ class Translator:
         Return value:
             The translated text.
         '''
-        bearer_token = 'Bearer ' + self._auth.get_token()
-        headers = {
-            'Authorization': bearer_token,
-            }
-
         def quote(string):
             return urllib.parse.quote(string, safe='')
 
@@ -102,28 +266,63 @@ class Translator:
                   from_lang=quote(from_lang),
                   to_lang=quote(to_lang))
 
-        last_connection_error = None
+        response = self._request_with_retries('GET', url, headers=self._get_auth_headers())
 
-        for retry in range(4):
-            try:
-                response = requests.get(url, headers=headers)
-            except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as exc:
-                # Sometimes there seems to be some transient flakiness, so we retry.
-                last_connection_error = exc
-                time.sleep(retry)
-                continue
+        translation_element = xml.etree.ElementTree.fromstring(response.text.encode('utf-8'))
+        if translation_element.text is None:
+            raise self._translation_failure(response)
 
-            translation_element = xml.etree.ElementTree.fromstring(response.text.encode('utf-8'))
-            if translation_element.text is None:
-                raise TranslationFailure(
-                    'Failed to translate the text. Got:\n{}.'.format(
-                        textwrap.indent(response.text, ' ' * 4)))
+        return escaping.html_unescape(translation_element.text)
 
-            return escaping.html_unescape(translation_element.text)
+    def translate_many(self, from_lang, to_lang, texts):
+        '''
+        Translate all the strings in `texts` from `from_lang` to `to_lang` with a
+        single request.
 
-        assert last_connection_error is not None
-        # pylint: disable=raising-bad-type
-        raise last_connection_error
+        Return value:
+            A list of translated texts, in the same order as `texts`.
+        '''
+        texts = list(texts)
+        if not texts:
+            return []
+
+        request_element = xml.etree.ElementTree.Element('TranslateArrayRequest')
+        xml.etree.ElementTree.SubElement(request_element, 'AppId')
+        xml.etree.ElementTree.SubElement(request_element, 'From').text = from_lang
+        options_element = xml.etree.ElementTree.SubElement(request_element, 'Options')
+        xml.etree.ElementTree.SubElement(
+            options_element,
+            '{{{}}}ContentType'.format(_SERVICE_NAMESPACE)).text = 'text/plain'
+        texts_element = xml.etree.ElementTree.SubElement(request_element, 'Texts')
+        for text in texts:
+            xml.etree.ElementTree.SubElement(
+                texts_element,
+                '{{{}}}string'.format(_ARRAYS_NAMESPACE)).text = text
+        xml.etree.ElementTree.SubElement(request_element, 'To').text = to_lang
+
+        headers = self._get_auth_headers()
+        headers['Content-Type'] = 'text/xml'
+
+        response = self._request_with_retries(
+            'POST',
+            'http://api.microsofttranslator.com/v2/Http.svc/TranslateArray',
+            headers=headers,
+            data=xml.etree.ElementTree.tostring(request_element, encoding='utf-8'))
+
+        try:
+            response_element = xml.etree.ElementTree.fromstring(response.text.encode('utf-8'))
+        except xml.etree.ElementTree.ParseError:
+            raise self._translation_failure(response)
+
+        translations = [
+            escaping.html_unescape(element.text or '')
+            for element in response_element.iter(
+                '{{{}}}TranslatedText'.format(_SERVICE_NAMESPACE))
+            ]
+        if len(translations) != len(texts):
+            raise self._translation_failure(response)
+
+        return translations
 
 
 def main():
@@ -0,0 +1,355 @@
+import argparse
+import collections
+import json
+import os
+import time
+import types
+
+import archive
+import classifier
+import equilibrium
+import logparser
+import offensive
+import placeholders
+import twitter
+
+
+class ReplayMiss(Exception):
+    '''
+    An error raised when a `ReplayTranslator` is asked for a translation which was
+    not recorded.
+    '''
+    pass
+
+
+class ReplayTranslator:
+    '''
+    A translator which replays translations previously recorded by the application
+    (i.e. the `*-translations.json` files in the extras directory).
+    '''
+
+    def __init__(self):
+        self._translations = {}
+
+        self.name = 'replay'
+
+    def add_trajectory(self, initial_text, trajectory):
+        '''
+        Record the translations done for a tweet.
+
+        initial_text:
+            The (sanitized) text which was translated.
+        trajectory:
+            The list of translations, as saved in the `*-translations.json` files.
+        Return value:
+            A `(main_lang, intermediate_lang)` tuple.
+        '''
+        assert trajectory
+        intermediate_lang = trajectory[0]['language']
+        main_lang = trajectory[1]['language'] if len(trajectory) > 1 else None
+
+        previous_text = initial_text
+        previous_lang = main_lang
+        for entry in trajectory:
+            key = (previous_lang, entry['language'], previous_text)
+            self._translations[key] = entry['text']
+            previous_text = entry['text']
+            previous_lang = entry['language']
+
+        return main_lang, intermediate_lang
+
+    def translate(self, from_lang, to_lang, text):
+        try:
+            return self._translations[(from_lang, to_lang, text)]
+        except KeyError:
+            raise ReplayMiss('No recorded translation from "{}" to "{}" for: {}'.format(
+                from_lang, to_lang, text))
+
+
+Benchmark = collections.namedtuple('Benchmark', ['name', 'items', 'function'])
+
+
+class Data:
+    '''
+    The data, loaded from the state directory of an account, used by the benchmarks.
+    '''
+
+    def __init__(self, state_dir, max_items=None):
+        '''
+        Initialize a `Data` instance.
+
+        state_dir:
+            The directory where the application stores the log and the extras (i.e.
+            `~/.transequilibrium/<my-user-name>-<target-user-name>`).
+        max_items:
+            The maximum number of tweets to load or `None` to load all of them.
+        '''
+        self.log_path = os.path.join(state_dir, 'log')
+        self.extra_dir = os.path.join(state_dir, 'extras')
+
+        archive_path = os.path.join(state_dir, archive.ExtrasArchive.BASENAME)
+        if os.path.exists(archive_path):
+            self._extras_archive = archive.ExtrasArchive(archive_path)
+            extra_names = self._extras_archive.names()
+        else:
+            self._extras_archive = None
+            extra_names = os.listdir(self.extra_dir)
+
+        # Maps tweet IDs to the extras file names.
+        extras = {}
+        for basename in extra_names:
+            parsed = archive.parse_extra_name(basename)
+            if parsed is not None:
+                kind, tweet_id = parsed
+                extras.setdefault(str(tweet_id), {})[kind] = basename
+
+        self.tweets = []
+        self.sanitized_texts = []
+        self.texts = []
+        self.replay_translator = ReplayTranslator()
+        self.trajectories = []
+
+        for log_entry in logparser.Parser(self.log_path, tweets=True):
+            if max_items is not None and len(self.sanitized_texts) >= max_items:
+                break
+
+            self.texts.append(log_entry['original-text'])
+            self.texts.append(log_entry['translated-text'])
+
+            tweet_extras = extras.get(str(log_entry['original-id']), {})
+
+            tweet_basename = tweet_extras.get('tweet')
+            if tweet_basename is not None:
+                tweet_json = self._load_extra(tweet_basename)
+                self.tweets.append(types.SimpleNamespace(full_text=tweet_json['full_text'],
+                                                         entities=tweet_json['entities']))
+
+            initial_text = log_entry.get('original-sanitized-text', log_entry['original-text'])
+            self.sanitized_texts.append(initial_text)
+
+            translations_basename = tweet_extras.get('translations')
+            if translations_basename is not None:
+                trajectory = self._load_extra(translations_basename)
+                if trajectory:
+                    main_lang, intermediate_lang = self.replay_translator.add_trajectory(
+                        initial_text, trajectory)
+                    if main_lang is not None:
+                        self.trajectories.append((main_lang, intermediate_lang, initial_text))
+
+        if self._extras_archive is not None:
+            self._extras_archive.close()
+
+    def _load_extra(self, basename):
+        if self._extras_archive is not None:
+            return json.loads(self._extras_archive.get(basename))
+        with open(os.path.join(self.extra_dir, basename)) as extra_file:
+            return json.load(extra_file)
+
+
+def get_benchmarks(data):
+    '''
+    Get the benchmarks to run.
+
+    data:
+        A `Data` instance.
+    Return value:
+        A list of `Benchmark` instances.
+    '''
+    def find_equilibrium(trajectory):
+        main_lang, intermediate_lang, initial_text = trajectory
+        equilibrium.find_equilibrium(data.replay_translator,
+                                     main_lang, intermediate_lang, initial_text)
+
+    def sanitize_compact(tweet):
+        # pylint: disable=protected-access
+        twitter.Client._sanitize_tweet(tweet, placeholders.get_scheme('compact'))
+
+    def unsanitize(sanitized_text):
+        # The texts in the log use the tag scheme, which doesn't need the entities.
+        placeholders.TAG_SCHEME.restore(sanitized_text, [])
+
+    def classify_many(_):
+        # A new classifier each time, so the results are not cached across runs.
+        classifier.Classifier().classify_many(data.texts)
+
+    def parse_log(_):
+        for _ in logparser.Parser(data.log_path, use_index=False):
+            pass
+
+    def parse_log_tweets(_):
+        for _ in logparser.Parser(data.log_path, use_index=False, tweets=True):
+            pass
+
+    def parse_log_legacy(_):
+        for _ in _legacy_parse(data.log_path):
+            pass
+
+    def parse_log_indexed(_):
+        for _ in logparser.Parser(data.log_path, following=True):
+            pass
+
+    # pylint: disable=protected-access
+    return [
+        Benchmark('sanitize', data.tweets, twitter.Client._sanitize_tweet),
+        Benchmark('sanitize-compact', data.tweets, sanitize_compact),
+        Benchmark('unsanitize', data.sanitized_texts, unsanitize),
+        Benchmark('offensive', data.texts, offensive.tact),
+        Benchmark('offensive-classifier', data.texts, classifier.classify),
+        Benchmark('offensive-classifier-batch', [None], classify_many),
+        Benchmark('find-equilibrium', data.trajectories, find_equilibrium),
+        Benchmark('parse-log-legacy', [None], parse_log_legacy),
+        Benchmark('parse-log', [None], parse_log),
+        Benchmark('parse-log-tweets', [None], parse_log_tweets),
+        Benchmark('parse-log-indexed-following', [None], parse_log_indexed),
+        ]
+
+
+def _legacy_parse(log_file_path):
+    # The line-by-line parser used before the chunked decoder, kept for comparison.
+    with open(log_file_path) as log_file:
+        iterator = iter(log_file)
+
+        for line_ext in iterator:
+            line_ext = line_ext.rstrip()
+            assert line_ext == '{'
+            content_list = [line_ext]
+
+            for line_int in iterator:
+                line_int = line_int.rstrip()
+                content_list.append(line_int)
+                if line_int == '}':
+                    break
+
+            yield json.loads('\n'.join(content_list))
+
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(percent / 100.0 * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_benchmark(benchmark, repeat):
+    '''
+    Run a benchmark.
+
+    benchmark:
+        The `Benchmark` to run.
+    repeat:
+        How many times to go through all the items.
+    Return value:
+        A dictionary with the throughput (items per second) and the latency
+        percentiles (in microseconds) for a single item, or `None` if there are
+        no items to run the benchmark on.
+    '''
+    if not benchmark.items:
+        return None
+
+    timer = time.perf_counter
+    durations = []
+    for _ in range(repeat):
+        for item in benchmark.items:
+            start = timer()
+            benchmark.function(item)
+            durations.append(timer() - start)
+
+    total = sum(durations)
+    durations.sort()
+
+    return collections.OrderedDict([
+        ('items', len(durations)),
+        ('throughput', len(durations) / total if total else float('inf')),
+        ('p50-us', _percentile(durations, 50) * 1e6),
+        ('p90-us', _percentile(durations, 90) * 1e6),
+        ('p99-us', _percentile(durations, 99) * 1e6),
+        ])
+
+
+def compare_with_baseline(results, baseline, threshold):
+    '''
+    Find the benchmarks which are slower than in the baseline.
+
+    results:
+        A dictionary mapping benchmark names to results (see `run_benchmark`).
+    baseline:
+        The same as `results`, but for a previous run.
+    threshold:
+        By how much (as a fraction) the throughput must drop to consider it a
+        regression.
+    Return value:
+        A list of `(name, baseline throughput, new throughput)` tuples.
+    '''
+    regressions = []
+    for name, result in results.items():
+        baseline_result = baseline.get(name)
+        if result is None or baseline_result is None:
+            continue
+        if result['throughput'] < baseline_result['throughput'] * (1 - threshold):
+            regressions.append((name, baseline_result['throughput'], result['throughput']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the application using the data from a state directory.')
+    parser.add_argument('state_dir',
+                        help='The state directory of an account, for instance '
+                        '~/.transequilibrium/USER-TARGET.')
+    parser.add_argument('--baseline',
+                        help='A JSON file with the results of a previous run.')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Save the results to the baseline file instead of comparing them.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='The fraction of throughput lost which counts as a regression.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='How many times to run each benchmark on all the items.')
+    parser.add_argument('--max-items', type=int,
+                        help='The maximum number of tweets to load.')
+    parser.add_argument('--only', action='append',
+                        help='Run only the benchmark with this name (can be repeated).')
+    args = parser.parse_args()
+
+    data = Data(os.path.expanduser(args.state_dir), args.max_items)
+
+    results = collections.OrderedDict()
+    for benchmark in get_benchmarks(data):
+        if args.only and benchmark.name not in args.only:
+            continue
+        result = run_benchmark(benchmark, args.repeat)
+        results[benchmark.name] = result
+        if result is None:
+            print('{:20} no data'.format(benchmark.name))
+        else:
+            print('{:20} {:12.1f}/s  p50 {:10.1f}us  p90 {:10.1f}us  p99 {:10.1f}us'.format(
+                benchmark.name,
+                result['throughput'],
+                result['p50-us'],
+                result['p90-us'],
+                result['p99-us']))
+
+    if not args.baseline:
+        return
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=4)
+        print('Baseline saved to "{}".'.format(args.baseline))
+        return
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    regressions = compare_with_baseline(results, baseline, args.threshold)
+    for name, baseline_throughput, throughput in regressions:
+        print('REGRESSION in {}: {:.1f}/s (was {:.1f}/s).'.format(
+            name, throughput, baseline_throughput))
+
+    if regressions:
+        raise SystemExit(1)
+
+    print('No regressions.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+import collections
+import os
+import sqlite3
+import threading
+import time
+
+import equilibrium
+import translatorwrapper
+
+
+class CachingTranslator(translatorwrapper.TranslatorWrapper):
+    '''
+    Wrap a translator and cache its translations.
+
+    The cache has two tiers:
+    - A small in-memory LRU cache.
+    - A bigger on-disk cache (an SQLite database) which survives across runs.
+
+    Entries are keyed on the translator name, the language pair and the text, so
+    the same cache file can be safely shared by different translators.
+    '''
+
+    DB_BASENAME = 'translation-cache.sqlite'
+
+    #pylint: disable=too-many-arguments
+    def __init__(self, translator, cache_dir=None, max_memory_entries=1024,
+                 max_disk_bytes=64 * 1024 * 1024, max_age=90 * 24 * 60 * 60):
+        '''
+        Initialize a `CachingTranslator` instance.
+
+        translator:
+            The translator to wrap.
+        cache_dir:
+            The directory where to store the on-disk cache or `None` to use only the
+            in-memory cache.
+        max_memory_entries:
+            How many translations to keep in memory.
+        max_disk_bytes:
+            The approximate maximum size of the translations stored on disk.
+        max_age:
+            How many seconds a translation can stay unused on disk before being evicted.
+        '''
+        super().__init__(translator)
+        self._max_memory_entries = max_memory_entries
+        self._max_disk_bytes = max_disk_bytes
+        self._max_age = max_age
+
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._db = None
+        self._inserts_since_eviction = 0
+        if cache_dir is not None:
+            self._db = sqlite3.connect(os.path.join(cache_dir, self.DB_BASENAME),
+                                       check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS translations ('
+                '    translator TEXT NOT NULL,'
+                '    from_lang TEXT NOT NULL,'
+                '    to_lang TEXT NOT NULL,'
+                '    text TEXT NOT NULL,'
+                '    translation TEXT NOT NULL,'
+                '    size INTEGER NOT NULL,'
+                '    last_used REAL NOT NULL,'
+                '    PRIMARY KEY (translator, from_lang, to_lang, text))')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS translations_last_used '
+                'ON translations (last_used)')
+            self._db.commit()
+            self._evict_disk()
+
+    @property
+    def hits(self):
+        return self.memory_hits + self.disk_hits
+
+    def stats(self):
+        '''
+        Get the cache counters.
+
+        Return value:
+            A dictionary with the number of hits (split between the two tiers) and misses.
+        '''
+        return collections.OrderedDict([
+            ('memory-hits', self.memory_hits),
+            ('disk-hits', self.disk_hits),
+            ('misses', self.misses),
+            ])
+
+    def close(self):
+        '''
+        Close the on-disk cache and the wrapped translator.
+        '''
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+        super().close()
+
+    def translate(self, from_lang, to_lang, text):
+        '''
+        Translate `text` from `from_lang` to `to_lang`, using a cached translation if
+        available.
+
+        Return value:
+            The translated text.
+        '''
+        key = (self.name, from_lang, to_lang, text)
+
+        with self._lock:
+            translation = self._lookup(key)
+            if translation is not None:
+                return translation
+            self.misses += 1
+
+        # Don't hold the lock while doing network requests.
+        translation = self._translator.translate(from_lang, to_lang, text)
+
+        with self._lock:
+            self._store(key, translation)
+
+        return translation
+
+    def translate_many(self, from_lang, to_lang, texts):
+        '''
+        Translate all the strings in `texts` from `from_lang` to `to_lang`, using
+        cached translations when available.
+
+        The texts which are not cached are translated with a single batched request
+        if the wrapped translator supports it.
+
+        Return value:
+            A list of translated texts, in the same order as `texts`.
+        '''
+        keys = [(self.name, from_lang, to_lang, text) for text in texts]
+        translations = {}
+
+        with self._lock:
+            for key in keys:
+                if key in translations:
+                    continue
+                translation = self._lookup(key)
+                if translation is not None:
+                    translations[key] = translation
+
+            missing_keys = []
+            for key in keys:
+                if key not in translations and key not in missing_keys:
+                    missing_keys.append(key)
+            self.misses += len(missing_keys)
+
+        if missing_keys:
+            new_translations = equilibrium.translate_many(
+                self._translator,
+                from_lang,
+                to_lang,
+                [key[3] for key in missing_keys])
+
+            with self._lock:
+                for key, translation in zip(missing_keys, new_translations):
+                    self._store(key, translation)
+                    translations[key] = translation
+
+        return [translations[key] for key in keys]
+
+    def _lookup(self, key):
+        translation = self._memory.get(key)
+        if translation is not None:
+            self._memory.move_to_end(key)
+            self.memory_hits += 1
+            return translation
+
+        if self._db is None:
+            return None
+
+        row = self._db.execute(
+            'SELECT translation FROM translations '
+            'WHERE translator = ? AND from_lang = ? AND to_lang = ? AND text = ?',
+            key).fetchone()
+        if row is None:
+            return None
+
+        translation = row[0]
+        self._db.execute(
+            'UPDATE translations SET last_used = ? '
+            'WHERE translator = ? AND from_lang = ? AND to_lang = ? AND text = ?',
+            (time.time(),) + key)
+        self._db.commit()
+
+        self._store_in_memory(key, translation)
+        self.disk_hits += 1
+
+        return translation
+
+    def _store_in_memory(self, key, translation):
+        self._memory[key] = translation
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _store(self, key, translation):
+        self._store_in_memory(key, translation)
+
+        if self._db is None:
+            return
+
+        size = len(key[3].encode('utf-8')) + len(translation.encode('utf-8'))
+        self._db.execute(
+            'INSERT OR REPLACE INTO translations '
+            '(translator, from_lang, to_lang, text, translation, size, last_used) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            key + (translation, size, time.time()))
+        self._db.commit()
+
+        # Evicting is relatively expensive, so we don't do it on every insertion.
+        self._inserts_since_eviction += 1
+        if self._inserts_since_eviction >= 100:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        self._inserts_since_eviction = 0
+
+        self._db.execute('DELETE FROM translations WHERE last_used < ?',
+                         (time.time() - self._max_age,))
+
+        total_size = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM translations').fetchone()[0]
+        if total_size > self._max_disk_bytes:
+            # Delete the least recently used entries until we are back under the limit.
+            excess = total_size - self._max_disk_bytes
+            to_delete = []
+            for rowid, size in self._db.execute(
+                    'SELECT rowid, size FROM translations ORDER BY last_used'):
+                if excess <= 0:
+                    break
+                to_delete.append((rowid,))
+                excess -= size
+            self._db.executemany('DELETE FROM translations WHERE rowid = ?', to_delete)
+
+        self._db.commit()
@@ -0,0 +1,151 @@
+import collections
+import re
+import threading
+
+import offensive
+
+
+POLICIES = ('log', 'skip')
+
+# Each alternative in `offensive.offensive` starts at the beginning of a word, with
+# one of these prefixes (in lower case). If a text doesn't have any word starting
+# like this, the regex cannot match.
+# Keep this in sync with the regex.
+_WORD_PREFIXES = frozenset([
+    'abd', 'alq', 'ass', 'att', 'aut', 'bea', 'beh', 'bla', 'blo', 'bod', 'bom', 'bur',
+    'can', 'cas', 'chi', 'cra', 'dea', 'dec', 'die', 'dro', 'exe', 'fat', 'fun', 'gan',
+    'gen', 'gun', 'han', 'hom', 'hos', 'hur', 'inj', 'jih', 'kid', 'kil', 'let', 'mas',
+    'mis', 'mur', 'pae', 'ped', 'pil', 'ram', 'rap', 'sep', 'sex', 'sho', 'sht', 'sla',
+    'sob', 'sta', 'sui', 'ter', 'tor', 'tra', 'vic', 'vio', 'wou',
+    ])
+
+# The alternatives which can start with a word shorter than a prefix (like "al" in
+# "al Qaeda" or "9" in "9/11").
+_SHORT_WORDS = frozenset(['al', '9'])
+
+_WORD_RE = re.compile(r'\w+')
+
+
+# The result of classifying a text.
+# `offensive` is whether the text is offensive and `term` is the offensive term
+# found (or `None`).
+Verdict = collections.namedtuple('Verdict', ['offensive', 'term'])
+
+_NOT_OFFENSIVE = Verdict(False, None)
+
+
+def _find_candidates(text):
+    # Yield the positions of the words which could start an offensive term.
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        # Some characters change length in lower case, so the positions would be
+        # wrong. This is very rare, so just check the whole text.
+        yield None
+        return
+
+    for match in _WORD_RE.finditer(lowered):
+        word = match.group()
+        if word[:3] in _WORD_PREFIXES or word in _SHORT_WORDS:
+            yield match.start()
+
+
+def classify(text):
+    '''
+    Check whether a text is offensive, like `offensive.tact` but faster.
+
+    Most texts don't contain any word which could be offensive, so the words are
+    checked against the possible prefixes of an offensive term first and the
+    (slower) regex is used only where one is found.
+
+    text:
+        The text to check.
+    Return value:
+        A `Verdict` instance.
+    '''
+    for position in _find_candidates(text):
+        if position is None:
+            match = offensive.offensive.search(text)
+        else:
+            match = offensive.offensive.match(text, position)
+        if match is not None:
+            return Verdict(True, match.group(1).lower())
+    return _NOT_OFFENSIVE
+
+
+class Classifier:
+    '''
+    Check whether texts are offensive, remembering the recent results.
+
+    The same text is often checked more than once (for instance, the intermediate
+    translations of a tweet often repeat), so the results are cached.
+    '''
+
+    def __init__(self, max_cached=10000):
+        '''
+        Initialize a `Classifier` instance.
+
+        max_cached:
+            The maximum number of results to remember.
+        '''
+        self._max_cached = max_cached
+
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+
+        self.classified = 0
+        self.cache_hits = 0
+        self.offensive = 0
+
+    def classify(self, text):
+        '''
+        Check whether `text` is offensive.
+
+        Return value:
+            A `Verdict` instance.
+        '''
+        return self.classify_many([text])[0]
+
+    def classify_many(self, texts):
+        '''
+        Check whether each text in `texts` is offensive.
+
+        texts:
+            An iterable of texts.
+        Return value:
+            A list of `Verdict` instances, one for each text.
+        '''
+        verdicts = []
+        with self._lock:
+            for text in texts:
+                self.classified += 1
+
+                verdict = self._cache.get(text)
+                if verdict is not None:
+                    self._cache.move_to_end(text)
+                    self.cache_hits += 1
+                else:
+                    verdict = classify(text)
+                    self._cache[text] = verdict
+                    if len(self._cache) > self._max_cached:
+                        self._cache.popitem(last=False)
+
+                if verdict.offensive:
+                    self.offensive += 1
+                verdicts.append(verdict)
+
+        return verdicts
+
+    def stats(self):
+        '''
+        Get the classifier counters.
+
+        Return value:
+            A dictionary with the number of classified texts, of results found in the
+            cache and of offensive texts.
+        '''
+        with self._lock:
+            return collections.OrderedDict([
+                ('classified', self.classified),
+                ('cache-hits', self.cache_hits),
+                ('offensive', self.offensive),
+                ])
@@ -1,7 +1,148 @@
 import collections
 
+import metrics
+import tracing
 
-Result = collections.namedtuple('Result', ['equilibrium', 'text'])
+
+# equilibrium:
+#     Whether retranslating `text` gives back `text` itself.
+# text:
+#     The final text. If a cycle was found, this is its representative.
+# cycle_length:
+#     The number of distinct texts in the cycle the translations got stuck in
+#     (1 if an equilibrium was reached) or 0 if no cycle was found.
+# cycle:
+#     The texts in the cycle, in the order in which they were produced.
+Result = collections.namedtuple('Result', ['equilibrium', 'text', 'cycle_length', 'cycle'])
+
+
+_RUNS = metrics.REGISTRY.counter(
+    'transequilibrium_equilibrium_runs_total',
+    'Number of texts for which an equilibrium was searched, by outcome.')
+_ROUND_TRIPS = metrics.REGISTRY.histogram(
+    'transequilibrium_equilibrium_round_trips',
+    'Number of round trips (from the main language and back) done for each text.',
+    buckets=range(1, 16))
+
+
+def _cycle_representative(cycle):
+    # The order in which we enter a cycle depends on the initial text, so we pick
+    # something independent from it. Shorter texts are better for tweeting.
+    return min(cycle, key=lambda text: (len(text), text))
+
+
+class _Trajectory:
+    '''
+    Keep track of all the texts produced while looking for an equilibrium.
+    '''
+
+    def __init__(self, initial_text):
+        # The main language texts, starting from the initial one.
+        self._main_texts = [initial_text]
+        self._main_indices = {initial_text: 0}
+        # Maps intermediate texts to the index of the main text they were translated
+        # from.
+        self._intermediate_indices = {}
+        self._translations = 0
+
+        self.result = None
+
+    @property
+    def last_text(self):
+        return self._main_texts[-1]
+
+    def _set_result(self, result):
+        self.result = result
+
+        if result.equilibrium:
+            outcome = 'equilibrium'
+        elif result.cycle_length:
+            outcome = 'cycle'
+        else:
+            outcome = 'gave-up'
+        _RUNS.inc(outcome=outcome)
+        # A round trip which stopped after the first translation still counts.
+        _ROUND_TRIPS.observe((self._translations + 1) // 2)
+
+    def _set_cycle(self, cycle):
+        if len(cycle) == 1:
+            self._set_result(Result(True, cycle[0], 1, cycle))
+        else:
+            self._set_result(Result(False, _cycle_representative(cycle), len(cycle), cycle))
+
+    def add_intermediate(self, intermediate_text):
+        '''
+        Record `intermediate_text` as the translation of the last main language text.
+
+        Return value:
+            Whether a cycle was found. If so, `result` is set.
+        '''
+        self._translations += 1
+        current_index = len(self._main_texts) - 1
+        previous_index = self._intermediate_indices.get(intermediate_text)
+        if previous_index is None:
+            self._intermediate_indices[intermediate_text] = current_index
+            return False
+
+        # We already translated this intermediate text, so we know what it's going to
+        # be translated back into (the main text after `previous_index`) and that
+        # we are in a cycle without needing to do the translation.
+        self._set_cycle(self._main_texts[previous_index + 1:current_index + 1])
+        return True
+
+    def add_main(self, main_text):
+        '''
+        Record `main_text` as the retranslation of the last intermediate text.
+
+        Return value:
+            Whether a cycle was found. If so, `result` is set.
+        '''
+        self._translations += 1
+        previous_index = self._main_indices.get(main_text)
+        if previous_index is None:
+            self._main_indices[main_text] = len(self._main_texts)
+            self._main_texts.append(main_text)
+            return False
+
+        self._set_cycle(self._main_texts[previous_index:])
+        return True
+
+    def give_up(self):
+        '''
+        Set `result` for a trajectory which didn't end up in a cycle.
+        '''
+        self._set_result(Result(False, self.last_text, 0, []))
+
+
+def _start_session(translator):
+    # A translator can require all the translations for the same text to be done in
+    # a session (see `hedging.HedgingTranslator`), so they are consistent.
+    translator_session = getattr(translator, 'session', None)
+    if translator_session is not None:
+        return translator_session()
+    return translator
+
+
+def translate_many(translator, from_lang, to_lang, texts):
+    '''
+    Translate all the strings in `texts` from `from_lang` to `to_lang`.
+
+    If `translator` can translate multiple texts with a single request (i.e. it has
+    a `translate_many` method) this is used, otherwise the texts are translated one
+    by one.
+
+    Return value:
+        A list of translated texts, in the same order as `texts`.
+    '''
+    texts = list(texts)
+    if not texts:
+        return []
+
+    translator_translate_many = getattr(translator, 'translate_many', None)
+    if translator_translate_many is not None:
+        return translator_translate_many(from_lang, to_lang, texts)
+
+    return [translator.translate(from_lang, to_lang, text) for text in texts]
 
 
 def find_equilibrium(translator, main_lang, intermediate_lang, initial_text, translation_cb=None):
@@ -10,6 +151,11 @@ def find_equilibrium(translator, main_lang, intermediate_lang, initial_text, tra
     equilibrium is found, i.e. retranslating the text again doesn't change the
     translation.
 
+    All the translated texts are remembered, so the translation stops early also if
+    the texts get stuck in a cycle between a few different texts. In this case, the
+    returned text is a representative picked from the cycle which doesn't depend on
+    where the cycle was entered.
+
     translator:
         A translator instance.
     main_lang:
@@ -24,27 +170,102 @@ def find_equilibrium(translator, main_lang, intermediate_lang, initial_text, tra
         The function's gets as parameters the retry count, the language for the
         translated text (i.e. alternatively `intermediate_lang` and `main_lang`),
         ane the translated text.
+    Return value:
+        A `Result` instance.
     '''
-    last_text = initial_text
+    translator = _start_session(translator)
+    trajectory = _Trajectory(initial_text)
 
     for retry_count in range(15):
-        intermediate_text = translator.translate(main_lang, intermediate_lang, last_text)
+        with tracing.span('translate', round=retry_count, from_lang=main_lang,
+                          to_lang=intermediate_lang):
+            intermediate_text = translator.translate(main_lang, intermediate_lang,
+                                                     trajectory.last_text)
         if translation_cb:
             translation_cb(retry_count, intermediate_lang, intermediate_text)
+        if trajectory.add_intermediate(intermediate_text):
+            return trajectory.result
 
-        retranslated_text = translator.translate(intermediate_lang, main_lang, intermediate_text)
+        with tracing.span('translate', round=retry_count, from_lang=intermediate_lang,
+                          to_lang=main_lang):
+            retranslated_text = translator.translate(intermediate_lang, main_lang,
+                                                     intermediate_text)
         if translation_cb:
             translation_cb(retry_count, main_lang, retranslated_text)
+        if trajectory.add_main(retranslated_text):
+            return trajectory.result
 
-        if last_text == retranslated_text:
-            # Equilibrium!
-            return Result(True, last_text)
+    # We gave up as it doesn't look like we are going to reach an equilibrium.
+    trajectory.give_up()
+    return trajectory.result
 
-        # No equilibrium (yet?).
-        last_text = retranslated_text
 
-    # We gave up as it doesn't look like we are going to reach an equilibrium.
-    return Result(False, last_text)
+def find_equilibrium_many(translator, main_lang, intermediate_lang, initial_texts,
+                          translation_cb=None):
+    '''
+    Like `find_equilibrium`, but for multiple texts at the same time.
+
+    All the texts are translated in lock-step, so each round costs a single batched
+    request per direction (see `translate_many`) instead of one per text. Texts which
+    reach an equilibrium (or a cycle) drop out of the following rounds.
+
+    translator:
+        A translator instance.
+    main_lang:
+        The language for `initial_texts`.
+    intermediate_lang:
+        The intermediate language for the translation.
+    initial_texts:
+        The texts to translate.
+    translation_cb:
+        An optional function to call when a translation is made (for debugging
+        purposes).
+        The function gets as parameters the index of the text in `initial_texts`,
+        and then the same parameters as the callback for `find_equilibrium`.
+    Return value:
+        A list of `Result` instances, in the same order as `initial_texts`.
+    '''
+    translator = _start_session(translator)
+    trajectories = [_Trajectory(text) for text in initial_texts]
+
+    for retry_count in range(15):
+        active = [(index, trajectory) for index, trajectory in enumerate(trajectories)
+                  if trajectory.result is None]
+        if not active:
+            break
+
+        with tracing.span('translate', round=retry_count, from_lang=main_lang,
+                          to_lang=intermediate_lang, texts=len(active)):
+            intermediate_texts = translate_many(
+                translator, main_lang, intermediate_lang,
+                [trajectory.last_text for _, trajectory in active])
+
+        still_active = []
+        for (index, trajectory), intermediate_text in zip(active, intermediate_texts):
+            if translation_cb:
+                translation_cb(index, retry_count, intermediate_lang, intermediate_text)
+            if not trajectory.add_intermediate(intermediate_text):
+                still_active.append((index, trajectory, intermediate_text))
+
+        if not still_active:
+            break
+
+        with tracing.span('translate', round=retry_count, from_lang=intermediate_lang,
+                          to_lang=main_lang, texts=len(still_active)):
+            retranslated_texts = translate_many(
+                translator, intermediate_lang, main_lang,
+                [intermediate_text for _, _, intermediate_text in still_active])
+
+        for (index, trajectory, _), retranslated_text in zip(still_active, retranslated_texts):
+            if translation_cb:
+                translation_cb(index, retry_count, main_lang, retranslated_text)
+            trajectory.add_main(retranslated_text)
+
+    for trajectory in trajectories:
+        if trajectory.result is None:
+            trajectory.give_up()
+
+    return [trajectory.result for trajectory in trajectories]
 
 
 def debug_run(translator_new, config_basename, text=None):
@@ -73,5 +294,10 @@ def debug_run(translator_new, config_basename, text=None):
             ))
 
     res = find_equilibrium(translator, 'en', 'ja', text, translator_cb)
-    equilibrium_text = '' if res.equilibrium else ' (equilibrium not found)'
+    if res.equilibrium:
+        equilibrium_text = ''
+    elif res.cycle_length:
+        equilibrium_text = ' (cycle of length {})'.format(res.cycle_length)
+    else:
+        equilibrium_text = ' (equilibrium not found)'
     print('RESULT{}: {}'.format(equilibrium_text, res.text))
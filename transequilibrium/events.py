@@ -0,0 +1,375 @@
+import abc
+import collections
+import heapq
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import tweepy
+
+
+SOURCE_TYPES = ('none', 'file', 'socket', 'stream')
+
+
+def normalize_tweet_json(tweet_json):
+    '''
+    Make the JSON for a tweet look like the one returned by the REST API in extended
+    mode, so it can be processed like the tweets from the timeline.
+
+    The streaming API puts the full text and entities of long tweets in an
+    "extended_tweet" object, while the REST API puts them in "full_text" and
+    "entities".
+
+    tweet_json:
+        The JSON object (i.e. a dictionary) for the tweet.
+    Return value:
+        The normalized JSON object (`tweet_json` is not modified).
+    '''
+    tweet_json = dict(tweet_json)
+    if 'full_text' not in tweet_json:
+        extended = tweet_json.get('extended_tweet')
+        if extended is not None:
+            tweet_json['full_text'] = extended['full_text']
+            tweet_json['entities'] = extended.get('entities', tweet_json.get('entities', {}))
+        else:
+            tweet_json['full_text'] = tweet_json['text']
+    if 'id_str' not in tweet_json:
+        tweet_json['id_str'] = str(tweet_json['id'])
+    return tweet_json
+
+
+class EventSource(abc.ABC):
+    '''
+    Base class for sources of tweets which are pushed to us as soon as they are
+    posted, instead of being fetched by polling the timeline.
+
+    Subclasses receive the tweets (usually on a background thread) and pass their
+    JSON to `_push`. Duplicated tweets are dropped and the others are returned by
+    `get_tweets`, sorted by ID.
+
+    Nothing guarantees that all the tweets are pushed (for instance, if the
+    connection drops), so the timeline should still be polled once in a while to
+    catch the missing ones.
+    '''
+
+    # After a tweet arrives, how long to wait for other ones, so tweets arriving
+    # close together but out of order are still sorted.
+    SETTLE_TIME = 1.0
+
+    # How many tweet IDs to remember to detect duplicates.
+    MAX_SEEN = 10000
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        # A heap of `(tweet_id, tweet_json)` tuples.
+        self._heap = []
+        self._seen = collections.OrderedDict()
+        self._woken_up = False
+        self._closed = False
+
+        self.received = 0
+        self.duplicates = 0
+        self.invalid = 0
+
+    @property
+    @abc.abstractmethod
+    def name(self):
+        '''
+        A description of the source, for the statistics.
+        '''
+
+    def _push(self, tweet_json):
+        '''
+        Add a tweet received by the source.
+
+        tweet_json:
+            The JSON object (i.e. a dictionary) for the tweet.
+        '''
+        try:
+            tweet_json = normalize_tweet_json(tweet_json)
+            tweet_id = int(tweet_json['id_str'])
+        except (KeyError, TypeError, ValueError):
+            with self._condition:
+                self.invalid += 1
+            return
+
+        with self._condition:
+            self.received += 1
+            if tweet_id in self._seen:
+                self.duplicates += 1
+                return
+
+            self._seen[tweet_id] = True
+            while len(self._seen) > self.MAX_SEEN:
+                self._seen.popitem(last=False)
+
+            heapq.heappush(self._heap, (tweet_id, tweet_json))
+            self._condition.notify_all()
+
+    def get_tweets(self, timeout):
+        '''
+        Wait for tweets to be pushed.
+
+        timeout:
+            The maximum number of seconds to wait.
+        Return value:
+            A list of tweet JSON objects sorted from the oldest to the newest. The list
+            is empty if nothing arrived before the timeout, if `wake_up` was called or
+            if the source was closed.
+        '''
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while not self._heap and not self._woken_up and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            if self._heap and not self._woken_up and not self._closed:
+                settle_deadline = min(time.monotonic() + self.SETTLE_TIME, deadline)
+                while not self._woken_up and not self._closed:
+                    remaining = settle_deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+            self._woken_up = False
+            tweets = []
+            while self._heap:
+                tweets.append(heapq.heappop(self._heap)[1])
+            return tweets
+
+    def wake_up(self):
+        '''
+        Make a call to `get_tweets` return immediately (with the tweets received so far).
+
+        This can be called from a signal handler.
+        '''
+        with self._condition:
+            self._woken_up = True
+            self._condition.notify_all()
+
+    def stats(self):
+        '''
+        Get the source counters.
+
+        Return value:
+            A dictionary with the number of received tweets, of duplicated ones and of
+            events which were not valid tweets.
+        '''
+        with self._condition:
+            return collections.OrderedDict([
+                ('source', self.name),
+                ('received', self.received),
+                ('duplicates', self.duplicates),
+                ('invalid', self.invalid),
+                ])
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _push_line(self, line):
+        line = line.strip()
+        if not line:
+            return
+        try:
+            tweet_json = json.loads(line)
+        except ValueError:
+            with self._condition:
+                self.invalid += 1
+            return
+        self._push(tweet_json)
+
+
+class FileEventSource(EventSource):
+    '''
+    An event source reading tweets from a file, one JSON object per line.
+
+    The file is followed like with `tail -f`, so another process can append tweets
+    to it. This is mainly useful to test the push mode without connecting to
+    Twitter.
+    '''
+
+    def __init__(self, path, poll_interval=0.5):
+        '''
+        Initialize a `FileEventSource` instance.
+
+        path:
+            The path of the file. It doesn't need to exist yet.
+        poll_interval:
+            How many seconds to wait between checks for new lines.
+        '''
+        super().__init__()
+
+        self._path = path
+        self._poll_interval = poll_interval
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self._thread_main, name='file-events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def name(self):
+        return 'file:{}'.format(self._path)
+
+    def _thread_main(self):
+        offset = 0
+        partial = ''
+        while not self._stopped.is_set():
+            try:
+                if os.path.getsize(self._path) < offset:
+                    # The file was truncated, start again.
+                    offset = 0
+                    partial = ''
+                with open(self._path) as events_file:
+                    events_file.seek(offset)
+                    data = events_file.read()
+                    offset = events_file.tell()
+            except (IOError, OSError):
+                data = ''
+
+            lines = (partial + data).split('\n')
+            # The last line may not be complete yet.
+            partial = lines.pop()
+            for line in lines:
+                self._push_line(line)
+
+            self._stopped.wait(self._poll_interval)
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join()
+        super().close()
+
+
+class _LineHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            #pylint: disable=protected-access
+            self.server.event_source._push_line(line.decode('utf-8', 'replace'))
+
+
+class SocketEventSource(EventSource):
+    '''
+    An event source listening for tweets on a TCP socket.
+
+    Clients connect and send tweets, one JSON object per line (see `main`). This is
+    a local stand-in for a webhook or streaming connection.
+    '''
+
+    def __init__(self, host, port):
+        '''
+        Initialize a `SocketEventSource` instance.
+
+        host:
+            The address to listen on, usually "localhost".
+        port:
+            The port to listen on.
+        '''
+        super().__init__()
+
+        self._server = socketserver.ThreadingTCPServer((host, port), _LineHandler,
+                                                       bind_and_activate=False)
+        self._server.allow_reuse_address = True
+        self._server.daemon_threads = True
+        self._server.event_source = self
+        try:
+            self._server.server_bind()
+            self._server.server_activate()
+        except BaseException:
+            self._server.server_close()
+            raise
+
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='socket-events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def name(self):
+        host, port = self._server.server_address[:2]
+        return 'socket:{}:{}'.format(host, port)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        super().close()
+
+
+class _StreamListener(tweepy.StreamListener):
+    def __init__(self, event_source):
+        super().__init__()
+        self._event_source = event_source
+
+    def on_status(self, status):
+        #pylint: disable=protected-access
+        self._event_source._push(status._json)
+
+    def on_error(self, status_code):
+        print('WARNING: The Twitter stream failed with status {}.'.format(status_code),
+              file=sys.stderr)
+        # Keep going, tweepy waits before reconnecting.
+        return True
+
+
+class StreamEventSource(EventSource):
+    '''
+    An event source receiving tweets from the Twitter streaming API.
+
+    The stream also contains tweets by other users (for instance, replies to the
+    followed users), so the tweets must still be filtered by user.
+    '''
+
+    def __init__(self, auth, follow_ids):
+        '''
+        Initialize a `StreamEventSource` instance.
+
+        auth:
+            The `tweepy.OAuthHandler` to use.
+        follow_ids:
+            A list of the IDs (as strings) of the users whose tweets we want.
+        '''
+        super().__init__()
+
+        self._stream = tweepy.Stream(auth, _StreamListener(self))
+        # The stream is run on our own thread, as the argument for this changed
+        # name between tweepy versions.
+        self._thread = threading.Thread(target=self._stream.filter,
+                                        kwargs={'follow': follow_ids},
+                                        name='stream-events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def name(self):
+        return 'stream'
+
+    def close(self):
+        self._stream.disconnect()
+        super().close()
+
+
+def main():
+    '''
+    Send the tweets from the standard input (one JSON object per line) to a
+    `SocketEventSource`.
+    '''
+    if len(sys.argv) != 3:
+        print('{} HOST PORT < TWEETS-FILE'.format(sys.argv[0]), file=sys.stderr)
+        raise SystemExit(1)
+
+    with socket.create_connection((sys.argv[1], int(sys.argv[2]))) as connection:
+        for line in sys.stdin:
+            connection.sendall(line.encode('utf-8'))
+
+
+if __name__ == '__main__':
+    main()
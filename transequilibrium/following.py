@@ -0,0 +1,142 @@
+import collections
+import json
+import os
+import time
+
+
+# How many IDs Twitter returns for each call to get the followed users.
+FRIENDS_IDS_PAGE_SIZE = 5000
+
+
+def count_friends_ids_calls(count):
+    '''
+    Get the number of calls needed to get the IDs of `count` followed users.
+    '''
+    return max((count + FRIENDS_IDS_PAGE_SIZE - 1) // FRIENDS_IDS_PAGE_SIZE, 1)
+
+
+class FollowingStore:
+    '''
+    The set of users followed by an account, saved to a file so it doesn't need to
+    be downloaded from Twitter every time.
+
+    The set is updated locally when a user is followed, but it's still reconciled
+    with Twitter (i.e. downloaded again) once in a while or if something suggests
+    it's not correct anymore.
+    '''
+
+    def __init__(self, path, reconcile_interval=24 * 60 * 60):
+        '''
+        Initialize a `FollowingStore` instance.
+
+        path:
+            The file where the set is saved.
+        reconcile_interval:
+            How many seconds can pass before the set must be reconciled.
+        '''
+        self._path = path
+        self._reconcile_interval = reconcile_interval
+
+        self.ids = set()
+        self._reconcile_time = None
+        self._total_saved_calls = 0
+
+        # Counters for this instance only.
+        self.reconciles = 0
+        self.saved_calls = 0
+
+        try:
+            with open(self._path) as store_file:
+                content = json.load(store_file)
+        except (IOError, ValueError):
+            # Missing or corrupted, so it's like we never reconciled.
+            return
+
+        self.ids = set(content['ids'])
+        self._reconcile_time = content['reconcile-time']
+        self._total_saved_calls = content.get('saved-calls', 0)
+
+    def save(self):
+        '''
+        Save the set and the counters to the file.
+
+        This is done automatically when the set changes, but not when only the
+        counters do.
+        '''
+        content = collections.OrderedDict([
+            ('reconcile-time', self._reconcile_time),
+            ('saved-calls', self._total_saved_calls),
+            ('ids', sorted(self.ids)),
+            ])
+
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as store_file:
+            json.dump(content, store_file)
+        os.replace(tmp_path, self._path)
+
+    def needs_reconcile(self, expected_count=None):
+        '''
+        Whether the set must be reconciled with Twitter.
+
+        expected_count:
+            The number of followed users according to Twitter or `None` if not
+            known. If different from the number of users in the set, then the set
+            is not correct.
+        '''
+        if self._reconcile_time is None:
+            return True
+        if time.time() - self._reconcile_time >= self._reconcile_interval:
+            return True
+        return expected_count is not None and expected_count != len(self.ids)
+
+    def mark_stale(self):
+        '''
+        Force the set to be reconciled the next time `needs_reconcile` is called.
+        '''
+        self._reconcile_time = None
+        self.save()
+
+    def reconcile(self, ids):
+        '''
+        Replace the set with the one downloaded from Twitter.
+
+        ids:
+            An iterable of the IDs of the followed users.
+        '''
+        ids = set(ids)
+        # Use the same set object, as it can be shared with other code.
+        self.ids.clear()
+        self.ids.update(ids)
+        self._reconcile_time = time.time()
+        self.reconciles += 1
+        self.save()
+
+    def skip_reconcile(self):
+        '''
+        Record that the saved set was used instead of downloading it again.
+        '''
+        saved = count_friends_ids_calls(len(self.ids))
+        self.saved_calls += saved
+        self._total_saved_calls += saved
+
+    def add(self, user_id):
+        '''
+        Record that the account is now following the user with ID `user_id`.
+        '''
+        self.ids.add(user_id)
+        self.save()
+
+    def stats(self):
+        '''
+        Get the sync counters.
+
+        Return value:
+            A dictionary with the number of followed users, of reconciles and of
+            calls saved by not reconciling (both for this instance and in total).
+        '''
+        return collections.OrderedDict([
+            ('following', len(self.ids)),
+            ('reconciles', self.reconciles),
+            ('saved-calls', self.saved_calls),
+            ('total-saved-calls', self._total_saved_calls),
+            ])
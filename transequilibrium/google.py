@@ -1,3 +1,5 @@
+import threading
+
 import googleapiclient.discovery
 
 import escaping
@@ -21,8 +23,20 @@ class Translator:
             model = 'nmt'
         assert model in ('base', 'nmt')
         self._model = model
+        self._dev_key = dev_key
+
+        # The HTTP objects used by the API client are not thread-safe, so each thread
+        # gets its own service.
+        self._local = threading.local()
+        self._get_service()
 
-        self._service = googleapiclient.discovery.build('translate', 'v2', developerKey=dev_key)
+    def _get_service(self):
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = googleapiclient.discovery.build('translate', 'v2',
+                                                      developerKey=self._dev_key)
+            self._local.service = service
+        return service
 
     @property
     def name(self):
@@ -35,14 +49,29 @@ class Translator:
         Return value:
             The translated text.
         '''
+        return self.translate_many(from_lang, to_lang, [text])[0]
+
+    def translate_many(self, from_lang, to_lang, texts):
+        '''
+        Translate all the strings in `texts` from `from_lang` to `to_lang` with a
+        single request.
+
+        Return value:
+            A list of translated texts, in the same order as `texts`.
+        '''
+        texts = list(texts)
+        if not texts:
+            return []
+
         # pylint: disable=no-member
-        res = self._service.translations().list(
-            q=[text],
+        res = self._get_service().translations().list(
+            q=texts,
             source=from_lang,
             target=to_lang,
             model=self._model,
             ).execute()
-        return escaping.html_unescape(res['translations'][0]['translatedText'])
+        return [escaping.html_unescape(translation['translatedText'])
+                for translation in res['translations']]
 
 
 def main():
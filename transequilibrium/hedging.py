@@ -0,0 +1,320 @@
+import collections
+import concurrent.futures
+import math
+import threading
+import time
+
+import equilibrium
+import metrics
+import ratelimit
+
+
+_HEDGES = metrics.REGISTRY.counter(
+    'transequilibrium_translator_hedges_total',
+    'Number of requests sent to the secondary translator as well, by winner.')
+
+
+class _Race:
+    # The state of a call sent to a translator and, possibly, to a second one.
+
+    def __init__(self, backends):
+        self.backends = backends
+        self.condition = threading.Condition()
+        self.start = time.monotonic()
+        # Maps the index in `backends` to a `(result, exception, end_time)` tuple.
+        self.outcomes = {}
+        # The indexes of the requests waiting for a rate limiter and, for the ones
+        # which waited, when they stopped waiting (i.e. were actually sent).
+        self.throttled = set()
+        self.sent_times = {}
+
+    def get_sent_time(self, index):
+        return self.sent_times.get(index, self.start)
+
+
+class HedgingTranslator:
+    '''
+    Wrap a primary and a secondary translator and, if the primary is slow to answer a
+    request, send the same request to the secondary one and use whichever answers
+    first.
+
+    The delay before hedging is a percentile of the recent latencies of the primary
+    translator, so only the slowest requests (the ones which would dominate the
+    time taken by a tweet) are sent twice.
+
+    The time a request spends waiting for a rate limiter (see `ratelimit`) doesn't
+    count: when the quota is used up, a hedged request would only take more of it.
+
+    The two translators don't translate in the same way, so, to avoid mixing them
+    while looking for an equilibrium, use a `session`: its first request is hedged
+    with the secondary translator and the following ones go to the translator which
+    answered it. A stall usually affects a single request, so, if one of the
+    following requests is slow, it's sent again to the same translator.
+    '''
+
+    #pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, primary, secondary, percentile=95, min_delay=0.2, max_delay=5,
+                 window=200, min_samples=20, max_workers=16):
+        '''
+        Initialize a `HedgingTranslator` instance.
+
+        primary:
+            The translator to use normally.
+        secondary:
+            The translator to use when the primary one is slow or fails.
+        percentile:
+            Which percentile of the latencies of the primary translator to wait before
+            sending a request to the secondary one.
+        min_delay, max_delay:
+            The bounds (in seconds) for the delay computed from the percentile.
+            `max_delay` is also used until enough latencies were recorded.
+        window:
+            How many recent latencies of the primary translator to remember.
+        min_samples:
+            How many latencies are needed before using the percentile.
+        max_workers:
+            The maximum number of requests in flight at the same time.
+        '''
+        assert 0 < percentile <= 100
+        assert 0 <= min_delay <= max_delay
+
+        self.primary = primary
+        self.secondary = secondary
+        self._backends = (primary, secondary)
+        self._percentile = percentile
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._min_samples = min_samples
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='hedging')
+
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window)
+
+        self.requests = 0
+        self.hedged = 0
+        self.secondary_wins = 0
+        self.duplicate_wins = 0
+        self.failovers = 0
+        self.saved_seconds = 0.0
+        self.pinned = [0, 0]
+
+    @property
+    def name(self):
+        return 'hedge({},{})'.format(self.primary.name, self.secondary.name)
+
+    def close(self):
+        '''
+        Wait for the requests in flight and close the wrapped translators.
+        '''
+        self._executor.shutdown(wait=True)
+        for backend in self._backends:
+            backend_close = getattr(backend, 'close', None)
+            if backend_close is not None:
+                backend_close()
+
+    def get_delay(self):
+        '''
+        Get how many seconds to wait for the primary translator before hedging.
+        '''
+        with self._lock:
+            if len(self._latencies) < self._min_samples:
+                return self._max_delay
+            latencies = sorted(self._latencies)
+        index = max(math.ceil(self._percentile / 100 * len(latencies)) - 1, 0)
+        return min(max(latencies[index], self._min_delay), self._max_delay)
+
+    def _record_latency(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    @staticmethod
+    def _set_throttled(race, index, waiting):
+        with race.condition:
+            if waiting:
+                race.throttled.add(index)
+            else:
+                race.throttled.discard(index)
+                race.sent_times[index] = time.monotonic()
+            race.condition.notify_all()
+
+    def _run(self, race, index, function):
+        ratelimit.set_wait_listener(
+            lambda waiting: self._set_throttled(race, index, waiting))
+        try:
+            outcome = (function(race.backends[index]), None, time.monotonic())
+        except Exception as exc: #pylint: disable=broad-except
+            outcome = (None, exc, time.monotonic())
+        finally:
+            ratelimit.set_wait_listener(None)
+
+        with race.condition:
+            race.outcomes[index] = outcome
+            race.condition.notify_all()
+            other = race.outcomes.get(1)
+            sent_time = race.get_sent_time(index)
+
+        if index == 0 and outcome[1] is None:
+            if race.backends[0] is self.primary:
+                self._record_latency(outcome[2] - sent_time)
+            if other is not None and other[1] is None:
+                # The hedged request won, this is how much time it saved.
+                with self._lock:
+                    self.saved_seconds += outcome[2] - other[2]
+
+    def _hedge(self, function, backend=None):
+        '''
+        Call `function` with a translator and, if it's slow or fails, with a second
+        one.
+
+        function:
+            A function taking a translator and returning its translation(s).
+        backend:
+            The translator to send duplicated requests to or `None` to hedge the
+            primary translator with the secondary one.
+        Return value:
+            A `(result, translator)` tuple, where `translator` is the translator
+            which gave `result`.
+        '''
+        if backend is None:
+            race = _Race(self._backends)
+        else:
+            race = _Race((backend, backend))
+        delay = self.get_delay()
+        self._executor.submit(self._run, race, 0, function)
+
+        with race.condition:
+            while not race.outcomes:
+                if 0 in race.throttled:
+                    # Don't hedge while waiting for the rate limiter.
+                    race.condition.wait()
+                    continue
+                remaining = race.get_sent_time(0) + delay - time.monotonic()
+                if remaining <= 0:
+                    break
+                race.condition.wait(remaining)
+            primary = race.outcomes.get(0)
+            if primary is not None and primary[1] is None:
+                with self._lock:
+                    self.requests += 1
+                return primary[0], race.backends[0]
+
+        with self._lock:
+            self.requests += 1
+            if primary is None:
+                self.hedged += 1
+            else:
+                # The primary translator failed, so this is not a hedge.
+                self.failovers += 1
+        self._executor.submit(self._run, race, 1, function)
+
+        with race.condition:
+            while True:
+                # Prefer the primary translator if both answered.
+                for index in (0, 1):
+                    outcome = race.outcomes.get(index)
+                    if outcome is not None and outcome[1] is None:
+                        if backend is None:
+                            winner = ('primary', 'secondary')[index]
+                        else:
+                            winner = ('first', 'duplicate')[index]
+                        if index == 1:
+                            with self._lock:
+                                if backend is None:
+                                    self.secondary_wins += 1
+                                else:
+                                    self.duplicate_wins += 1
+                        if primary is None:
+                            _HEDGES.inc(winner=winner)
+                        return outcome[0], race.backends[index]
+                if len(race.outcomes) == 2:
+                    # Both failed, the primary error is more useful.
+                    raise race.outcomes[0][1]
+                race.condition.wait()
+
+    def translate(self, from_lang, to_lang, text):
+        '''
+        Translate `text` from `from_lang` to `to_lang`.
+
+        Return value:
+            The translated text.
+        '''
+        return self._hedge(lambda backend: backend.translate(from_lang, to_lang, text))[0]
+
+    def translate_many(self, from_lang, to_lang, texts):
+        '''
+        Translate all the strings in `texts` from `from_lang` to `to_lang`.
+
+        Return value:
+            A list of translated texts, in the same order as `texts`.
+        '''
+        texts = list(texts)
+        if not texts:
+            return []
+        return self._hedge(
+            lambda backend: equilibrium.translate_many(backend, from_lang, to_lang, texts))[0]
+
+    def session(self):
+        '''
+        Get a translator whose requests all go to the same backend, that is the one
+        which answered its first request.
+        '''
+        return _Session(self)
+
+    def _pin(self, backend):
+        with self._lock:
+            self.pinned[self._backends.index(backend)] += 1
+
+    def stats(self):
+        '''
+        Get the hedging counters.
+
+        Return value:
+            A dictionary with the number of hedged requests, how often the secondary
+            translator won, the time saved and the current delay.
+        '''
+        delay = self.get_delay()
+        with self._lock:
+            return collections.OrderedDict([
+                ('requests', self.requests),
+                ('hedged', self.hedged),
+                ('hedge-rate', round(self.hedged / self.requests, 3) if self.requests else 0),
+                ('secondary-wins', self.secondary_wins),
+                ('duplicate-wins', self.duplicate_wins),
+                ('failovers', self.failovers),
+                ('saved-seconds', round(self.saved_seconds, 3)),
+                ('pinned-primary', self.pinned[0]),
+                ('pinned-secondary', self.pinned[1]),
+                ('delay-ms', round(delay * 1000, 1)),
+                ])
+
+
+class _Session:
+    # A translator returned by `HedgingTranslator.session`.
+
+    def __init__(self, hedging_translator):
+        self._hedging_translator = hedging_translator
+        self._backend = None
+
+    @property
+    def name(self):
+        return self._hedging_translator.name
+
+    def _call(self, function):
+        #pylint: disable=protected-access
+        result, backend = self._hedging_translator._hedge(function, self._backend)
+        if self._backend is None:
+            self._backend = backend
+            self._hedging_translator._pin(backend)
+        return result
+
+    def translate(self, from_lang, to_lang, text):
+        return self._call(lambda backend: backend.translate(from_lang, to_lang, text))
+
+    def translate_many(self, from_lang, to_lang, texts):
+        texts = list(texts)
+        if not texts:
+            return []
+        return self._call(
+            lambda backend: equilibrium.translate_many(backend, from_lang, to_lang, texts))
@@ -0,0 +1,108 @@
+import collections
+
+import requests
+import requests.adapters
+
+
+class HTTPPool:
+    '''
+    A pool of keep-alive HTTP connections.
+
+    Using the module-level `requests` functions opens a new connection (including
+    the TLS handshake) for every request. Requests done through an `HTTPPool` reuse
+    the connections to the same host instead.
+
+    The pool can be shared by multiple objects and is safe to use from multiple
+    threads.
+    '''
+
+    #pylint: disable=too-many-arguments
+    def __init__(self, pool_connections=4, pool_maxsize=8, connect_timeout=10,
+                 read_timeout=30):
+        '''
+        Initialize an `HTTPPool` instance.
+
+        pool_connections:
+            The number of different hosts for which connections are kept.
+        pool_maxsize:
+            The maximum number of connections kept for each host. This should be at
+            least as big as the number of threads doing requests at the same time.
+        connect_timeout:
+            How many seconds to wait for a connection to be established.
+        read_timeout:
+            How many seconds to wait for the server to send data.
+        '''
+        self._timeout = (connect_timeout, read_timeout)
+
+        self._adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+                                                      pool_maxsize=pool_maxsize)
+        self._session = requests.Session()
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+
+    def request(self, method, url, **kwargs):
+        '''
+        Do an HTTP request using a pooled connection.
+
+        The arguments are the same as for `requests.request`. If no timeout is
+        specified, then the pool's timeouts are used.
+
+        Return value:
+            A `requests.Response` instance.
+        '''
+        kwargs.setdefault('timeout', self._timeout)
+        return self._session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        '''
+        Get the connection counters.
+
+        Only hosts which still have a pool of connections are counted.
+
+        Return value:
+            A dictionary with the number of requests, of new connections and of
+            requests which reused an existing connection.
+        '''
+        pools = self._adapter.poolmanager.pools
+        requests_count = 0
+        new_connections = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_count += pool.num_requests
+            new_connections += pool.num_connections
+
+        return collections.OrderedDict([
+            ('requests', requests_count),
+            ('new-connections', new_connections),
+            ('reused-connections', max(requests_count - new_connections, 0)),
+            ])
+
+    def close(self):
+        '''
+        Close all the pooled connections.
+        '''
+        self._session.close()
+
+
+_g_default_pool = None
+
+
+def get_default_pool():
+    '''
+    Get an `HTTPPool` with the default settings shared by the whole process.
+
+    Return value:
+        An `HTTPPool` instance.
+    '''
+    global _g_default_pool
+    if _g_default_pool is None:
+        _g_default_pool = HTTPPool()
+    return _g_default_pool
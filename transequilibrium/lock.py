@@ -29,7 +29,9 @@ class FileLock(object):
     File-based locking.
     '''
 
-    def __init__(self, lock_file_path, timeout=60, timeout_cb=None, still_waiting_cb=None):
+    #pylint: disable=too-many-arguments
+    def __init__(self, lock_file_path, timeout=60, timeout_cb=None, still_waiting_cb=None,
+                 sleep_time=0.5):
         '''
         Initialize a `FileLock` instance.
 
@@ -44,6 +46,9 @@ class FileLock(object):
             A function to call once in a while if we are waiting to acquire the lock. This is
             useful, for instance, to print an informative message to the user, so that they
             know the program is not frozen.
+        sleep_time:
+            How many seconds to wait between attempts to acquire the lock. Locks held
+            only briefly can use a shorter time.
         '''
         self._lock_file_path = lock_file_path
         self._timeout = timeout
@@ -52,7 +57,7 @@ class FileLock(object):
 
         self._locked = False
         self._lock_file = None
-        self._sleep_time = 0.5
+        self._sleep_time = sleep_time
 
     def __enter__(self):
         self.acquire()
@@ -0,0 +1,412 @@
+import bisect
+import calendar
+import codecs
+import collections
+import datetime
+import json
+import mmap
+import os
+import re
+import struct
+
+import lock
+
+
+TYPE_TWEET = 1
+TYPE_RETWEET = 2
+TYPE_FOLLOWING = 3
+TYPE_SKIPPED = 4
+
+TYPE_NAMES = {
+    TYPE_TWEET: 'tweet',
+    TYPE_RETWEET: 'retweet',
+    TYPE_FOLLOWING: 'following',
+    TYPE_SKIPPED: 'skipped',
+    }
+
+
+def timestamp_from_iso(iso_time):
+    '''
+    Convert a (UTC) time in ISO format, as stored in the log, to a UNIX timestamp.
+    '''
+    parsed = datetime.datetime.strptime(iso_time[:19], '%Y-%m-%dT%H:%M:%S')
+    return float(calendar.timegm(parsed.utctimetuple()))
+
+
+def timestamp_from_datetime(time):
+    '''
+    Convert a (UTC) `datetime.datetime` to a UNIX timestamp.
+    '''
+    return float(calendar.timegm(time.utctimetuple()))
+
+
+# type:
+#     The type of the entry (one of the `TYPE_*` constants).
+# length:
+#     The length in bytes of the entry in the log.
+# tweet_id:
+#     The ID of the original tweet. For entries without an ID (i.e. following
+#     entries) this is the ID of the previous entry, so IDs are sorted.
+# time:
+#     The time of the original tweet as UNIX timestamp. For entries without a time,
+#     like for `tweet_id`, the time of the previous entry is used.
+# offset:
+#     The offset in bytes of the entry in the log.
+IndexRecord = collections.namedtuple('IndexRecord',
+                                     ['type', 'length', 'tweet_id', 'time', 'offset'])
+
+
+_CHUNK_SIZE = 1024 * 1024
+
+# Entries are JSON objects indented with 4 spaces and strings cannot contain new
+# lines, so these can only match the start (the brace followed by the first key)
+# and the end of an entry.
+_ENTRY_START = '{\n    "'
+_ENTRY_END = '\n}\n'
+
+# Quotes in strings are escaped, so these can only match keys.
+_FOLLOWING_START = '{\n    "following-id":'
+_RETWEET_KEY = '"skipped-because-retweet":'
+_SKIPPED_KEY = '"skipped-because-offensive":'
+_TWEET_KEY = '"translated-text":'
+
+_STR_PATTERNS = (_ENTRY_START, _ENTRY_END, _FOLLOWING_START, _RETWEET_KEY, _SKIPPED_KEY,
+                 _TWEET_KEY)
+_BYTES_PATTERNS = tuple(pattern.encode('ascii') for pattern in _STR_PATTERNS)
+
+_ID_RE = re.compile(br'"original-id":\s*(\d+)')
+_TIME_RE = re.compile(br'"original-time":\s*"([^"]*)"')
+
+_DECODER = json.JSONDecoder()
+
+
+def _split_entries(read_chunk, buf, patterns):
+    '''
+    Split the content of a log file into entries.
+
+    read_chunk:
+        A function returning the next chunk of the file or an empty chunk at the end.
+    buf:
+        An empty buffer of the same type as the chunks.
+    patterns:
+        `_STR_PATTERNS` or `_BYTES_PATTERNS`, depending on the type of the chunks.
+    Return value:
+        An iterator over `(buf, start, end, type, buf_offset)` tuples, where the entry
+        is `buf[start:end]` and `buf_offset` is the position of `buf` in the file.
+    '''
+    entry_start, entry_end, following_start, retweet_key, skipped_key, tweet_key = patterns
+
+    buf_offset = 0
+
+    while True:
+        chunk = read_chunk()
+        buf += chunk
+
+        pos = 0
+        while True:
+            end = buf.find(entry_end, pos)
+            if end == -1:
+                break
+            end += len(entry_end)
+
+            # If this is not at `pos`, then what is before it is a truncated entry.
+            start = buf.rfind(entry_start, pos, end)
+            pos = end
+            if start == -1:
+                # Not an entry at all, so there's nothing we can do.
+                continue
+
+            if buf.startswith(following_start, start):
+                object_type = TYPE_FOLLOWING
+            elif buf.find(retweet_key, start, end) != -1:
+                object_type = TYPE_RETWEET
+            elif buf.find(skipped_key, start, end) != -1:
+                object_type = TYPE_SKIPPED
+            elif buf.find(tweet_key, start, end) != -1:
+                object_type = TYPE_TWEET
+            else:
+                raise ValueError('Invalid object: {}'.format(buf[start:end]))
+
+            yield buf, start, end, object_type, buf_offset
+
+        buf = buf[pos:]
+        buf_offset += pos
+
+        if not chunk:
+            break
+
+
+def read_entries(log_file, offset=0):
+    '''
+    Find the entries in a log file without decoding them.
+
+    The file is read in big chunks. A truncated entry (for instance, because the
+    application crashed while writing it) is ignored, both at the end of the file
+    and if followed by other entries.
+
+    log_file:
+        A log file opened in binary mode.
+    offset:
+        Where to start reading. This must be the start of an entry.
+    Return value:
+        An iterator over `(offset, type, content)` tuples, where `content` are the
+        bytes of the (undecoded) entry.
+    '''
+    log_file.seek(offset)
+
+    for buf, start, end, object_type, buf_offset in _split_entries(
+            lambda: log_file.read(_CHUNK_SIZE), b'', _BYTES_PATTERNS):
+        yield offset + buf_offset + start, object_type, buf[start:end]
+
+
+def decode_entries(log_file, wanted_types=None):
+    '''
+    Decode the entries in a log file.
+
+    Like for `read_entries`, the file is read in big chunks and truncated entries
+    are ignored.
+
+    log_file:
+        A log file opened in binary mode.
+    wanted_types:
+        A container with the types (i.e. `TYPE_*` constants) of the entries to decode
+        or `None` to decode all of them. Entries of other types are skipped without
+        decoding them, which is much faster.
+    Return value:
+        An iterator over the decoded entries.
+    '''
+    log_file.seek(0)
+
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    def read_chunk():
+        chunk = log_file.read(_CHUNK_SIZE)
+        return text_decoder.decode(chunk, final=not chunk)
+
+    raw_decode = _DECODER.raw_decode
+
+    for buf, start, _, object_type, _ in _split_entries(read_chunk, '', _STR_PATTERNS):
+        if wanted_types is None or object_type in wanted_types:
+            yield raw_decode(buf, start)[0]
+
+
+def decode_entry(content):
+    '''
+    Decode a log entry.
+
+    content:
+        The bytes of the entry.
+    Return value:
+        The decoded JSON object.
+    '''
+    return _DECODER.raw_decode(content.decode('utf-8'))[0]
+
+
+def _make_records(entries, tweet_id=0, time=0.0):
+    for offset, object_type, content in entries:
+        if object_type != TYPE_FOLLOWING:
+            tweet_id = int(_ID_RE.search(content).group(1))
+            time = timestamp_from_iso(_TIME_RE.search(content).group(1).decode('utf-8'))
+        yield IndexRecord(object_type, len(content), tweet_id, time, offset)
+
+
+class LogIndex:
+    '''
+    A sidecar index for a log file, allowing random access to its entries.
+
+    The index is a file (next to the log) with a fixed-size record for each entry
+    in the log, so records can be accessed directly by position.
+    '''
+
+    _MAGIC = b'TEQIDX01'
+    _RECORD = struct.Struct('<BxxxIqdQ')
+
+    def __init__(self, log_path, index_path=None):
+        '''
+        Initialize a `LogIndex` instance.
+
+        log_path:
+            The path of the log to index.
+        index_path:
+            The path of the index or `None` to use the default one (i.e. the log
+            path with ".idx" appended).
+        '''
+        self._log_path = log_path
+        self._index_path = index_path or log_path + '.idx'
+
+        self._index_file = None
+        self._index_map = None
+        self._count = 0
+
+        # Views on the records which can be used with `bisect`.
+        self.tweet_ids = _FieldView(self, 'tweet_id')
+        self.times = _FieldView(self, 'time')
+
+    def close(self):
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_map = None
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+        self._count = 0
+
+    def __del__(self):
+        self.close()
+
+    def _load(self):
+        self.close()
+
+        try:
+            self._index_file = open(self._index_path, 'rb')
+        except IOError:
+            return
+
+        size = os.fstat(self._index_file.fileno()).st_size
+        if size <= len(self._MAGIC) or self._index_file.read(len(self._MAGIC)) != self._MAGIC:
+            self.close()
+            return
+
+        self._index_map = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        # Ignore a partially written record.
+        self._count = (size - len(self._MAGIC)) // self._RECORD.size
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('Index record out of range.')
+
+        offset = len(self._MAGIC) + index * self._RECORD.size
+        return IndexRecord(*self._RECORD.unpack_from(self._index_map, offset))
+
+    @property
+    def indexed_end(self):
+        '''
+        The offset in the log after the last indexed entry.
+        '''
+        if not self._count:
+            return 0
+        last = self[-1]
+        return last.offset + last.length
+
+    def open(self, allow_unindexed_tail=False):
+        '''
+        Open the index, without updating it.
+
+        allow_unindexed_tail:
+            Whether the index should be considered consistent if the end of the log is
+            not indexed. This is useful just after calling `update`, as the tail can
+            then only be a truncated entry.
+        Return value:
+            Whether the index is consistent with the log (i.e. the whole log is
+            indexed).
+        '''
+        self._load()
+        try:
+            log_size = os.path.getsize(self._log_path)
+        except OSError:
+            log_size = 0
+
+        if not self._count or self.indexed_end > log_size:
+            return False
+
+        return allow_unindexed_tail or self.indexed_end == log_size
+
+    def update(self):
+        '''
+        Open the index, indexing the log entries not indexed yet.
+
+        If the index is not consistent with the log (for instance, because the log
+        was replaced), it's rebuilt from scratch.
+
+        Return value:
+            The number of entries added to the index.
+        '''
+        with lock.FileLock(self._index_path + '.lock'):
+            self._load()
+
+            try:
+                log_size = os.path.getsize(self._log_path)
+            except OSError:
+                log_size = 0
+
+            if self.indexed_end > log_size:
+                self.close()
+                os.unlink(self._index_path)
+
+            if self._count:
+                last = self[-1]
+                start = self.indexed_end
+                tweet_id = last.tweet_id
+                time = last.time
+            else:
+                start = 0
+                tweet_id = 0
+                time = 0.0
+
+            if start == log_size:
+                return 0
+
+            added = 0
+            with open(self._log_path, 'rb') as log_file, \
+                 open(self._index_path, 'r+b' if self._count else 'wb') as index_file:
+                if self._count:
+                    # Get rid of any partially written record.
+                    index_file.truncate(len(self._MAGIC) + self._count * self._RECORD.size)
+                    index_file.seek(0, os.SEEK_END)
+                else:
+                    index_file.write(self._MAGIC)
+
+                for record in _make_records(read_entries(log_file, start), tweet_id, time):
+                    index_file.write(self._RECORD.pack(*record))
+                    added += 1
+
+            self._load()
+            return added
+
+
+class MemoryIndex(list):
+    '''
+    An index, like `LogIndex`, but kept only in memory.
+    '''
+
+    def __init__(self, log_file):
+        '''
+        Initialize a `MemoryIndex` instance.
+
+        log_file:
+            The log file to index, opened in binary mode.
+        '''
+        super().__init__(_make_records(read_entries(log_file)))
+
+        self.tweet_ids = _FieldView(self, 'tweet_id')
+        self.times = _FieldView(self, 'time')
+
+    def close(self):
+        pass
+
+
+class _FieldView:
+    '''
+    A read-only sequence view on one of the fields of the records of a `LogIndex` or
+    `MemoryIndex`.
+    '''
+
+    def __init__(self, index, field_name):
+        self._index = index
+        self._field_index = IndexRecord._fields.index(field_name)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, position):
+        return self._index[position][self._field_index]
+
+    def bisect_left(self, value):
+        '''
+        Find the position of the first record with a field not less than `value`.
+        '''
+        return bisect.bisect_left(self, value)
@@ -1,4 +1,9 @@
-import json
+import io
+import mmap
+
+import logindex
+import logstore
+
 
 class Parser:
     '''
@@ -9,18 +14,28 @@ class Parser:
     don't want to have to delete to reparse it every time to correctly log.
 
     This object also allow to select which type of objects to retrive. For instance,
-    you can only get retweets.
+    you can only get retweets or only the tweets which were skipped because
+    offensive.
+
+    If possible, a sidecar index (see `logindex.LogIndex`) is used, so it's possible
+    to efficiently iterate the log backwards, find tweets by ID or time, and skip
+    the entries of the wrong type without decoding them.
+
+    If there are entries in the compact format (see `logstore`), they are returned
+    after the ones in the (legacy) log file, so the two look like a single log.
     '''
 
-    def __init__(self, log_file_path, tweets=None, retweets=None, following=None):
+    #pylint: disable=too-many-arguments
+    def __init__(self, log_file_path, tweets=None, retweets=None, following=None,
+                 skipped=None, use_index=True):
         '''
         Initialize a Parser instance.
 
-        If `tweets`, `retweets` and `following` are ALL unset, then all the elements are
-        returned.
+        If `tweets`, `retweets`, `following` and `skipped` are ALL unset, then all the
+        elements are returned.
 
-        If any of `tweets`, `retweets` or `following` are set, then only tweets matching
-        the specified types are returned.
+        If any of `tweets`, `retweets`, `following` or `skipped` are set, then only
+        tweets matching the specified types are returned.
 
         This mean the you can just do `for item in Parser(path)` to iterate everything
         or specify only a subset of types, like in `for item in Parser(path, tweets=True)`.
@@ -33,67 +48,228 @@ class Parser:
             Whether to return retweets.
         following:
             Whether to return new followed accounts.
+        skipped:
+            Whether to return tweets which were not translated because offensive.
+        use_index:
+            Whether to use (and, if needed, update) the index for the log.
         '''
 
-        if tweets is None and retweets is None and following is None:
+        if tweets is None and retweets is None and following is None and skipped is None:
             tweets = True
             retweets = True
             following = True
+            skipped = True
         else:
             tweets = False if tweets is None else tweets
             retweets = False if retweets is None else retweets
             following = False if following is None else following
+            skipped = False if skipped is None else skipped
 
         self._tweets = bool(tweets)
         self._retweets = bool(retweets)
         self._following = bool(following)
+        self._skipped = bool(skipped)
+
+        self._log_file_path = log_file_path
+        try:
+            self._log_file = open(log_file_path, 'rb')
+        except IOError:
+            if not logstore.has_segments(log_file_path):
+                raise
+            # Only the compact format was ever used, so there's no legacy log.
+            self._log_file = None
 
-        self._log_file = open(log_file_path)
+        self._index = None
+        self._log_map = None
+        if use_index and self._log_file is not None:
+            self._open_index(log_file_path)
 
     def __del__(self):
-        self._log_file.close()
-
-    @staticmethod
-    def _get_object_type(json_object):
-        if 'skipped-because-retweet' in json_object:
-            return 'retweet'
-        elif 'following-id' in json_object:
-            return 'following'
-        elif 'translated-text' in json_object:
-            return 'tweet'
-        else:
-            raise ValueError('Invalid object: {}'.format(json_object))
+        if self._log_map is not None:
+            self._log_map.close()
+        if self._index is not None:
+            self._index.close()
+        if self._log_file is not None:
+            self._log_file.close()
 
-    def _should_skip(self, json_object):
+    def _open_index(self, log_file_path):
+        index = logindex.LogIndex(log_file_path)
+        try:
+            index.update()
+            updated = True
+        except (IOError, OSError):
+            # For instance, we don't have write access to the directory.
+            updated = False
+
+        if not index.open(allow_unindexed_tail=updated):
+            index.close()
+            return
+
+        self._index = index
+        self._log_map = mmap.mmap(self._log_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _get_index(self):
+        if self._index is None:
+            # No usable index on disk, so we need to go through the whole log once.
+            self._index = logindex.MemoryIndex(self._log_file or io.BytesIO())
+            if self._index:
+                self._log_map = mmap.mmap(self._log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._index
+
+    def _wanted_types(self):
         conditions = {
-            'tweet': self._tweets,
-            'retweet': self._retweets,
-            'following': self._following,
+            logindex.TYPE_TWEET: self._tweets,
+            logindex.TYPE_RETWEET: self._retweets,
+            logindex.TYPE_FOLLOWING: self._following,
+            logindex.TYPE_SKIPPED: self._skipped,
             }
-        return not conditions[self._get_object_type(json_object)]
+        return frozenset(object_type for object_type, wanted in conditions.items() if wanted)
 
-    def __iter__(self):
-        iterator = iter(self._log_file)
+    def _should_skip_type(self, object_type):
+        return object_type not in self._wanted_types()
 
-        for line_ext in iterator:
-            line_ext = line_ext.rstrip()
-            assert line_ext == '{'
-            content_list = [line_ext]
+    def _decode_record(self, record):
+        return logindex.decode_entry(self._log_map[record.offset:record.offset + record.length])
 
-            for line_int in iterator:
-                line_int = line_int.rstrip()
-                content_list.append(line_int)
-                if line_int == '}':
-                    break
+    def _iter_records(self, positions):
+        index = self._get_index()
+        wanted_types = self._wanted_types()
+        for position in positions:
+            record = index[position]
+            if record.type not in wanted_types:
+                continue
+            yield self._decode_record(record)
 
-            content = '\n'.join(content_list)
-            json_object = json.loads(content)
+    def _iter_segment_records(self, tweet_id=0, time=0.0, reverse=False):
+        if not logstore.has_segments(self._log_file_path):
+            return
 
-            if self._should_skip(json_object):
-                continue
+        wanted_types = self._wanted_types()
+        for records in logstore.iter_segments(self._log_file_path, tweet_id, time, reverse):
+            if reverse:
+                records = reversed(records)
+            for record in records:
+                if record.type in wanted_types:
+                    yield record
+
+    def _get_legacy_tail(self):
+        # The ID and time to use for entries without them at the start of the segments.
+        index = self._get_index()
+        if not index:
+            return 0, 0.0
+        last = index[-1]
+        return last.tweet_id, last.time
+
+    def __iter__(self):
+        # This is a generator (rather than just returning an iterator) so `self`, and
+        # then the file, is kept alive while iterating.
+        if self._index is not None:
+            legacy_objects = self._iter_records(range(len(self._index)))
+        elif self._log_file is not None:
+            # Not building an index avoids keeping it all in memory if it's not needed.
+            legacy_objects = logindex.decode_entries(self._log_file, self._wanted_types())
+        else:
+            legacy_objects = []
 
+        for json_object in legacy_objects:
             yield json_object
 
+        for record in self._iter_segment_records():
+            yield logstore.decode_record(record)
+
     def __reversed__(self):
-        # This is fast enough.
-        return reversed(list(self))
+        for record in self._iter_segment_records(reverse=True):
+            yield logstore.decode_record(record)
+
+        for json_object in self._iter_records(range(len(self._get_index()) - 1, -1, -1)):
+            yield json_object
+
+    def find_id(self, tweet_id):
+        '''
+        Find the entry for the original tweet with ID `tweet_id`.
+
+        tweet_id:
+            The ID of the original tweet.
+        Return value:
+            The log entry or `None` if not found (or if of a type which was not
+            selected).
+        '''
+        tweet_id = int(tweet_id)
+        index = self._get_index()
+
+        position = index.tweet_ids.bisect_left(tweet_id)
+        while position < len(index):
+            record = index[position]
+            if record.tweet_id != tweet_id:
+                break
+            if record.type != logindex.TYPE_FOLLOWING and not self._should_skip_type(record.type):
+                return self._decode_record(record)
+            position += 1
+
+        if position < len(index):
+            # The following entries are all for newer tweets.
+            return None
+
+        for record in self._iter_segment_records():
+            if record.tweet_id > tweet_id:
+                break
+            if record.tweet_id == tweet_id and record.type != logindex.TYPE_FOLLOWING:
+                return logstore.decode_record(record)
+
+        return None
+
+    def iter_since_id(self, tweet_id):
+        '''
+        Iterate the entries starting from the one for the original tweet with ID
+        `tweet_id` (or the first following one if there's no such tweet).
+
+        tweet_id:
+            The ID of the original tweet.
+        Return value:
+            An iterator over log entries.
+        '''
+        tweet_id = int(tweet_id)
+        index = self._get_index()
+        start = index.tweet_ids.bisect_left(tweet_id)
+        for json_object in self._iter_records(range(start, len(index))):
+            yield json_object
+
+        last_tweet_id, last_time = self._get_legacy_tail()
+        for record in self._iter_segment_records(last_tweet_id, last_time):
+            if record.tweet_id >= tweet_id:
+                yield logstore.decode_record(record)
+
+    def iter_time_range(self, start_time, end_time):
+        '''
+        Iterate the entries for original tweets created between `start_time` and
+        `end_time`.
+
+        Entries without a time (i.e. following entries) are considered to have the
+        same time as the entry before them.
+
+        start_time:
+            A UTC `datetime.datetime` for the start of the range (included).
+        end_time:
+            A UTC `datetime.datetime` for the end of the range (excluded).
+        Return value:
+            An iterator over log entries.
+        '''
+        start_timestamp = logindex.timestamp_from_datetime(start_time)
+        end_timestamp = logindex.timestamp_from_datetime(end_time)
+
+        index = self._get_index()
+        start = index.times.bisect_left(start_timestamp)
+        end = index.times.bisect_left(end_timestamp)
+        for json_object in self._iter_records(range(start, end)):
+            yield json_object
+
+        if end < len(index):
+            # The following entries are all for newer tweets.
+            return
+
+        last_tweet_id, last_time = self._get_legacy_tail()
+        for record in self._iter_segment_records(last_tweet_id, last_time):
+            if record.time >= end_timestamp:
+                break
+            if record.time >= start_timestamp:
+                yield logstore.decode_record(record)
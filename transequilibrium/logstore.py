@@ -0,0 +1,324 @@
+import collections
+import datetime
+import gzip
+import json
+import os
+import re
+
+import logindex
+import pathutils
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None # pylint: disable=invalid-name
+
+
+COMPRESSIONS = ('none', 'gzip', 'zstd')
+ROTATIONS = ('size', 'daily')
+
+_EXTENSIONS = {
+    'none': '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+    }
+
+# Quotes in strings are escaped, so these can only match keys.
+_FOLLOWING_START = b'{"following-id":'
+_RETWEET_KEY = b'"skipped-because-retweet":'
+_SKIPPED_KEY = b'"skipped-because-offensive":'
+_TWEET_KEY = b'"translated-text":'
+
+_ID_RE = re.compile(br'"original-id":(\d+)')
+_TIME_RE = re.compile(br'"original-time":"([^"]*)"')
+
+
+def get_store_dir(log_path):
+    '''
+    Get the directory where the compact segments for the log at `log_path` are
+    stored.
+    '''
+    return log_path + '.d'
+
+
+def check_compression(compression):
+    '''
+    Check whether `compression` is supported.
+
+    Return value:
+        An error message or `None` if the compression is supported.
+    '''
+    if compression not in COMPRESSIONS:
+        return 'Invalid compression: {}.'.format(compression)
+    if compression == 'zstd' and zstandard is None:
+        return 'The "zstandard" module is needed for zstd compression.'
+    return None
+
+
+def serialize_compact(log_entry):
+    '''
+    Convert a log entry, as produced by `twitter.Client`, to the compact format
+    (i.e. a single line of JSON).
+    '''
+    json_object = json.loads(log_entry, object_pairs_hook=collections.OrderedDict)
+    return json.dumps(json_object, separators=(',', ':')) + '\n'
+
+
+class _Manifest:
+    '''
+    The list of segments in a store, saved as a JSON file.
+    '''
+
+    BASENAME = 'manifest.json'
+
+    def __init__(self, store_dir):
+        self._path = os.path.join(store_dir, self.BASENAME)
+
+        try:
+            with open(self._path) as manifest_file:
+                self.segments = json.load(manifest_file,
+                                          object_pairs_hook=collections.OrderedDict)['segments']
+        except IOError:
+            self.segments = []
+
+    def save(self):
+        # Write to a temporary file and rename it, so the manifest is never corrupted.
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump({'segments': self.segments}, manifest_file, indent=4)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(tmp_path, self._path)
+
+
+class CompactLogWriter:
+    '''
+    Write log entries as a sequence of segments, each containing one JSON object per
+    line.
+
+    When a segment gets too big (or at the start of a new day), it's closed and,
+    optionally, compressed and a new one is started.
+    '''
+
+    def __init__(self, log_path, max_segment_bytes=16 * 1024 * 1024, rotation='size',
+                 compression='none'):
+        '''
+        Initialize a `CompactLogWriter` instance.
+
+        log_path:
+            The path of the (legacy) main log. The segments are stored in a directory
+            next to it.
+        max_segment_bytes:
+            The size after which a segment is closed.
+        rotation:
+            Either 'size' (segments are closed only when too big) or 'daily' (segments
+            are closed also when a new day starts, in UTC).
+        compression:
+            How to compress closed segments, one of `COMPRESSIONS`.
+        '''
+        assert rotation in ROTATIONS
+        assert check_compression(compression) is None
+
+        self._store_dir = get_store_dir(log_path)
+        self._max_segment_bytes = max_segment_bytes
+        self._rotation = rotation
+        self._compression = compression
+
+        pathutils.makedirs(self._store_dir)
+        self._manifest = _Manifest(self._store_dir)
+
+        current = self._get_current_segment()
+        if current is not None:
+            self._repair_segment(current)
+
+    @staticmethod
+    def _today():
+        return datetime.datetime.utcnow().strftime('%Y-%m-%d')
+
+    def _segment_path(self, segment):
+        return os.path.join(self._store_dir, segment['name'])
+
+    def _get_current_segment(self):
+        if self._manifest.segments and not self._manifest.segments[-1]['closed']:
+            return self._manifest.segments[-1]
+        return None
+
+    def _repair_segment(self, segment):
+        # If we crashed while writing, the last line could be incomplete.
+        path = self._segment_path(segment)
+        try:
+            with open(path, 'r+b') as segment_file:
+                content = segment_file.read()
+                if content and not content.endswith(b'\n'):
+                    segment_file.truncate(content.rfind(b'\n') + 1)
+        except IOError:
+            pass
+
+    def _start_segment(self):
+        number = len(self._manifest.segments) + 1
+        segment = collections.OrderedDict([
+            ('name', 'segment-{:06d}.jsonl'.format(number)),
+            ('date', self._today()),
+            ('closed', False),
+            ])
+        self._manifest.segments.append(segment)
+        self._manifest.save()
+        return segment
+
+    def _close_segment(self, segment):
+        path = self._segment_path(segment)
+
+        if self._compression != 'none':
+            with open(path, 'rb') as segment_file:
+                content = segment_file.read()
+
+            compressed_name = segment['name'] + _EXTENSIONS[self._compression]
+            compressed_path = os.path.join(self._store_dir, compressed_name)
+            if self._compression == 'gzip':
+                with gzip.open(compressed_path, 'wb') as compressed_file:
+                    compressed_file.write(content)
+            else:
+                with open(compressed_path, 'wb') as compressed_file:
+                    compressed_file.write(zstandard.ZstdCompressor().compress(content))
+
+            segment['name'] = compressed_name
+
+        segment['closed'] = True
+        self._manifest.save()
+
+        if self._compression != 'none':
+            os.unlink(path)
+
+    def _needs_rotation(self, segment):
+        try:
+            size = os.path.getsize(self._segment_path(segment))
+        except OSError:
+            size = 0
+
+        if size >= self._max_segment_bytes:
+            return True
+
+        return self._rotation == 'daily' and segment['date'] != self._today()
+
+    def append(self, log_entry):
+        '''
+        Append an entry to the log.
+
+        log_entry:
+            The entry, serialized as JSON (in any format).
+        '''
+        self.append_many([log_entry])
+
+    def append_many(self, log_entries):
+        '''
+        Append multiple entries to the log.
+
+        The entries are all written to the same segment, so a segment can grow
+        bigger than the maximum size by up to a batch of entries.
+
+        log_entries:
+            A list of entries, serialized as JSON (in any format).
+        '''
+        segment = self._get_current_segment()
+        if segment is not None and self._needs_rotation(segment):
+            self._close_segment(segment)
+            segment = None
+        if segment is None:
+            segment = self._start_segment()
+
+        content = ''.join(serialize_compact(log_entry) for log_entry in log_entries)
+        with open(self._segment_path(segment), 'ab') as segment_file:
+            segment_file.write(content.encode('utf-8'))
+
+
+def _read_segment(path):
+    if path.endswith(_EXTENSIONS['gzip']):
+        with gzip.open(path, 'rb') as segment_file:
+            return segment_file.read()
+    elif path.endswith(_EXTENSIONS['zstd']):
+        if zstandard is None:
+            raise IOError('The "zstandard" module is needed to read "{}".'.format(path))
+        with open(path, 'rb') as segment_file:
+            return zstandard.ZstdDecompressor().decompress(segment_file.read())
+    else:
+        with open(path, 'rb') as segment_file:
+            return segment_file.read()
+
+
+def _get_line_type(line):
+    if line.startswith(_FOLLOWING_START):
+        return logindex.TYPE_FOLLOWING
+    elif _RETWEET_KEY in line:
+        return logindex.TYPE_RETWEET
+    elif _SKIPPED_KEY in line:
+        return logindex.TYPE_SKIPPED
+    elif _TWEET_KEY in line:
+        return logindex.TYPE_TWEET
+    else:
+        raise ValueError('Invalid object: {}'.format(line))
+
+
+# Like `logindex.IndexRecord`, but with the undecoded content of the entry instead of
+# its position.
+SegmentRecord = collections.namedtuple('SegmentRecord', ['type', 'tweet_id', 'time', 'content'])
+
+
+def has_segments(log_path):
+    '''
+    Whether there's a compact store for the log at `log_path`.
+    '''
+    return os.path.exists(os.path.join(get_store_dir(log_path), _Manifest.BASENAME))
+
+
+def iter_segments(log_path, tweet_id=0, time=0.0, reverse=False):
+    '''
+    Iterate the records in all the segments for the log at `log_path`.
+
+    log_path:
+        The path of the (legacy) main log.
+    tweet_id:
+        The tweet ID to use for entries without one if they are at the start.
+    time:
+        Like `tweet_id`, but for the time.
+    reverse:
+        Whether to iterate from the newest segment rather than from the oldest.
+        In this case `tweet_id` and `time` are used at the start of each segment.
+    Return value:
+        An iterator over lists of `SegmentRecord` instances (sorted from the oldest
+        to the newest), one list for each segment.
+    '''
+    store_dir = get_store_dir(log_path)
+    segments = _Manifest(store_dir).segments
+    if reverse:
+        segments = reversed(segments)
+        initial_tweet_id = tweet_id
+        initial_time = time
+
+    for segment in segments:
+        if reverse:
+            tweet_id = initial_tweet_id
+            time = initial_time
+
+        content = _read_segment(os.path.join(store_dir, segment['name']))
+
+        lines = content.split(b'\n')
+        # The last line is either empty or was truncated (for instance, because the
+        # application crashed while writing it).
+        lines.pop()
+
+        records = []
+        for line in lines:
+            object_type = _get_line_type(line)
+            if object_type != logindex.TYPE_FOLLOWING:
+                tweet_id = int(_ID_RE.search(line).group(1))
+                time = logindex.timestamp_from_iso(_TIME_RE.search(line).group(1).decode('utf-8'))
+            records.append(SegmentRecord(object_type, tweet_id, time, line))
+
+        yield records
+
+
+def decode_record(record):
+    '''
+    Decode the content of a `SegmentRecord`.
+    '''
+    return json.loads(record.content.decode('utf-8'))
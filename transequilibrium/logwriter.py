@@ -0,0 +1,228 @@
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+
+POLICIES = ('always', 'interval', 'shutdown')
+
+STATS_BASENAME = 'log-writer-stats.json'
+
+
+class BufferedLogWriter:
+    '''
+    Buffer log entries in memory and write them in batches.
+
+    The entries are written, in the same order they were added, by a function passed
+    to the initializer. When they are written depends on the policy:
+    - 'always': each entry is written before `append` returns.
+    - 'interval': entries are written by a background thread every `interval`
+      seconds.
+    - 'shutdown': entries are written only when the writer is closed (or if too many
+      are pending).
+
+    Some statistics (like the number of pending entries and how long writing them
+    took) can be saved to a file, so they can be checked by other processes (see
+    `main`).
+    '''
+
+    #pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, write_entries, policy='always', interval=0.5, max_pending=1000,
+                 stats_path=None):
+        '''
+        Initialize a `BufferedLogWriter` instance.
+
+        write_entries:
+            A function which writes a list of entries. An entry is the tuple of the
+            arguments passed to `append`.
+        policy:
+            When to write the entries, see the class documentation.
+        interval:
+            How many seconds to wait between writes for the 'interval' policy. This is
+            also how often the statistics are saved.
+        max_pending:
+            How many entries can be pending before they are written anyway, whatever
+            the policy.
+        stats_path:
+            Where to save the statistics or `None` to not save them.
+        '''
+        assert policy in POLICIES
+        assert interval > 0
+        assert max_pending > 0
+
+        self._write_entries = write_entries
+        self._policy = policy
+        self._interval = interval
+        self._max_pending = max_pending
+        self._stats_path = stats_path
+
+        # `_lock` protects the pending entries and the counters, `_write_lock` makes
+        # sure only one batch at a time is written, so the order is preserved.
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pending = []
+        self._oldest_pending_time = None
+
+        self.written = 0
+        self.flushes = 0
+        self.errors = 0
+        self.last_flush_duration = 0.0
+        self.max_flush_duration = 0.0
+        self.max_entry_age = 0.0
+
+        self._last_stats_save = 0.0
+
+        self._closed = threading.Event()
+        self._thread = None
+        if policy != 'always':
+            self._thread = threading.Thread(target=self._thread_main,
+                                            name='log-writer')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def append(self, *entry):
+        '''
+        Add an entry to be written.
+
+        entry:
+            The arguments to pass, in a tuple, to the `write_entries` function.
+        '''
+        assert not self._closed.is_set()
+
+        with self._lock:
+            if not self._pending:
+                self._oldest_pending_time = time.monotonic()
+            self._pending.append(entry)
+            must_flush = self._policy == 'always' or len(self._pending) >= self._max_pending
+
+        if must_flush:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write all the pending entries.
+
+        If writing fails, the entries are kept and the exception is propagated.
+        '''
+        with self._write_lock:
+            with self._lock:
+                entries = self._pending
+                oldest_pending_time = self._oldest_pending_time
+                self._pending = []
+                self._oldest_pending_time = None
+
+            if not entries:
+                return
+
+            start = time.monotonic()
+            try:
+                self._write_entries(entries)
+            except BaseException:
+                with self._lock:
+                    # Put the entries back, so we can try again later.
+                    self._pending[:0] = entries
+                    self._oldest_pending_time = oldest_pending_time
+                    self.errors += 1
+                raise
+            end = time.monotonic()
+
+            with self._lock:
+                self.written += len(entries)
+                self.flushes += 1
+                self.last_flush_duration = end - start
+                self.max_flush_duration = max(self.max_flush_duration, end - start)
+                self.max_entry_age = max(self.max_entry_age, end - oldest_pending_time)
+
+        # Without a background thread, the statistics are saved here, but not too often.
+        if self._policy == 'always' and end - self._last_stats_save >= self._interval:
+            self._save_stats()
+
+    def stats(self):
+        '''
+        Get the writer statistics.
+
+        Return value:
+            A dictionary with the number of pending entries, of written entries, of
+            writes and of failed writes, and the durations (in milliseconds) of the
+            last and of the slowest writes and the longest time an entry waited
+            before being written.
+        '''
+        with self._lock:
+            return collections.OrderedDict([
+                ('policy', self._policy),
+                ('pending', len(self._pending)),
+                ('written', self.written),
+                ('flushes', self.flushes),
+                ('errors', self.errors),
+                ('last-flush-ms', round(self.last_flush_duration * 1000, 3)),
+                ('max-flush-ms', round(self.max_flush_duration * 1000, 3)),
+                ('max-entry-age-ms', round(self.max_entry_age * 1000, 3)),
+                ])
+
+    def _save_stats(self):
+        if self._stats_path is None:
+            return
+
+        self._last_stats_save = time.monotonic()
+        stats = self.stats()
+        stats['time'] = time.time()
+
+        tmp_path = self._stats_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as stats_file:
+                json.dump(stats, stats_file, indent=4)
+            os.replace(tmp_path, self._stats_path)
+        except (IOError, OSError) as exc:
+            print('WARNING: Failed to save the log writer statistics: {}'.format(exc),
+                  file=sys.stderr)
+
+    def _thread_main(self):
+        while not self._closed.wait(self._interval):
+            if self._policy == 'interval':
+                try:
+                    self.flush()
+                except Exception as exc:
+                    # The entries are kept, so we can just try again later.
+                    print('WARNING: Failed to write log entries: {}'.format(exc),
+                          file=sys.stderr)
+            self._save_stats()
+
+    def close(self):
+        '''
+        Stop the background thread (if any) and write all the pending entries.
+        '''
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        try:
+            self.flush()
+        finally:
+            self._save_stats()
+
+
+def main():
+    if len(sys.argv) != 2:
+        print('{} STATE-DIR'.format(sys.argv[0]), file=sys.stderr)
+        raise SystemExit(1)
+
+    stats_path = os.path.join(os.path.expanduser(sys.argv[1]), STATS_BASENAME)
+    try:
+        with open(stats_path) as stats_file:
+            stats = json.load(stats_file, object_pairs_hook=collections.OrderedDict)
+    except IOError:
+        print('No statistics in "{}".'.format(stats_path), file=sys.stderr)
+        raise SystemExit(1)
+
+    saved_time = stats.pop('time', None)
+    for key, value in stats.items():
+        print('{:20} {}'.format(key, value))
+    if saved_time is not None:
+        print('{:20} {:.1f}s ago'.format('saved', time.time() - saved_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,406 @@
+import bisect
+import collections
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+import translatorwrapper
+
+
+PROMETHEUS_BASENAME = 'metrics.prom'
+JSON_BASENAME = 'metrics.json'
+
+# The default histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels_key, extra=()):
+    pairs = list(labels_key) + list(extra)
+    if not pairs:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{{{}}}'.format(','.join('{}="{}"'.format(name, escape(value))
+                                    for name, value in pairs))
+
+
+def _format_number(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class _Metric:
+    '''
+    Base class for metrics.
+
+    A metric has a value for each combination of labels (passed as keyword arguments
+    when updating it).
+    '''
+
+    type_name = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+
+        self._lock = threading.Lock()
+        # Maps the labels (as returned by `_labels_key`) to values.
+        self._values = collections.OrderedDict()
+
+    def _get_values(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def _format_value(self, labels_key, value):
+        return ['{}{} {}'.format(self.name, _format_labels(labels_key), _format_number(value))]
+
+    def _snapshot_value(self, value):
+        #pylint: disable=no-self-use
+        return value
+
+    def to_prometheus(self):
+        '''
+        Get the metric in the Prometheus text format.
+
+        Return value:
+            A list of lines.
+        '''
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help_text),
+            '# TYPE {} {}'.format(self.name, self.type_name),
+            ]
+        for labels_key, value in self._get_values():
+            lines.extend(self._format_value(labels_key, value))
+        return lines
+
+    def snapshot(self):
+        '''
+        Get the metric as a JSON-serializable dictionary.
+        '''
+        return collections.OrderedDict([
+            ('type', self.type_name),
+            ('help', self.help_text),
+            ('values', [collections.OrderedDict([('labels', dict(labels_key)),
+                                                 ('value', self._snapshot_value(value))])
+                        for labels_key, value in self._get_values()]),
+            ])
+
+
+class Counter(_Metric):
+    '''
+    A value which can only go up, like the number of requests.
+    '''
+
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        '''
+        Increase the counter for `labels` by `amount`.
+        '''
+        key = _labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(_labels_key(labels), 0)
+
+
+class Gauge(_Metric):
+    '''
+    A value which can go up and down, like the number of pending tweets.
+    '''
+
+    type_name = 'gauge'
+
+    def set(self, value, **labels):
+        '''
+        Set the gauge for `labels` to `value`.
+        '''
+        with self._lock:
+            self._values[_labels_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        '''
+        Increase (or, if `amount` is negative, decrease) the gauge for `labels`.
+        '''
+        key = _labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(_labels_key(labels), 0)
+
+
+class _Timer:
+    # The context manager returned by `Histogram.time`.
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._histogram.observe(time.monotonic() - self._start, **self._labels)
+
+
+class Histogram(_Metric):
+    '''
+    The distribution of some values, like the latency of requests, counted in
+    buckets.
+    '''
+
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self._buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        '''
+        Record `value` for `labels`.
+        '''
+        key = _labels_key(labels)
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # The non-cumulative count for each bucket, the sum and the count.
+                state = [[0] * len(self._buckets), 0.0, 0]
+                self._values[key] = state
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        '''
+        Get a context manager which records how many seconds its block took.
+        '''
+        return _Timer(self, labels)
+
+    def _get_values(self):
+        with self._lock:
+            return [(key, (list(counts), total, count))
+                    for key, (counts, total, count) in self._values.items()]
+
+    def _cumulative(self, counts):
+        cumulative = 0
+        for bound, bucket_count in zip(self._buckets, counts):
+            cumulative += bucket_count
+            yield bound, cumulative
+
+    def _format_value(self, labels_key, value):
+        counts, total, count = value
+        lines = []
+        for bound, cumulative in self._cumulative(counts):
+            bucket_labels = _format_labels(labels_key, [('le', _format_number(bound))])
+            lines.append('{}_bucket{} {}'.format(self.name, bucket_labels, cumulative))
+        lines.append('{}_sum{} {}'.format(self.name, _format_labels(labels_key),
+                                          _format_number(round(total, 6))))
+        lines.append('{}_count{} {}'.format(self.name, _format_labels(labels_key), count))
+        return lines
+
+    def _snapshot_value(self, value):
+        counts, total, count = value
+        return collections.OrderedDict([
+            ('count', count),
+            ('sum', round(total, 6)),
+            ('buckets', collections.OrderedDict(
+                (_format_number(bound), cumulative)
+                for bound, cumulative in self._cumulative(counts))),
+            ])
+
+
+class Registry:
+    '''
+    A collection of metrics, which can be exported together.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = collections.OrderedDict()
+
+    def _get_or_create(self, metric_class, name, help_text, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, help_text, **kwargs)
+                self._metrics[name] = metric
+            assert isinstance(metric, metric_class)
+            return metric
+
+    def counter(self, name, help_text):
+        '''
+        Get the `Counter` called `name`, creating it if needed.
+        '''
+        return self._get_or_create(Counter, name, help_text)
+
+    def gauge(self, name, help_text):
+        '''
+        Get the `Gauge` called `name`, creating it if needed.
+        '''
+        return self._get_or_create(Gauge, name, help_text)
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        '''
+        Get the `Histogram` called `name`, creating it if needed.
+        '''
+        return self._get_or_create(Histogram, name, help_text, buckets=buckets)
+
+    def _get_metrics(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def to_prometheus(self):
+        '''
+        Get all the metrics in the Prometheus text format.
+        '''
+        lines = []
+        for metric in self._get_metrics():
+            lines.extend(metric.to_prometheus())
+        return ''.join(line + '\n' for line in lines)
+
+    def snapshot(self):
+        '''
+        Get all the metrics as a JSON-serializable dictionary.
+        '''
+        return collections.OrderedDict([
+            ('time', time.time()),
+            ('metrics', collections.OrderedDict(
+                (metric.name, metric.snapshot()) for metric in self._get_metrics())),
+            ])
+
+
+# The registry used by the whole application.
+REGISTRY = Registry()
+
+
+def _write_atomically(path, content):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as output_file:
+        output_file.write(content)
+    os.replace(tmp_path, path)
+
+
+class Exporter:
+    '''
+    Periodically write the metrics to files, both in the Prometheus text format (for
+    instance, for the textfile collector of the node exporter) and as JSON.
+    '''
+
+    def __init__(self, prometheus_path, json_path, interval=60, registry=REGISTRY):
+        '''
+        Initialize an `Exporter` instance.
+
+        prometheus_path:
+            Where to write the metrics in the Prometheus format or `None` to not write
+            them.
+        json_path:
+            Where to write the metrics as JSON or `None` to not write them.
+        interval:
+            How many seconds to wait between writes.
+        registry:
+            The `Registry` to export.
+        '''
+        assert interval > 0
+
+        self._prometheus_path = prometheus_path
+        self._json_path = json_path
+        self._interval = interval
+        self._registry = registry
+
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._thread_main, name='metrics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def export(self):
+        '''
+        Write the metrics now.
+        '''
+        try:
+            if self._prometheus_path is not None:
+                _write_atomically(self._prometheus_path, self._registry.to_prometheus())
+            if self._json_path is not None:
+                _write_atomically(self._json_path,
+                                  json.dumps(self._registry.snapshot(), indent=4) + '\n')
+        except (IOError, OSError) as exc:
+            print('WARNING: Failed to export the metrics: {}'.format(exc), file=sys.stderr)
+
+    def _thread_main(self):
+        while not self._closed.wait(self._interval):
+            self.export()
+
+    def close(self):
+        '''
+        Stop the background thread and write the metrics a last time.
+        '''
+        self._closed.set()
+        self._thread.join()
+        self.export()
+
+
+# Updated by the modules which call the Twitter API, labelled by API method.
+TWITTER_SECONDS = REGISTRY.histogram(
+    'transequilibrium_twitter_request_seconds',
+    'Time taken by the requests to the Twitter API.')
+
+# Updated by the translators which retry failed requests.
+TRANSLATOR_RETRIES = REGISTRY.counter(
+    'transequilibrium_translator_retries_total',
+    'Number of requests to the translation service which were retried.')
+
+_TRANSLATOR_REQUESTS = REGISTRY.counter(
+    'transequilibrium_translator_requests_total',
+    'Number of requests done to the translation service.')
+_TRANSLATOR_TEXTS = REGISTRY.counter(
+    'transequilibrium_translator_texts_total',
+    'Number of texts sent to the translation service.')
+_TRANSLATOR_CHARACTERS = REGISTRY.counter(
+    'transequilibrium_translator_characters_total',
+    'Number of characters sent to the translation service.')
+_TRANSLATOR_ERRORS = REGISTRY.counter(
+    'transequilibrium_translator_errors_total',
+    'Number of requests to the translation service which failed.')
+_TRANSLATOR_SECONDS = REGISTRY.histogram(
+    'transequilibrium_translator_request_seconds',
+    'Time taken by the requests to the translation service.')
+
+
+class MeteredTranslator(translatorwrapper.TranslatorWrapper):
+    '''
+    Wrap a translator and record metrics for each request done to it.
+
+    This should wrap the actual translation service (i.e. be inside any cache), so
+    the metrics match what the service sees.
+    '''
+
+    def _call(self, function, from_lang, to_lang, texts):
+        #pylint: disable=unused-argument
+        labels = {'translator': self._translator.name}
+        _TRANSLATOR_REQUESTS.inc(**labels)
+        _TRANSLATOR_TEXTS.inc(len(texts), **labels)
+        _TRANSLATOR_CHARACTERS.inc(sum(len(text) for text in texts), **labels)
+        try:
+            with _TRANSLATOR_SECONDS.time(**labels):
+                return function()
+        except Exception:
+            _TRANSLATOR_ERRORS.inc(**labels)
+            raise
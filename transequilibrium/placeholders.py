@@ -0,0 +1,313 @@
+import abc
+import collections
+import os
+import re
+import sys
+
+import escaping
+
+
+# An entity of a tweet (like a URL or a mention) which must not be translated.
+# `type` is one of "media", "url", "mention" and "hashtag".
+Entity = collections.namedtuple('Entity', ['type', 'value'])
+
+# A text where the entities were replaced by placeholders.
+# `entities` is the list of the replaced `Entity` instances and `scheme` is the
+# `Scheme` used (which may be different from the requested one, see `Scheme.encode`).
+Encoded = collections.namedtuple('Encoded', ['text', 'entities', 'scheme'])
+
+# A text where the placeholders were replaced back by the entities.
+# `missing` is the number of entities whose placeholder was not found (these are
+# appended at the end of the text) and `unknown` is the number of placeholders
+# which don't correspond to any entity (these are removed).
+Restored = collections.namedtuple('Restored', ['text', 'missing', 'unknown'])
+
+_ENTITY_FORMATS = {
+    'media': '{}',
+    'url': '{}',
+    'mention': '@{}',
+    'hashtag': '#{}',
+    }
+
+
+def _format_entity(entity):
+    return _ENTITY_FORMATS[entity.type].format(entity.value)
+
+
+class Scheme(abc.ABC):
+    '''
+    A way of replacing the entities of a tweet with placeholders which translators
+    leave alone.
+
+    Subclasses define how placeholders look like.
+    '''
+
+    name = None
+
+    # Matches a placeholder, possibly slightly changed by the translator.
+    _PATTERN = None
+
+    def __init__(self):
+        # Translators tend to eat or add spaces next to placeholders, so the spaces
+        # around them are replaced as well. Runs of spaces are matched too, so they
+        # are collapsed in the same pass.
+        self._restore_re = re.compile(' *(?:{}) *| {{2,}}'.format(self._PATTERN.pattern))
+
+    @abc.abstractmethod
+    def make_placeholder(self, index, entity):
+        '''
+        Get the placeholder for the `index`-th entity (from 0) of a text.
+        '''
+
+    @abc.abstractmethod
+    def _match_entity(self, match, entities, found):
+        '''
+        Find the entity for a placeholder.
+
+        match:
+            The match for `_PATTERN`.
+        entities:
+            The list of entities of the text.
+        found:
+            The set of the indexes of the entities already found in the text.
+        Return value:
+            An `(index, entity)` tuple. `index` is the position of the entity in
+            `entities` or `None` if not there. `entity` is `None` if the placeholder
+            doesn't correspond to an entity.
+        '''
+
+    def _is_dropped(self, match):
+        '''
+        Whether the placeholder should just be removed (for instance, because it's
+        a closing tag).
+        '''
+        #pylint: disable=unused-argument,no-self-use
+        return False
+
+    def encode(self, text, spans):
+        '''
+        Replace entities in `text` with placeholders.
+
+        If the text already contains something which looks like a placeholder, the
+        "tag" scheme (whose placeholders cannot be confused with normal text) is
+        used instead.
+
+        text:
+            The text, HTML-escaped as Twitter returns it.
+        spans:
+            A list of `((start, end), entity)` tuples, one for each `Entity` to
+            replace, sorted by position.
+        Return value:
+            An `Encoded` instance, whose text is not HTML-escaped anymore.
+        '''
+        if self is not TAG_SCHEME and self._PATTERN.search(escaping.html_unescape(text)):
+            return TAG_SCHEME.encode(text, spans)
+
+        entities = [entity for indices, entity in spans]
+
+        # Start from the end, as we are replacing text at a fixed position.
+        for index in reversed(range(len(spans))):
+            (start, end), entity = spans[index]
+            text = text[:start] + self.make_placeholder(index, entity) + text[end:]
+
+        # Twitter returns HTML-escaped strings, but expects unescaped strings.
+        # Probably this was done to avoid HTML injection.
+        text = escaping.html_unescape(text)
+
+        return Encoded(text.strip(), entities, self)
+
+    def restore(self, text, entities):
+        '''
+        Replace the placeholders in `text` with the entities they stand for.
+
+        text:
+            The (translated) text with placeholders.
+        entities:
+            The list of entities, as in `Encoded.entities`.
+        Return value:
+            A `Restored` instance.
+        '''
+        pieces = []
+        found = set()
+        unknown = 0
+
+        def add(piece):
+            # Avoid doubling the spaces around the replaced placeholders.
+            if pieces and pieces[-1].endswith(' ') and piece.startswith(' '):
+                piece = piece[1:]
+            if piece:
+                pieces.append(piece)
+
+        pos = 0
+        for match in self._restore_re.finditer(text):
+            add(text[pos:match.start()])
+            pos = match.end()
+
+            if match.group().strip(' ') == '' or self._is_dropped(match):
+                add(' ')
+                continue
+
+            index, entity = self._match_entity(match, entities, found)
+            if entity is None:
+                unknown += 1
+                add(' ')
+                continue
+
+            if index is not None:
+                found.add(index)
+            add(' {} '.format(_format_entity(entity)))
+        add(text[pos:])
+
+        missing = [entity for index, entity in enumerate(entities) if index not in found]
+        for entity in missing:
+            add(' {}'.format(_format_entity(entity)))
+
+        return Restored(''.join(pieces), len(missing), unknown)
+
+
+class TagScheme(Scheme):
+    '''
+    Placeholders which are XML tags containing the entity itself, like
+    `<transequilibrium:escaped type="url" value="https://t.co/..."></transequilibrium:escaped>`.
+
+    These are very long, but they can be restored even without knowing the original
+    entities and they cannot be confused with normal text.
+    '''
+
+    name = 'tag'
+
+    _PATTERN = re.compile(
+        '<transequilibrium:escaped type="([^"]+)" value="([^"]+)">|</transequilibrium:escaped>')
+
+    def make_placeholder(self, index, entity):
+        assert '"' not in entity.value
+        return ('<transequilibrium:escaped ' + \
+                'type="{type}" value="{value}">' + \
+                '</transequilibrium:escaped>').format(type=entity.type, value=entity.value)
+
+    def _is_dropped(self, match):
+        return match.group(1) is None
+
+    def _match_entity(self, match, entities, found):
+        entity = Entity(match.group(1), match.group(2))
+        if entity.type not in _ENTITY_FORMATS:
+            return None, None
+
+        indexes = [index for index, other in enumerate(entities) if other == entity]
+        for index in indexes:
+            if index not in found:
+                return index, entity
+        # Either a duplicated placeholder or not an entity of the text, but the tag
+        # has all the information we need anyway.
+        return (indexes[0] if indexes else None), entity
+
+
+class _NumberedScheme(Scheme):
+    # Placeholders containing just the (1-based) number of the entity.
+
+    _FORMAT = None
+
+    def make_placeholder(self, index, entity):
+        return self._FORMAT.format(index + 1)
+
+    def _match_entity(self, match, entities, found):
+        #pylint: disable=unused-argument
+        index = int(match.group(1)) - 1
+        if 0 <= index < len(entities):
+            return index, entities[index]
+        return None, None
+
+
+class CompactScheme(_NumberedScheme):
+    '''
+    Placeholders which are short XML tags, like `<x1/>`.
+
+    These are kept by translators which understand HTML (like Google's).
+    '''
+
+    name = 'compact'
+
+    _FORMAT = '<x{}/>'
+    _PATTERN = re.compile(r'<\s*x\s*(\d+)\s*/?\s*>')
+
+
+class BracketScheme(_NumberedScheme):
+    '''
+    Placeholders which are numbers in brackets, like `[1]`.
+
+    These are kept by translators which only handle plain text. Full-width brackets
+    (which translators may use for Japanese) are accepted as well.
+    '''
+
+    name = 'bracket'
+
+    _FORMAT = '[{}]'
+    _PATTERN = re.compile(r'[\[［]\s*(\d+)\s*[\]］]')
+
+
+TAG_SCHEME = TagScheme()
+
+_SCHEMES = collections.OrderedDict(
+    (scheme.name, scheme) for scheme in (TAG_SCHEME, CompactScheme(), BracketScheme()))
+
+SCHEMES = tuple(_SCHEMES)
+
+
+def get_scheme(name):
+    '''
+    Get the `Scheme` called `name` (one of `SCHEMES`).
+    '''
+    return _SCHEMES[name]
+
+
+def count_saved_chars(tweet_text, spans, encoded, translated_texts):
+    '''
+    Count how many characters were not sent to the translator thanks to using a more
+    compact scheme than the "tag" one.
+
+    tweet_text:
+        The text of the tweet, as passed to `Scheme.encode`.
+    spans:
+        The entities, as passed to `Scheme.encode`.
+    encoded:
+        The `Encoded` instance returned by `Scheme.encode`.
+    translated_texts:
+        The number of texts sent to the translator (i.e. the number of rounds).
+    Return value:
+        The number of characters saved in total.
+    '''
+    if encoded.scheme is TAG_SCHEME:
+        return 0
+    tag_encoded = TAG_SCHEME.encode(tweet_text, spans)
+    return (len(tag_encoded.text) - len(encoded.text)) * translated_texts
+
+
+def main():
+    import logparser
+
+    if len(sys.argv) != 2:
+        print('{} STATE-DIR'.format(sys.argv[0]), file=sys.stderr)
+        raise SystemExit(1)
+
+    log_path = os.path.join(os.path.expanduser(sys.argv[1]), 'log')
+
+    tweets = 0
+    saved = []
+    mangled = 0
+    for log_entry in logparser.Parser(log_path, tweets=True):
+        tweets += 1
+        if 'placeholder-chars-saved' in log_entry:
+            saved.append(log_entry['placeholder-chars-saved'])
+        if log_entry.get('placeholders-missing') or log_entry.get('placeholders-unknown'):
+            mangled += 1
+
+    print('{:34} {}'.format('tweets', tweets))
+    print('{:34} {}'.format('tweets with compact placeholders', len(saved)))
+    print('{:34} {}'.format('characters saved', sum(saved)))
+    if saved:
+        print('{:34} {:.1f}'.format('characters saved per tweet', sum(saved) / len(saved)))
+    print('{:34} {}'.format('tweets with mangled placeholders', mangled))
+
+
+if __name__ == '__main__':
+    main()
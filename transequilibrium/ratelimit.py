@@ -0,0 +1,234 @@
+import collections
+import json
+import os
+import threading
+import time
+
+import lock
+import metrics
+import tracing
+import translatorwrapper
+
+
+STATE_BASENAME = 'rate-limit.json'
+
+_WAIT_SECONDS = metrics.REGISTRY.histogram(
+    'transequilibrium_rate_limit_wait_seconds',
+    'Time requests to the translation service waited for the rate limiter.')
+_QUEUE_DEPTH = metrics.REGISTRY.gauge(
+    'transequilibrium_rate_limit_queue_depth',
+    'Number of requests in this process waiting for the rate limiter.')
+
+_local = threading.local()
+
+
+def set_wait_listener(listener):
+    '''
+    Set a function to call when a request on the current thread starts and stops
+    waiting for a rate limiter.
+
+    This lets callers which time requests (like `hedging.HedgingTranslator`) ignore
+    the time spent waiting.
+
+    listener:
+        A function getting `True` when the wait starts and `False` when it ends,
+        or `None`.
+    '''
+    _local.listener = listener
+
+
+class RateLimiter:
+    '''
+    Limit the rate of requests (and of characters sent) to a translation service,
+    across all the processes on the same host.
+
+    Each limit is a token bucket: tokens are added at a fixed rate, up to a maximum
+    (so short bursts are allowed), and each request takes some. The buckets are
+    kept in a state file, guarded by a lock file, so processes sharing the same API
+    key share the same buckets.
+
+    A request which finds not enough tokens doesn't poll: it takes the tokens
+    anyway (leaving the bucket in debt) and sleeps until they would have been
+    available. This means requests are served in order and the traffic is smoothed
+    instead of failing when the quota is exceeded.
+    '''
+
+    #pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, state_path, key, characters_per_second=0, requests_per_second=0,
+                 burst_seconds=1, lock_timeout=60):
+        '''
+        Initialize a `RateLimiter` instance.
+
+        state_path:
+            The path of the state file shared by the processes. The lock file is
+            next to it.
+        key:
+            The name of the buckets in the state file, usually the name of the
+            translator, so different services can share the same file.
+        characters_per_second:
+            The maximum number of characters to send per second or 0 for no limit.
+        requests_per_second:
+            The maximum number of requests per second or 0 for no limit.
+        burst_seconds:
+            How many seconds of unused tokens can be accumulated for bursts.
+        lock_timeout:
+            How many seconds to wait for the lock file before failing.
+        '''
+        assert characters_per_second >= 0
+        assert requests_per_second >= 0
+        assert characters_per_second or requests_per_second, 'No limit was set.'
+        assert burst_seconds > 0
+
+        self._state_path = state_path
+        self._key = key
+        self._rates = collections.OrderedDict([
+            ('characters', characters_per_second),
+            ('requests', requests_per_second),
+            ])
+        self._burst_seconds = burst_seconds
+        self._lock_timeout = lock_timeout
+
+        # `lock.FileLock` instances cannot be used by multiple threads at once.
+        self._thread_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+        self.requests = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+
+    @property
+    def key(self):
+        return self._key
+
+    def _read_state(self):
+        try:
+            with open(self._state_path) as state_file:
+                state = json.load(state_file)
+        except (IOError, OSError, ValueError):
+            # Missing or corrupted (which should not happen), start again.
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def _write_state(self, state):
+        tmp_path = self._state_path + '.tmp'
+        with open(tmp_path, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(tmp_path, self._state_path)
+
+    def _reserve(self, costs):
+        '''
+        Take tokens from the buckets.
+
+        costs:
+            A dictionary mapping bucket names to the tokens to take.
+        Return value:
+            How many seconds to wait before doing the request.
+        '''
+        with self._thread_lock, lock.FileLock(self._state_path + '.lock',
+                                              timeout=self._lock_timeout,
+                                              sleep_time=0.01):
+            now = time.time()
+            state = self._read_state()
+            buckets = state.setdefault(self._key, {})
+
+            wait = 0
+            for name, rate in self._rates.items():
+                if not rate:
+                    continue
+                capacity = rate * self._burst_seconds
+                bucket = buckets.get(name)
+                if not isinstance(bucket, dict):
+                    bucket = {'tokens': capacity, 'updated': now}
+                # If the clock went backwards, just don't add tokens.
+                elapsed = max(now - bucket['updated'], 0)
+                tokens = min(bucket['tokens'] + elapsed * rate, capacity) - costs[name]
+                buckets[name] = {'tokens': tokens, 'updated': now}
+                if tokens < 0:
+                    wait = max(wait, -tokens / rate)
+
+            self._write_state(state)
+
+        return wait
+
+    def acquire(self, characters):
+        '''
+        Wait until a request sending `characters` characters can be done.
+        '''
+        with self._stats_lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        _QUEUE_DEPTH.inc(key=self._key)
+
+        try:
+            wait = self._reserve({'characters': characters, 'requests': 1})
+            if wait > 0:
+                listener = getattr(_local, 'listener', None)
+                if listener is not None:
+                    listener(True)
+                try:
+                    with tracing.span('rate-limit-wait', key=self._key,
+                                      seconds=round(wait, 6)):
+                        time.sleep(wait)
+                finally:
+                    if listener is not None:
+                        listener(False)
+        finally:
+            _QUEUE_DEPTH.inc(-1, key=self._key)
+            with self._stats_lock:
+                self.queue_depth -= 1
+
+        _WAIT_SECONDS.observe(wait, key=self._key)
+        with self._stats_lock:
+            self.requests += 1
+            if wait > 0:
+                self.waited += 1
+                self.wait_seconds += wait
+                self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+    def stats(self):
+        '''
+        Get the rate limiter counters.
+
+        Return value:
+            A dictionary with the number of requests, how many (and how long) had to
+            wait and the maximum number of requests waiting at the same time in this
+            process.
+        '''
+        with self._stats_lock:
+            return collections.OrderedDict([
+                ('requests', self.requests),
+                ('waited', self.waited),
+                ('wait-seconds', round(self.wait_seconds, 3)),
+                ('max-wait-seconds', round(self.max_wait_seconds, 3)),
+                ('queue-depth', self.queue_depth),
+                ('max-queue-depth', self.max_queue_depth),
+                ])
+
+
+class RateLimitedTranslator(translatorwrapper.TranslatorWrapper):
+    '''
+    Wrap a translator so its requests go through a `RateLimiter`.
+
+    Cached translations are not requests to the service, so this goes inside any
+    cache.
+    '''
+
+    def __init__(self, translator, rate_limiter):
+        '''
+        Initialize a `RateLimitedTranslator` instance.
+
+        translator:
+            The translator to wrap.
+        rate_limiter:
+            The `RateLimiter` to use.
+        '''
+        super().__init__(translator)
+        self.rate_limiter = rate_limiter
+
+    def _call(self, function, from_lang, to_lang, texts):
+        #pylint: disable=unused-argument
+        self.rate_limiter.acquire(sum(len(text) for text in texts))
+        return function()
@@ -1,13 +1,33 @@
 import configparser
+import json
 import os
+import random
+import signal
 import sys
+import threading
 import time
 
 import tweepy
 
+import archive
+import cache
+import classifier
+import events
+import following
+import hedging
+import httppool
 import lock
+import logindex
+import logstore
+import logwriter
+import metrics
 import pathutils
+import placeholders
+import ratelimit
+import timeline
+import tracing
 import twitter
+import users
 
 
 def die(msg):
@@ -21,78 +41,602 @@ def die(msg):
     raise SystemExit(1)
 
 
-class Runner:
+ACCOUNT_SECTION_PREFIX = 'account:'
+
+_CHECKS = metrics.REGISTRY.counter(
+    'transequilibrium_checks_total',
+    'Number of times the timeline was checked for new tweets.')
+_CHECK_SECONDS = metrics.REGISTRY.histogram(
+    'transequilibrium_check_seconds',
+    'Time taken to check the timeline and process the new tweets.',
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1200))
+_LAST_CHECK = metrics.REGISTRY.gauge(
+    'transequilibrium_last_check_timestamp_seconds',
+    'When the timeline was last checked successfully (as a Unix timestamp).')
+
+
+def create_auth(get):
     '''
-    Run the application.
+    Create a `tweepy.OAuthHandler` to authenticate against Twitter.
+
+    get:
+        A function which, given a section and an option name, returns the value of
+        the option from the configuration.
+    Return value:
+        A `tweepy.OAuthHandler` instance.
+    '''
+    auth = tweepy.OAuthHandler(
+        get('twitter-api', 'consumer-key'),
+        get('twitter-api', 'consumer-secret'))
+
+    auth.set_access_token(
+        get('twitter-api', 'access-token'),
+        get('twitter-api', 'access-token-secret'))
+
+    return auth
+
+
+def print_stats(title, stats):
+    '''
+    Print some statistics.
+
+    title:
+        What the statistics are about.
+    stats:
+        A dictionary mapping the name of the statistic to its value.
+    '''
+    print('{}: {}'.format(
+        title,
+        ', '.join('{}={}'.format(key, value) for key, value in stats.items())))
+
+
+class _ConfigReader:
+    '''
+    Base class for objects reading options from the configuration file.
     '''
 
     def __init__(self, config_path):
         '''
-        Initialize a `Runner` instance.
+        Initialize a `_ConfigReader` instance.
 
         config_path:
-            The path to the configuration file containing the various keys,
-            user name to target, etc.
+            The path to the configuration file.
         '''
-        self._lock = None
-
         self._config_path = config_path
+        self._config = None
+        self._read_config()
+
+    def _read_config(self):
         self._config = configparser.ConfigParser()
 
         try:
-            self._config.read(config_path)
+            self._config.read(self._config_path)
         except configparser.MissingSectionHeaderError:
             die('The configuration file "{}" is not valid.'.format(self._config_path))
 
-        self._my_user_name = self._get('app', 'my-user-name')
-        self._target_user_name = self._get('app', 'target-user-name')
+    def get_account_sections(self):
+        '''
+        Get the names of the sections for the accounts (see `MultiRunner`).
+        '''
+        return [section_name for section_name in self._config.sections()
+                if section_name.startswith(ACCOUNT_SECTION_PREFIX)]
 
-        self._dir = os.path.join(os.path.expanduser('~'),
-                                 '.transequilibrium',
-                                 '{}-{}'.format(self._my_user_name, self._target_user_name).lower())
-        self._extra_dir = os.path.join(self._dir, 'extras')
-        pathutils.makedirs(self._extra_dir)
+    def _get(self, section_name, option_name):
+        '''
+        Get the configuration key for `section_name` and `option_name` or terminate
+        the program is the option is not set or is empty.
 
-    def __del__(self):
-        if self._lock is not None:
-            print('WARNING: The Runner was freed without calling the stop method.')
+        section_name:
+            The section where the option is.
+        option_name:
+            The name of the option to get.
+        Return value:
+            A string for the specified option.
+        '''
+        try:
+            section = self._config[section_name]
+        except KeyError:
+            die('Section "{}" is missing from configuration file "{}".'.format(
+                section_name,
+                self._config_path,
+                ))
+
+        try:
+            value = section[option_name]
+        except KeyError:
+            die('Option "{}" in section "{}" is missing from configuration file "{}".'.format(
+                option_name,
+                section_name,
+                self._config_path,
+                ))
+
+        value = value.strip()
+
+        if not value:
+            die('Option "{}" in section "{}" in configuration file "{}" is empty.'.format(
+                option_name,
+                section_name,
+                self._config_path,
+                ))
+
+        return value
+
+    def _get_optional(self, section_name, option_name, default):
+        '''
+        Get the configuration key for `section_name` and `option_name` or `default`
+        if the option is not set or is empty.
+
+        section_name:
+            The section where the option is.
+        option_name:
+            The name of the option to get.
+        default:
+            The value to return if the option is missing.
+        Return value:
+            A string for the specified option.
+        '''
+        try:
+            value = self._config[section_name][option_name].strip()
+        except KeyError:
+            return default
+
+        return value or default
+
+
+class SharedResources(_ConfigReader):
+    '''
+    The resources which can be shared by multiple `Runner` instances, that is the
+    translator (including its cache), the HTTP connections, the offensiveness
+    classifier, the metrics exporter and the tracer.
+    '''
+
+    def __init__(self, config_path, cache_dir):
+        '''
+        Initialize a `SharedResources` instance.
+
+        config_path:
+            The path to the configuration file.
+        cache_dir:
+            The directory where to store the translation cache.
+        '''
+        super().__init__(config_path)
+
+        self._cache_dir = cache_dir
+        self._translator = None
+        self._http_pool = None
+        self._classifier = None
+        self._rate_limiters = []
+        self._metrics_exporter = self._create_metrics_exporter()
+        self._tracer = self._create_tracer()
+
+    def _create_metrics_exporter(self):
+        if self._get_optional('metrics', 'enabled', 'no') != 'yes':
+            return None
+
+        try:
+            interval = float(self._get_optional('metrics', 'interval-seconds', '60'))
+        except ValueError as exc:
+            die('Invalid metrics interval: {}'.format(exc))
+        if interval <= 0:
+            die('Invalid metrics interval: {}.'.format(interval))
+
+        prometheus_path = self._get_optional(
+            'metrics', 'prometheus-path',
+            os.path.join(self._cache_dir, metrics.PROMETHEUS_BASENAME))
+        return metrics.Exporter(os.path.expanduser(prometheus_path),
+                                os.path.join(self._cache_dir, metrics.JSON_BASENAME),
+                                interval=interval)
+
+    def _create_tracer(self):
+        if self._get_optional('tracing', 'enabled', 'no') != 'yes':
+            return None
+
+        trace_dir = os.path.expanduser(
+            self._get_optional('tracing', 'directory', self._cache_dir))
+        tracer = tracing.Tracer(os.path.join(trace_dir, tracing.TRACES_DIRNAME))
+        tracing.set_tracer(tracer)
+        return tracer
+
+    def get_classifier(self):
+        '''
+        Get the offensiveness classifier, creating it if needed.
+        '''
+        if self._classifier is None:
+            self._classifier = classifier.Classifier()
+        return self._classifier
+
+    def get_translator(self):
+        '''
+        Get the translator, creating it if needed.
+        '''
+        if self._translator is None:
+            self._translator = self._get_translator()
+        return self._translator
 
     def _get_translator(self):
-        translator_name = self._get('app', 'translator')
+        translator = self._create_backend(self._get('app', 'translator'))
+        if self._get_optional('hedging', 'enabled', 'no') != 'yes':
+            return translator
+
+        # Each backend has its own cache, so a hedged request doesn't use a cached
+        # translation from the other one.
+        secondary = self._create_backend(self._get('hedging', 'secondary'),
+                                         section_suffix='-secondary')
+        try:
+            return hedging.HedgingTranslator(
+                translator,
+                secondary,
+                percentile=float(self._get_optional('hedging', 'percentile', '95')),
+                min_delay=float(self._get_optional('hedging', 'min-delay-ms', '200')) / 1000,
+                max_delay=float(self._get_optional('hedging', 'max-delay-ms', '5000')) / 1000)
+        except (AssertionError, ValueError) as exc:
+            die('Invalid configuration for hedging: {}'.format(exc))
+
+    def _get_backend_section(self, section_name, section_suffix):
+        # The secondary backend for hedging can have its own keys (for instance, a
+        # second Azure subscription), otherwise it shares the primary ones.
+        if self._config.has_section(section_name + section_suffix):
+            return section_name + section_suffix
+        return section_name
+
+    def _create_backend(self, translator_name, section_suffix=''):
+        '''
+        Create a translator for a translation service, wrapped in the cache (if
+        enabled).
+
+        translator_name:
+            The name of the service, as in the "translator" option.
+        section_suffix:
+            The suffix to add to the names of the sections with the options for the
+            translator, if such sections exist.
+        '''
         if translator_name == 'azure':
             import azure
-            return azure.Translator(self._get('azure-api', 'client-secret'))
+            section_name = self._get_backend_section('azure-api', section_suffix)
+            translator = azure.Translator(self._get(section_name, 'client-secret'),
+                                          self._get_http_pool())
         elif translator_name in ('google-base', 'google-nmt'):
             import google
             model = translator_name.split('-')[1]
-            return google.Translator(self._get('google-api', 'key'), model)
+            section_name = self._get_backend_section('google-api', section_suffix)
+            translator = google.Translator(self._get(section_name, 'key'), model)
+        elif translator_name == 'simulated':
+            section_name = self._get_backend_section('simulated', section_suffix)
+            translator = self._get_simulated_translator(section_name)
         else:
             die('Invalid translation API: {}.'.format(translator_name))
 
+        # Translators using different API keys need different rate-limit buckets.
+        rate_limit_key = translator.name
+        if section_suffix and section_name.endswith(section_suffix):
+            rate_limit_key += section_suffix
+
+        # The metrics are recorded inside the cache, so they count only the requests
+        # which actually reach the translation service.
+        translator = metrics.MeteredTranslator(translator)
+        translator = self._wrap_translator_with_rate_limiter(
+            translator, self._get_backend_section('rate-limit', section_suffix), rate_limit_key)
+        if self._tracer is not None:
+            translator = tracing.TracingTranslator(translator)
+        return self._wrap_translator_with_cache(translator)
+
+    def _wrap_translator_with_rate_limiter(self, translator, section_name, default_key):
+        if self._get_optional(section_name, 'enabled', 'no') != 'yes':
+            return translator
+
+        # The state is shared by all the processes of the user, not just the ones for
+        # an account, as they may use the same API key.
+        default_state_path = os.path.join(os.path.expanduser('~'), '.transequilibrium',
+                                          ratelimit.STATE_BASENAME)
+        state_path = os.path.expanduser(
+            self._get_optional(section_name, 'state-path', default_state_path))
+        try:
+            os.makedirs(os.path.dirname(state_path), exist_ok=True)
+            rate_limiter = ratelimit.RateLimiter(
+                state_path,
+                self._get_optional(section_name, 'key', default_key),
+                characters_per_second=float(
+                    self._get_optional(section_name, 'characters-per-second', '0')),
+                requests_per_second=float(
+                    self._get_optional(section_name, 'requests-per-second', '0')),
+                burst_seconds=float(self._get_optional(section_name, 'burst-seconds', '1')))
+        except (AssertionError, ValueError, OSError) as exc:
+            die('Invalid configuration for the rate limiter: {}'.format(exc))
+
+        self._rate_limiters.append(rate_limiter)
+        return ratelimit.RateLimitedTranslator(translator, rate_limiter)
+
+    def _get_simulated_translator(self, section_name='simulated'):
+        import simulated
+
+        seed = self._get_optional(section_name, 'seed', None)
+        try:
+            return simulated.Translator(
+                behaviour=self._get_optional(section_name, 'behaviour', 'converge'),
+                rounds=int(self._get_optional(section_name, 'rounds', '3')),
+                period=int(self._get_optional(section_name, 'period', '2')),
+                latency=self._get_optional(section_name, 'latency', 'fixed:0'),
+                failure_rate=float(self._get_optional(section_name, 'failure-rate', '0')),
+                retry_delay=float(self._get_optional(section_name, 'retry-delay', '1')),
+                seed=int(seed) if seed is not None else None)
+        except (AssertionError, ValueError) as exc:
+            die('Invalid configuration for the simulated translator: {}'.format(exc))
+
+    def _get_http_pool(self):
+        if self._http_pool is None:
+            self._http_pool = httppool.HTTPPool(
+                pool_connections=int(self._get_optional('http', 'pool-connections', '4')),
+                pool_maxsize=int(self._get_optional('http', 'pool-size', '8')),
+                connect_timeout=float(self._get_optional('http', 'connect-timeout', '10')),
+                read_timeout=float(self._get_optional('http', 'read-timeout', '30')))
+        return self._http_pool
+
+    def _wrap_translator_with_cache(self, translator):
+        if self._get_optional('cache', 'enabled', 'no') != 'yes':
+            return translator
+
+        return cache.CachingTranslator(
+            translator,
+            self._cache_dir,
+            max_memory_entries=int(self._get_optional('cache', 'memory-entries', '1024')),
+            max_disk_bytes=int(self._get_optional('cache', 'disk-megabytes', '64')) * 1024 * 1024,
+            max_age=int(self._get_optional('cache', 'max-age-days', '90')) * 24 * 60 * 60)
+
+    def close(self):
+        if isinstance(self._translator, hedging.HedgingTranslator):
+            print_stats('Hedging', self._translator.stats())
+            for backend in (self._translator.primary, self._translator.secondary):
+                if isinstance(backend, cache.CachingTranslator):
+                    print_stats('Translation cache ({})'.format(backend.name), backend.stats())
+        elif isinstance(self._translator, cache.CachingTranslator):
+            print_stats('Translation cache', self._translator.stats())
+        translator_close = getattr(self._translator, 'close', None)
+        if translator_close is not None:
+            translator_close()
+        self._translator = None
+
+        for rate_limiter in self._rate_limiters:
+            print_stats('Rate limiter ({})'.format(rate_limiter.key), rate_limiter.stats())
+        self._rate_limiters = []
+
+        if self._http_pool is not None:
+            print_stats('HTTP connections', self._http_pool.stats())
+            self._http_pool.close()
+            self._http_pool = None
+
+        if self._classifier is not None:
+            print_stats('Offensiveness', self._classifier.stats())
+            self._classifier = None
+
+        if self._metrics_exporter is not None:
+            self._metrics_exporter.close()
+            self._metrics_exporter = None
+
+        if self._tracer is not None:
+            tracing.set_tracer(None)
+            self._tracer.close()
+            self._tracer = None
+
+
+class Runner(_ConfigReader):
+    '''
+    Run the application.
+    '''
+
+    def __init__(self, config_path, account_section='app', shared=None):
+        '''
+        Initialize a `Runner` instance.
+
+        config_path:
+            The path to the configuration file containing the various keys,
+            user name to target, etc.
+        account_section:
+            The section with the user names (and, optionally, other options) for
+            the account to run.
+        shared:
+            A `SharedResources` instance or `None` to create one which is used only
+            by this runner.
+        '''
+        super().__init__(config_path)
+
+        self._lock = None
+        self._client = None
+        self._following_store = None
+        self._user_resolver = None
+        self._timeline_backlog = None
+        self._compact_log_writer = None
+        self._buffered_log_writer = None
+        self._extras_archive = None
+
+        self._account_section = account_section
+        self._my_user_name = self._get(account_section, 'my-user-name')
+        self._target_user_name = self._get(account_section, 'target-user-name')
+
+        self._dir = os.path.join(os.path.expanduser('~'),
+                                 '.transequilibrium',
+                                 '{}-{}'.format(self._my_user_name, self._target_user_name).lower())
+        self._extra_dir = os.path.join(self._dir, 'extras')
+        pathutils.makedirs(self._extra_dir)
+
+        self._owns_shared = shared is None
+        if self._owns_shared:
+            shared = SharedResources(config_path, self._dir)
+        self._shared = shared
+
+    @property
+    def name(self):
+        return '{}-{}'.format(self._my_user_name, self._target_user_name)
+
+    def __del__(self):
+        if self._lock is not None:
+            print('WARNING: The Runner was freed without calling the stop method.')
+
     def run(self):
         '''
         Start translating the tweets.
         '''
+        self.start()
+        self.process_tweets()
+
+    def start(self):
+        '''
+        Acquire the lock for the account and connect to Twitter.
+        '''
         def still_waiting_cb():
             print('Waiting for the lock (is another instance running?).')
 
-        self._lock = lock.FileLock(os.path.join(self._dir, 'lock'),
-                                   timeout=2 * 60,
-                                   still_waiting_cb=still_waiting_cb)
-        self._lock.acquire()
+        account_lock = lock.FileLock(os.path.join(self._dir, 'lock'),
+                                     timeout=2 * 60,
+                                     still_waiting_cb=still_waiting_cb)
+        account_lock.acquire()
+        # Only set if acquired, as `stop` releases it.
+        self._lock = account_lock
 
-        auth = self._get_auth()
-        translator = self._get_translator()
+        try:
+            self._create_client()
+        except BaseException:
+            # `start` is called again after a failure, so don't keep the lock (which
+            # could not be acquired again) or what was already opened.
+            self._abort_start()
+            raise
 
-        client = twitter.Client(
-            translator,
-            auth,
+    def _create_client(self):
+        reconcile_hours = float(
+            self._get_optional_for_account('app', 'following-reconcile-hours', '24'))
+        self._following_store = following.FollowingStore(
+            os.path.join(self._dir, 'following.json'),
+            reconcile_interval=reconcile_hours * 60 * 60)
+
+        ttl_days = float(self._get_optional_for_account('app', 'user-cache-days', '7'))
+        self._user_resolver = users.UserResolver(
+            cache_path=os.path.join(self._dir, users.UserResolver.DB_BASENAME),
+            ttl=ttl_days * 24 * 60 * 60)
+
+        self._timeline_backlog = timeline.TimelineBacklog(
+            os.path.join(self._dir, 'timeline-backlog.json'))
+
+        self._client = twitter.Client(
+            self._shared.get_translator(),
+            self._get_auth(),
             self._my_user_name,
             self._target_user_name,
-            self)
-        client.process_tweets()
+            self,
+            translation_mode=self._get_translation_mode(),
+            translation_workers=int(
+                self._get_optional_for_account('app', 'translation-workers', '4')),
+            following_store=self._following_store,
+            user_resolver=self._user_resolver,
+            timeline_backlog=self._timeline_backlog,
+            offensive_classifier=self._shared.get_classifier(),
+            offensive_policy=self._get_offensive_policy(),
+            placeholder_scheme=self._get_placeholder_scheme())
+
+    def _abort_start(self):
+        self._client = None
+        self._following_store = None
+        self._timeline_backlog = None
+
+        if self._user_resolver is not None:
+            self._user_resolver.close()
+            self._user_resolver = None
+
+        self._lock.release()
+        self._lock = None
+
+    def process_tweets(self, max_count=10):
+        '''
+        Translate the new tweets, calling `start` first if needed.
+
+        max_count:
+            The maximum number of tweets to process.
+        Return value:
+            The number of processed tweets.
+        '''
+        if self._client is None:
+            self.start()
+
+        _CHECKS.inc(account=self.name)
+        with _CHECK_SECONDS.time(account=self.name), \
+                tracing.span('check', account=self.name) as span:
+            processed = self._client.process_tweets(max_count)
+            span.set(processed=processed)
+        _LAST_CHECK.set(time.time(), account=self.name)
+        return processed
+
+    def process_pushed_tweets(self, tweets_json):
+        '''
+        Translate the tweets pushed by an event source, calling `start` first if
+        needed.
+
+        tweets_json:
+            A list of tweet JSON objects. Tweets by other users are ignored.
+        Return value:
+            The number of processed tweets.
+        '''
+        if self._client is None:
+            self.start()
+        with tracing.span('process-pushed-tweets', account=self.name, tweets=len(tweets_json)):
+            return self._client.process_pushed_tweets(tweets_json)
+
+    def _get_translation_mode(self):
+        translation_mode = self._get_optional_for_account('app', 'translation-mode', 'serial')
+        if translation_mode not in twitter.Client.TRANSLATION_MODES:
+            die('Invalid translation mode: {}.'.format(translation_mode))
+        return translation_mode
+
+    def _get_offensive_policy(self):
+        offensive_policy = self._get_optional_for_account('app', 'offensive-policy', 'log')
+        if offensive_policy not in classifier.POLICIES:
+            die('Invalid offensive policy: {}.'.format(offensive_policy))
+        return offensive_policy
+
+    def _get_placeholder_scheme(self):
+        # Not all translators keep the same placeholders intact, so the scheme can be
+        # set for each translator (like "google-nmt = compact").
+        scheme_name = self._get_optional(
+            'placeholders',
+            self._get('app', 'translator'),
+            self._get_optional('placeholders', 'scheme', 'tag'))
+        if scheme_name not in placeholders.SCHEMES:
+            die('Invalid placeholder scheme: {}.'.format(scheme_name))
+        return placeholders.get_scheme(scheme_name)
 
     def stop(self):
+        # Make sure all the log entries are written before anything else is closed,
+        # but release everything even if that fails.
+        try:
+            if self._buffered_log_writer is not None:
+                buffered_log_writer = self._buffered_log_writer
+                self._buffered_log_writer = None
+                buffered_log_writer.close()
+                print_stats('Log writer', buffered_log_writer.stats())
+        finally:
+            self._release_resources()
+
+    def _release_resources(self):
+        self._client = None
+
+        if self._following_store is not None:
+            print_stats('Following', self._following_store.stats())
+            self._following_store.save()
+            self._following_store = None
+
+        if self._timeline_backlog is not None:
+            print_stats('Timeline', self._timeline_backlog.stats())
+            self._timeline_backlog = None
+
+        if self._user_resolver is not None:
+            print_stats('Users', self._user_resolver.stats())
+            self._user_resolver.close()
+            self._user_resolver = None
+
+        if self._owns_shared:
+            self._shared.close()
+
+        if self._extras_archive is not None:
+            self._extras_archive.close()
+            self._extras_archive = None
+
         if self._lock:
             self._lock.release()
             self._lock = None
@@ -112,19 +656,76 @@ class Runner:
             with self._get_last_processed_file('r') as last_processed:
                 return last_processed.read().strip()
         except IOError:
-            return self._get('app', 'start-since')
+            return self._get_for_account('app', 'start-since')
 
     def set_last_processed(self, tweet_id):
         '''
         Set the ID of the last processed tweet.
 
+        The ID is on disk when this method returns, so, even if log entries are
+        buffered, it's saved before the entries for the tweet.
+
         tweet_id:
             The ID of the most recent tweet which was processed.
         '''
         with self._get_last_processed_file('w') as last_processed:
             last_processed.write(tweet_id)
+            last_processed.flush()
+            os.fsync(last_processed.fileno())
+
+    def _get_processing_gap_path(self):
+        return os.path.join(self._dir, 'processing-gap.json')
+
+    def get_processing_gap(self):
+        '''
+        Get the tweets processed out of order (see `twitter.Client`).
+
+        Return value:
+            A `(floor, processed_ids)` tuple, where `floor` is the ID (as an integer)
+            of the last tweet processed before the out of order ones or `None` if
+            there's no gap, and `processed_ids` is the set of the IDs (as integers) of
+            the tweets after `floor` which were already processed.
+        '''
+        try:
+            with open(self._get_processing_gap_path()) as gap_file:
+                gap = json.load(gap_file)
+            return int(gap['floor']), set(int(tweet_id) for tweet_id in gap['processed'])
+        except IOError:
+            return None, set()
+        except (KeyError, TypeError, ValueError):
+            print('WARNING: The processing gap file is not valid, ignoring it.',
+                  file=sys.stderr)
+            return None, set()
+
+    def set_processing_gap(self, floor, processed_ids):
+        '''
+        Save the tweets processed out of order.
+
+        Like the last processed tweet, this is on disk when the method returns.
+
+        floor:
+            As returned by `get_processing_gap`. If `None`, the gap is removed.
+        processed_ids:
+            As returned by `get_processing_gap`.
+        '''
+        path = self._get_processing_gap_path()
+        if floor is None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return
 
-    def save_last_processed_log(self, log_entry, extra_name=None):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as gap_file:
+            json.dump({'floor': str(floor),
+                       'processed': sorted(str(tweet_id) for tweet_id in processed_ids)},
+                      gap_file)
+            gap_file.flush()
+            os.fsync(gap_file.fileno())
+        os.replace(tmp_path, path)
+
+    def save_last_processed_log(self, log_entry, extra_name=None, trace_id=None):
         '''
         Save log_entry in the log file.
 
@@ -133,21 +734,110 @@ class Runner:
         extra_name:
             If `None`, the log is saved to the main file.
             If not `None`, the log is saved to an extra file in another directory
-            with this parameter as basename.
+            (or in the extras archive) with this parameter as basename.
+        trace_id:
+            For extra files, the ID of the original tweet which is being processed.
         '''
-        if extra_name is None:
-            path = os.path.join(self._dir, 'log')
-            mode = 'a'
+        # Depending on the configuration, this could be written later.
+        self._get_buffered_log_writer().append(log_entry, extra_name, trace_id)
+
+    def _get_buffered_log_writer(self):
+        if self._buffered_log_writer is None:
+            policy = self._get_optional('log', 'flush-policy', 'always')
+            if policy not in logwriter.POLICIES:
+                die('Invalid log flush policy: {}.'.format(policy))
+
+            self._buffered_log_writer = logwriter.BufferedLogWriter(
+                self._write_log_entries,
+                policy=policy,
+                interval=int(self._get_optional('log', 'flush-interval-ms', '500')) / 1000,
+                max_pending=int(self._get_optional('log', 'max-pending-entries', '1000')),
+                stats_path=os.path.join(self._dir, logwriter.STATS_BASENAME))
+
+        return self._buffered_log_writer
+
+    def _write_log_entries(self, entries):
+        main_log_entries = []
+        extras = []
+        for log_entry, extra_name, trace_id in entries:
+            if extra_name is None:
+                main_log_entries.append(log_entry)
+            else:
+                extras.append((extra_name, log_entry, trace_id))
+
+        # If writing fails, all the entries are written again later. Saving an extra
+        # again just replaces it, but appending to the main log would duplicate the
+        # entries, so that is the last step.
+        if extras and self._get_extras_archive() is not None:
+            self._get_extras_archive().add_many(extras)
         else:
-            path = os.path.join(self._extra_dir, extra_name)
-            mode = 'w'
+            for extra_name, log_entry, _ in extras:
+                with open(os.path.join(self._extra_dir, extra_name), 'w') as log_file:
+                    log_file.write(log_entry)
+
+        if main_log_entries:
+            self._append_to_main_log(main_log_entries)
+            try:
+                # Don't log too much to stdout.
+                print(''.join(main_log_entries), end='')
+            except (IOError, OSError):
+                # The entries are already in the log.
+                pass
+
+    def _get_extras_archive(self):
+        if self._extras_archive is None:
+            storage = self._get_optional('extras', 'storage', 'files')
+            if storage == 'files':
+                return None
+            elif storage != 'archive':
+                die('Invalid storage for extras: {}.'.format(storage))
+            self._extras_archive = archive.ExtrasArchive(
+                os.path.join(self._dir, archive.ExtrasArchive.BASENAME))
+        return self._extras_archive
+
+    def _get_log_format(self):
+        log_format = self._get_optional('log', 'format', 'pretty')
+        if log_format not in ('pretty', 'compact'):
+            die('Invalid log format: {}.'.format(log_format))
+        return log_format
+
+    def _get_compact_log_writer(self):
+        if self._compact_log_writer is None:
+            rotation = self._get_optional('log', 'rotation', 'size')
+            if rotation not in logstore.ROTATIONS:
+                die('Invalid log rotation: {}.'.format(rotation))
 
-        with open(path, mode) as log_file:
-            log_file.write(log_entry)
+            compression = self._get_optional('log', 'compression', 'none')
+            error = logstore.check_compression(compression)
+            if error is not None:
+                die(error)
 
-        if extra_name is None:
-            # Don't log too much to stdout.
-            print(log_entry, end='')
+            segment_megabytes = int(self._get_optional('log', 'segment-megabytes', '16'))
+
+            self._compact_log_writer = logstore.CompactLogWriter(
+                os.path.join(self._dir, 'log'),
+                max_segment_bytes=segment_megabytes * 1024 * 1024,
+                rotation=rotation,
+                compression=compression)
+
+        return self._compact_log_writer
+
+    def _append_to_main_log(self, log_entries):
+        if self._get_log_format() == 'compact':
+            # The compact format doesn't need an index.
+            self._get_compact_log_writer().append_many(log_entries)
+            return
+
+        path = os.path.join(self._dir, 'log')
+        with open(path, 'ab') as log_file:
+            log_file.write(''.join(log_entries).encode('utf-8'))
+
+        # Keep the index up to date, so it doesn't need to be updated (which is slower)
+        # when the log is parsed.
+        try:
+            logindex.LogIndex(path).update()
+        except (IOError, OSError, ValueError) as exc:
+            print('WARNING: Failed to update the log index: {}'.format(exc), file=sys.stderr)
 
     def _get_auth(self):
         '''
@@ -157,68 +847,380 @@ class Runner:
         Return value:
             A `tweepy.OAuthHandler` instance.
         '''
-        auth = tweepy.OAuthHandler(
-            self._get('twitter-api', 'consumer-key'),
-            self._get('twitter-api', 'consumer-secret'))
+        return create_auth(self._get_for_account)
 
-        auth.set_access_token(
-            self._get('twitter-api', 'access-token'),
-            self._get('twitter-api', 'access-token-secret'))
+    def _get_account_value(self, option_name):
+        if self._account_section == 'app':
+            return None
+        return self._get_optional(self._account_section, option_name, None)
 
-        return auth
+    def _get_for_account(self, section_name, option_name):
+        '''
+        Like `_get`, but, if the option is set in the account section, use that
+        value instead.
+        '''
+        value = self._get_account_value(option_name)
+        if value is not None:
+            return value
+        return self._get(section_name, option_name)
 
-    def _get(self, section_name, option_name):
+    def _get_optional_for_account(self, section_name, option_name, default):
         '''
-        Get the configuration key for `section_name` and `option_name` or terminate
-        the program is the option is not set or is empty.
+        Like `_get_optional`, but, if the option is set in the account section, use
+        that value instead.
+        '''
+        value = self._get_account_value(option_name)
+        if value is not None:
+            return value
+        return self._get_optional(section_name, option_name, default)
+
+
+class MultiRunner(_ConfigReader):
+    '''
+    Run the application for multiple accounts (i.e. pairs of bot and target users) in
+    a single process.
+
+    Each account is configured in an "[account:NAME]" section, with the same options
+    as in the "[app]" section (like "my-user-name" and "target-user-name"). The
+    account sections can also override options in the "[app]" and "[twitter-api]"
+    sections (like "start-since" or "access-token").
+
+    All the accounts share the same translator, translation cache and HTTP
+    connections, while each one has its own state directory and lock.
+
+    The accounts take turns, each one processing a few tweets per turn, until there
+    are no new tweets, so a busy account cannot delay the others too much.
+    '''
+
+    def __init__(self, config_path):
+        '''
+        Initialize a `MultiRunner` instance.
+
+        config_path:
+            The path to the configuration file.
+        '''
+        super().__init__(config_path)
+
+        account_sections = self.get_account_sections()
+        if not account_sections:
+            die('No account sections in configuration file "{}".'.format(self._config_path))
+
+        self._tweets_per_turn = int(self._get_optional('app', 'tweets-per-turn', '1'))
+        if self._tweets_per_turn < 1:
+            die('Invalid number of tweets per turn: {}.'.format(self._tweets_per_turn))
+
+        cache_dir = os.path.join(os.path.expanduser('~'), '.transequilibrium')
+        self._shared = SharedResources(config_path, cache_dir)
+        self._runners = [Runner(config_path, section_name, self._shared)
+                         for section_name in account_sections]
+        self._started_runners = []
+
+    def run(self):
+        '''
+        Start translating the tweets for all the accounts.
+
+        If an account fails, the other ones are still processed, then the error is
+        raised.
+        '''
+        self.start()
+        self.process_tweets()
+
+    @staticmethod
+    def _report_error(runner, exc, errors):
+        print('Failed to process account {}: {}'.format(runner.name, exc), file=sys.stderr)
+        errors.append(exc)
+
+    def _start_runners(self, errors):
+        for runner in self._runners:
+            if runner in self._started_runners:
+                continue
+            try:
+                runner.start()
+            except Exception as exc:
+                self._report_error(runner, exc, errors)
+                continue
+            self._started_runners.append(runner)
+
+    def start(self):
+        '''
+        Acquire the locks for all the accounts and connect to Twitter.
+
+        If an account fails, the other ones are still started, then the error is
+        raised. The failed accounts are started again by `process_tweets`.
+        '''
+        errors = []
+        self._start_runners(errors)
+        if errors:
+            raise errors[0]
+
+    def process_tweets(self):
+        '''
+        Translate the new tweets for all the accounts, taking turns.
+
+        Like for `start`, if an account fails, the other ones are still processed,
+        then the error is raised.
 
-        section_name:
-            The section where the option is.
-        option_name:
-            The name of the option to get.
         Return value:
-            A string for the specified option.
+            The number of processed tweets.
+        '''
+        errors = []
+        self._start_runners(errors)
+
+        total = 0
+        active = list(self._started_runners)
+        turn = 0
+        while active:
+            # Rotate the order, so the same account doesn't always go first.
+            offset = turn % len(active)
+            turn += 1
+
+            still_active = []
+            for runner in active[offset:] + active[:offset]:
+                try:
+                    processed = runner.process_tweets(self._tweets_per_turn)
+                except Exception as exc:
+                    self._report_error(runner, exc, errors)
+                    continue
+                total += processed
+                # If fewer tweets than requested were processed, there are no more.
+                if processed >= self._tweets_per_turn:
+                    still_active.append(runner)
+            active = still_active
+
+        if errors:
+            raise errors[0]
+
+        return total
+
+    def process_pushed_tweets(self, tweets_json):
+        '''
+        Translate the tweets pushed by an event source for all the accounts.
+
+        Like for `start`, if an account fails, the other ones are still processed,
+        then the error is raised.
+
+        tweets_json:
+            A list of tweet JSON objects. Each account ignores the tweets by users
+            other than its target.
+        Return value:
+            The number of processed tweets.
         '''
+        errors = []
+        self._start_runners(errors)
+
+        total = 0
+        for runner in self._started_runners:
+            try:
+                total += runner.process_pushed_tweets(tweets_json)
+            except Exception as exc:
+                self._report_error(runner, exc, errors)
+
+        if errors:
+            raise errors[0]
+
+        return total
+
+    def stop(self):
         try:
-            section = self._config[section_name]
-        except KeyError:
-            die('Section "{}" is missing from configuration file "{}".'.format(
-                section_name,
-                self._config_path,
-                ))
+            for runner in self._runners:
+                try:
+                    runner.stop()
+                except Exception as exc:
+                    print('Failed to stop account {}: {}'.format(runner.name, exc),
+                          file=sys.stderr)
+        finally:
+            self._shared.close()
+
+
+class Daemon(_ConfigReader):
+    '''
+    Keep running the application, checking for new tweets periodically.
+
+    Unlike creating a new `Runner` for each check, the runner (including the lock,
+    the connection to Twitter and the translator) is created only once, so each
+    check just needs to get the new tweets.
+
+    If there are no new tweets, checks are done less often. The configuration is
+    reloaded when the process receives SIGHUP.
+
+    Tweets can also be pushed by an event source (configured in the "[events]"
+    section), in which case they are processed as soon as they arrive, while the
+    periodic checks catch the tweets the event source missed. The event source is
+    not changed when the configuration is reloaded.
+    '''
+
+    MAX_FAILURES = 5
+
+    def __init__(self, config_path):
+        '''
+        Initialize a `Daemon` instance.
+
+        config_path:
+            The path to the configuration file.
+        '''
+        super().__init__(config_path)
+
+        self._runner = None
+        self._event_source = None
+        self._wake_up = threading.Event()
+        self._reload_requested = False
+
+    @property
+    def enabled(self):
+        '''
+        Whether the daemon mode is enabled in the configuration.
+        '''
+        return self._get_optional('daemon', 'enabled', 'no') == 'yes'
 
+    def _get_delay(self, idle_checks):
+        interval = float(self._get_optional('daemon', 'interval-seconds', '60'))
+        max_interval = float(self._get_optional('daemon', 'max-backoff-seconds', '600'))
+        jitter = float(self._get_optional('daemon', 'jitter-seconds', '10'))
+
+        # Double the interval for each check which didn't find anything new.
+        delay = min(interval * 2 ** min(idle_checks, 16), max(interval, max_interval))
+        return delay + random.uniform(0, jitter)
+
+    def _create_event_source(self):
+        source_type = self._get_optional('events', 'source', 'none')
+        if source_type not in events.SOURCE_TYPES:
+            die('Invalid event source: {}.'.format(source_type))
+
+        if source_type == 'file':
+            return events.FileEventSource(os.path.expanduser(self._get('events', 'path')))
+
+        if source_type == 'socket':
+            return events.SocketEventSource(self._get_optional('events', 'host', 'localhost'),
+                                            int(self._get('events', 'port')))
+
+        if source_type == 'stream':
+            follow_ids = [user_id.strip()
+                          for user_id in self._get('events', 'follow-ids').split(',')]
+            return events.StreamEventSource(create_auth(self._get), follow_ids)
+
+        return None
+
+    def _handle_sighup(self, signum, frame):
+        # pylint: disable=unused-argument
+        self._reload_requested = True
+        self._wake_up.set()
+        if self._event_source is not None:
+            self._event_source.wake_up()
+
+    def _reload(self):
+        print('Reloading the configuration...')
         try:
-            value = section[option_name]
-        except KeyError:
-            die('Option "{}" in section "{}" is missing from configuration file "{}".'.format(
-                option_name,
-                section_name,
-                self._config_path,
-                ))
+            self._read_config()
+            new_runner = create_runner(self._config_path)
+        except SystemExit:
+            # The error was already printed.
+            print('Keeping the old configuration.', file=sys.stderr)
+            return
 
-        value = value.strip()
+        # The new runner is started when used.
+        self._runner.stop()
+        self._runner = new_runner
 
-        if not value:
-            die('Option "{}" in section "{}" in configuration file "{}" is empty.'.format(
-                option_name,
-                section_name,
-                self._config_path,
-                ))
+    def run(self):
+        '''
+        Check for new tweets forever.
+        '''
+        signal.signal(signal.SIGHUP, self._handle_sighup)
 
-        return value
+        self._runner = create_runner(self._config_path)
+        try:
+            self._event_source = self._create_event_source()
+            self._run_loop()
+        finally:
+            try:
+                self._runner.stop()
+                self._runner = None
+            finally:
+                if self._event_source is not None:
+                    self._event_source.close()
+                    print_stats('Events', self._event_source.stats())
+                    self._event_source = None
+
+    def _run_loop(self):
+        idle_checks = 0
+        failed = 0
+        while True:
+            if self._reload_requested:
+                self._reload_requested = False
+                self._reload()
+                idle_checks = 0
+
+            try:
+                processed = self._runner.process_tweets()
+            except Exception as exc:
+                failed += 1
+                if failed > self.MAX_FAILURES:
+                    print('Failed too many times, giving up.', file=sys.stderr)
+                    raise
+                print('Got exception, will retry in {} minute(s): {}'.format(failed, exc),
+                      file=sys.stderr)
+                delay = failed * 60
+            else:
+                failed = 0
+                idle_checks = 0 if processed else idle_checks + 1
+                delay = self._get_delay(idle_checks)
+
+            self._wait(delay)
+
+    def _wait(self, delay):
+        '''
+        Wait until the next check, processing the pushed tweets (if any) meanwhile.
+        '''
+        if self._event_source is None:
+            self._wake_up.wait(delay)
+            self._wake_up.clear()
+            return
+
+        deadline = time.monotonic() + delay
+        while not self._reload_requested:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            tweets_json = self._event_source.get_tweets(remaining)
+            if not tweets_json:
+                continue
+            try:
+                self._runner.process_pushed_tweets(tweets_json)
+            except Exception as exc:
+                # The next check will find the tweets which were not processed.
+                print('Failed to process pushed tweets, checking now: {}'.format(exc),
+                      file=sys.stderr)
+                break
+        self._wake_up.clear()
+
+
+def create_runner(config_path):
+    '''
+    Create a `MultiRunner` if there are account sections in the configuration file
+    or a `Runner` otherwise.
+    '''
+    if _ConfigReader(config_path).get_account_sections():
+        return MultiRunner(config_path)
+    return Runner(config_path)
 
 
 def main():
     '''
-    Start a `Runner` with the options specified on the command line.
+    Start a `Runner` (or a `MultiRunner`) with the options specified on the command
+    line.
     '''
     if len(sys.argv) != 2:
         die('{} CONFIG-FILE'.format(sys.argv[0]))
 
+    daemon = Daemon(sys.argv[1])
+    if daemon.enabled:
+        daemon.run()
+        return
+
     failed = 0
     while True:
         try:
-            runner = Runner(sys.argv[1])
+            runner = create_runner(sys.argv[1])
             try:
                 runner.run()
             finally:
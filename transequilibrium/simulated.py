@@ -0,0 +1,235 @@
+import collections
+import math
+import random
+import threading
+import time
+
+import requests
+
+import metrics
+
+
+def parse_latency(spec):
+    '''
+    Parse a latency distribution specification.
+
+    spec:
+        One of:
+        - 'fixed:SECONDS'
+        - 'uniform:MIN-SECONDS:MAX-SECONDS'
+        - 'lognormal:MEDIAN-SECONDS:SIGMA'
+    Return value:
+        A function which, given a `random.Random` instance, returns a latency in
+        seconds.
+    '''
+    parts = spec.split(':')
+    kind = parts[0]
+    try:
+        params = [float(param) for param in parts[1:]]
+    except ValueError:
+        raise ValueError('Invalid latency specification: {}.'.format(spec))
+
+    if kind == 'fixed' and len(params) == 1:
+        return lambda rand: params[0]
+    elif kind == 'uniform' and len(params) == 2:
+        return lambda rand: rand.uniform(params[0], params[1])
+    elif kind == 'lognormal' and len(params) == 2:
+        mu = math.log(params[0])
+        return lambda rand: rand.lognormvariate(mu, params[1])
+    else:
+        raise ValueError('Invalid latency specification: {}.'.format(spec))
+
+
+class Translator:
+    '''
+    Simulate a translation API without doing any network request.
+
+    The "translations" are deterministic and their convergence behaviour can be
+    chosen, so this can be used to test and measure the rest of the application
+    without spending any translation quota.
+
+    Texts in the main language get a marker appended at each round trip. The number
+    of markers then decides whether the text changes:
+    - 'converge': the text stops changing after `rounds` round trips.
+    - 'oscillate': the text cycles between `period` different texts.
+    - 'diverge': the text never stops changing.
+    '''
+
+    BEHAVIOURS = ('converge', 'oscillate', 'diverge')
+    MARKER = '~'
+
+    #pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, behaviour='converge', rounds=3, period=2, latency='fixed:0',
+                 failure_rate=0.0, retry_delay=1.0, seed=None):
+        '''
+        Initialize a `Translator` instance.
+
+        behaviour:
+            How the translations behave, see the class documentation.
+        rounds:
+            For the 'converge' behaviour, after how many round trips the text stops
+            changing.
+        period:
+            For the 'oscillate' behaviour, the length of the cycle.
+        latency:
+            The latency for each request, see `parse_latency`.
+        failure_rate:
+            The probability (between 0 and 1) that a request fails with a transient
+            error (like a `requests.exceptions.ConnectionError`).
+        retry_delay:
+            How many seconds to wait, multiplied by the attempt number, before
+            retrying a failed request. This is the same policy used by the Azure
+            translator when the delay is 1.
+        seed:
+            The seed for the random number generator used for latencies and
+            failures.
+        '''
+        assert behaviour in self.BEHAVIOURS
+        assert rounds >= 0
+        assert period >= 1
+        assert 0 <= failure_rate <= 1
+
+        self._behaviour = behaviour
+        self._rounds = rounds
+        self._period = period
+        self._latency = parse_latency(latency)
+        self._failure_rate = failure_rate
+        self._retry_delay = retry_delay
+
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+        self.requests = 0
+        self.texts = 0
+        self.characters = 0
+        self.failures = 0
+        self.busy_time = 0.0
+
+        self.name = 'simulated-{}'.format(behaviour)
+
+    def stats(self):
+        '''
+        Get the throughput counters.
+
+        Return value:
+            A dictionary with the number of requests (including failed ones), texts and
+            characters translated, failed requests and the total time spent in
+            requests.
+        '''
+        with self._lock:
+            return collections.OrderedDict([
+                ('requests', self.requests),
+                ('texts', self.texts),
+                ('characters', self.characters),
+                ('failures', self.failures),
+                ('busy-time', round(self.busy_time, 3)),
+                ])
+
+    def _next_marker_count(self, count):
+        if self._behaviour == 'converge':
+            return min(count + 1, self._rounds)
+        elif self._behaviour == 'oscillate':
+            return (count + 1) % self._period
+        else:
+            return count + 1
+
+    def _pseudo_translate(self, from_lang, to_lang, text):
+        prefix = '{}|'.format(from_lang)
+        if not text.startswith(prefix):
+            # The text is in the main language.
+            return '{}|{}'.format(to_lang, text)
+
+        # The text is in the intermediate language, so we are completing a round trip.
+        text = text[len(prefix):]
+        base_text = text.rstrip(self.MARKER)
+        count = len(text) - len(base_text)
+        return base_text + self.MARKER * self._next_marker_count(count)
+
+    def _simulate_request(self, texts):
+        with self._lock:
+            latency = max(self._latency(self._random), 0)
+            failure = self._random.random() < self._failure_rate
+            if failure:
+                exc_type = self._random.choice([requests.exceptions.ConnectionError,
+                                                requests.exceptions.ReadTimeout])
+            self.requests += 1
+            self.busy_time += latency
+            if failure:
+                self.failures += 1
+            else:
+                self.texts += len(texts)
+                self.characters += sum(len(text) for text in texts)
+
+        time.sleep(latency)
+
+        if failure:
+            raise exc_type('Simulated failure.')
+
+    def _request_with_retries(self, texts):
+        last_connection_error = None
+
+        for retry in range(4):
+            try:
+                self._simulate_request(texts)
+                return
+            except (requests.exceptions.ConnectionError, requests.exceptions.ReadTimeout) as exc:
+                last_connection_error = exc
+                metrics.TRANSLATOR_RETRIES.inc(translator=self.name)
+                time.sleep(retry * self._retry_delay)
+                continue
+
+        assert last_connection_error is not None
+        # pylint: disable=raising-bad-type
+        raise last_connection_error
+
+    def translate(self, from_lang, to_lang, text):
+        '''
+        Translate `text` from `from_lang` to `to_lang`.
+
+        Return value:
+            The translated text.
+        '''
+        return self.translate_many(from_lang, to_lang, [text])[0]
+
+    def translate_many(self, from_lang, to_lang, texts):
+        '''
+        Translate all the strings in `texts` from `from_lang` to `to_lang` with a
+        single (simulated) request.
+
+        Return value:
+            A list of translated texts, in the same order as `texts`.
+        '''
+        texts = list(texts)
+        if not texts:
+            return []
+
+        self._request_with_retries(texts)
+        return [self._pseudo_translate(from_lang, to_lang, text) for text in texts]
+
+
+def main():
+    import sys
+    import equilibrium
+
+    args = sys.argv[1:] + [None, None]
+    behaviour = args[0] or 'converge'
+    text = args[1]
+    if text is None:
+        text = input('Text: ')
+
+    translator = Translator(behaviour)
+
+    def translator_cb(counter, lang, translated_text):
+        print('[{counter}] {lang}: {translated_text}'.format(
+            counter=counter,
+            lang=lang,
+            translated_text=translated_text,
+            ))
+
+    res = equilibrium.find_equilibrium(translator, 'en', 'ja', text, translator_cb)
+    print('RESULT: {}'.format(res))
+    print('STATS: {}'.format(dict(translator.stats())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import collections
+import json
+import os
+
+
+class TimelineBacklog:
+    '''
+    The tweets fetched from the target user's timeline which were not processed yet,
+    saved to a file so they don't need to be fetched again.
+
+    This is useful after a long downtime, when there are more new tweets than can be
+    processed at once: the whole timeline since the last processed tweet is fetched
+    only once and the following runs continue from where the previous one stopped.
+    '''
+
+    def __init__(self, path):
+        '''
+        Initialize a `TimelineBacklog` instance.
+
+        path:
+            The file where the tweets are saved.
+        '''
+        self._path = path
+
+        # Counters for this instance only.
+        self.calls = 0
+        self.fetched = 0
+        self.served_from_backlog = 0
+        self.remaining = 0
+
+        try:
+            with open(self._path) as backlog_file:
+                self.tweets_json = json.load(backlog_file)['tweets']
+        except (IOError, ValueError):
+            self.tweets_json = []
+
+    def save(self, tweets):
+        '''
+        Save the tweets not processed yet.
+
+        tweets:
+            A list of `tweepy.models.Status` instances.
+        '''
+        #pylint: disable=protected-access
+        self.tweets_json = [tweet._json for tweet in tweets]
+
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as backlog_file:
+            json.dump({'tweets': self.tweets_json}, backlog_file)
+        os.replace(tmp_path, self._path)
+
+    def record_fetch(self, calls, fetched, served_from_backlog, remaining):
+        '''
+        Update the counters after getting new tweets.
+
+        calls:
+            The number of calls done to get the timeline.
+        fetched:
+            The number of tweets fetched.
+        served_from_backlog:
+            The number of tweets which were already in the backlog.
+        remaining:
+            The number of tweets left for later.
+        '''
+        self.calls += calls
+        self.fetched += fetched
+        self.served_from_backlog += served_from_backlog
+        self.remaining = remaining
+
+    def stats(self):
+        '''
+        Get the timeline counters.
+
+        Return value:
+            A dictionary with the number of calls done to get the timeline, the
+            number of tweets fetched, the number of tweets taken from the backlog
+            instead of being fetched and the number of tweets left for later.
+        '''
+        return collections.OrderedDict([
+            ('calls', self.calls),
+            ('fetched', self.fetched),
+            ('from-backlog', self.served_from_backlog),
+            ('remaining', self.remaining),
+            ])
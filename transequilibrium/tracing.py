@@ -0,0 +1,259 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import translatorwrapper
+
+
+TRACES_DIRNAME = 'traces'
+
+
+class _NullSpan:
+    # The span returned when tracing is disabled. It does nothing, so the same
+    # instance can be used for all spans.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def set(self, **attributes):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _NullTracer:
+    # The tracer used when tracing is disabled.
+
+    enabled = False
+
+    def span(self, name, **attributes):
+        #pylint: disable=unused-argument,no-self-use
+        return _NULL_SPAN
+
+    def close(self):
+        pass
+
+
+class _Span:
+    # A span recorded by a `Tracer`, used as a context manager.
+
+    def __init__(self, tracer, name, attributes):
+        self._tracer = tracer
+        self._name = name
+        self._attributes = attributes
+        self._start = None
+
+    def __enter__(self):
+        #pylint: disable=protected-access
+        self._tracer._enter_span()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._attributes['error'] = exc_type.__name__
+        #pylint: disable=protected-access
+        self._tracer._add_span(self._name, self._start, time.perf_counter(), self._attributes)
+
+    def set(self, **attributes):
+        '''
+        Add attributes to the span, for instance ones known only at the end.
+        '''
+        self._attributes.update(attributes)
+
+
+class Tracer:
+    '''
+    Record spans (named periods of time, with attributes) and write them to files
+    in the Chrome trace-event format, which can be loaded in chrome://tracing or
+    https://ui.perfetto.dev.
+
+    Spans are recorded with `span` and they nest by time, so a span started inside
+    another one is shown below it.
+
+    The spans are written as they end and the file is flushed whenever a
+    top-level span (like a check of the timeline) ends, so the trace of a daemon
+    is available while it runs and survives a crash. (The trace-event format
+    accepts an array which is not terminated, which is what is left if the
+    process is killed.)
+    After `MAX_EVENTS_PER_FILE` spans, a new file is started.
+    '''
+
+    enabled = True
+
+    MAX_EVENTS_PER_FILE = 200000
+
+    def __init__(self, directory, max_events_per_file=MAX_EVENTS_PER_FILE):
+        '''
+        Initialize a `Tracer` instance.
+
+        directory:
+            The directory where to write the trace files (called
+            "trace-TIME-PID-INDEX.json").
+        max_events_per_file:
+            How many spans to write in a file before starting a new one.
+        '''
+        assert max_events_per_file > 0
+
+        self._directory = directory
+        self._max_events_per_file = max_events_per_file
+        self._basename_prefix = 'trace-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'),
+                                                     os.getpid())
+
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        # The nesting level of the spans open in each thread.
+        self._local = threading.local()
+
+        self._file = None
+        self._file_index = 0
+        self._file_events = 0
+        self._file_threads = set()
+        self._failed = False
+        self._closed = False
+
+        self.written = 0
+        self.files = 0
+
+    def span(self, name, **attributes):
+        '''
+        Get a context manager which records a span for its block.
+
+        name:
+            The name of the span, like "translate".
+        attributes:
+            Details about the span, like the tweet ID, which must be serializable to
+            JSON.
+        '''
+        return _Span(self, name, attributes)
+
+    def _enter_span(self):
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+
+    def _open_file(self):
+        os.makedirs(self._directory, exist_ok=True)
+        self._file_index += 1
+        path = os.path.join(self._directory, '{}-{:03}.json'.format(self._basename_prefix,
+                                                                   self._file_index))
+        self._file = open(path, 'w')
+        self._file.write('[')
+        self._file_events = 0
+        self._file_threads = set()
+        self.files += 1
+
+    def _close_file(self):
+        self._file.write('\n]\n')
+        self._file.close()
+        self._file = None
+
+    def _write_event(self, event):
+        self._file.write('\n' if self._file_events == 0 else ',\n')
+        self._file.write(json.dumps(event, default=str))
+        self._file_events += 1
+
+    def _add_span(self, name, start, end, attributes):
+        self._local.depth -= 1
+        thread_id = threading.get_ident()
+        event = {
+            'name': name,
+            'ph': 'X',
+            # Timestamps and durations are in microseconds.
+            'ts': round((start - self._origin) * 1e6, 3),
+            'dur': round((end - start) * 1e6, 3),
+            'pid': os.getpid(),
+            'tid': thread_id,
+            'args': attributes,
+            }
+
+        with self._lock:
+            if self._failed or self._closed:
+                return
+            try:
+                if self._file is not None and self._file_events >= self._max_events_per_file:
+                    self._close_file()
+                if self._file is None:
+                    self._open_file()
+                if thread_id not in self._file_threads:
+                    # Each file gets the thread names, so it can be loaded on its own.
+                    self._file_threads.add(thread_id)
+                    self._write_event({'name': 'thread_name',
+                                       'ph': 'M',
+                                       'pid': os.getpid(),
+                                       'tid': thread_id,
+                                       'args': {'name': threading.current_thread().name}})
+                self._write_event(event)
+                self.written += 1
+                if self._local.depth == 0:
+                    self._file.flush()
+            except (IOError, OSError) as exc:
+                print('WARNING: Failed to write the trace, tracing is disabled: {}'.format(exc),
+                      file=sys.stderr)
+                self._failed = True
+
+    def close(self):
+        '''
+        Terminate the current trace file.
+        '''
+        with self._lock:
+            self._closed = True
+            if self._file is not None:
+                try:
+                    self._close_file()
+                except (IOError, OSError) as exc:
+                    print('WARNING: Failed to write the trace: {}'.format(exc),
+                          file=sys.stderr)
+
+
+_tracer = _NullTracer()
+
+
+def get_tracer():
+    '''
+    Get the tracer used by `span`.
+    '''
+    return _tracer
+
+
+def set_tracer(tracer):
+    '''
+    Set the tracer used by `span`.
+
+    tracer:
+        A `Tracer` instance or `None` to disable tracing.
+    Return value:
+        The previous tracer.
+    '''
+    global _tracer #pylint: disable=global-statement
+    previous = _tracer
+    _tracer = tracer if tracer is not None else _NullTracer()
+    return previous
+
+
+def span(name, **attributes):
+    '''
+    Record a span with the current tracer (see `Tracer.span`).
+
+    When tracing is disabled, this returns an object which does nothing, so
+    instrumented code is not slowed down.
+    '''
+    return _tracer.span(name, **attributes)
+
+
+class TracingTranslator(translatorwrapper.TranslatorWrapper):
+    '''
+    Wrap a translator and record a span for each request done to it.
+
+    Inside any cache, the spans show which translations were not cached.
+    '''
+
+    def _call(self, function, from_lang, to_lang, texts):
+        with span('translator-request', translator=self._translator.name,
+                  from_lang=from_lang, to_lang=to_lang, texts=len(texts),
+                  characters=sum(len(text) for text in texts)):
+            return function()
@@ -0,0 +1,73 @@
+class TranslatorWrapper:
+    '''
+    Base class for translators which wrap another translator and pass their requests
+    to it.
+
+    Subclasses which need to do something around each request sent to the wrapped
+    translator (a batched one counting as a single request) override `_call`.
+    '''
+
+    def __init__(self, translator):
+        '''
+        Initialize a `TranslatorWrapper` instance.
+
+        translator:
+            The translator to wrap.
+        '''
+        self._translator = translator
+
+    @property
+    def name(self):
+        return self._translator.name
+
+    def close(self):
+        '''
+        Close the wrapped translator.
+        '''
+        translator_close = getattr(self._translator, 'close', None)
+        if translator_close is not None:
+            translator_close()
+
+    def _call(self, function, from_lang, to_lang, texts):
+        '''
+        Do a request to the wrapped translator.
+
+        function:
+            A function doing the request and returning its result.
+        from_lang, to_lang:
+            The languages of the request.
+        texts:
+            The list of texts sent with the request.
+        Return value:
+            The result of `function`.
+        '''
+        #pylint: disable=unused-argument,no-self-use
+        return function()
+
+    def translate(self, from_lang, to_lang, text):
+        '''
+        Translate `text` from `from_lang` to `to_lang`.
+
+        Return value:
+            The translated text.
+        '''
+        return self._call(lambda: self._translator.translate(from_lang, to_lang, text),
+                          from_lang, to_lang, [text])
+
+    def translate_many(self, from_lang, to_lang, texts):
+        '''
+        Translate all the strings in `texts` from `from_lang` to `to_lang`, with a
+        single request if the wrapped translator supports it.
+
+        Return value:
+            A list of translated texts, in the same order as `texts`.
+        '''
+        texts = list(texts)
+        if not texts:
+            return []
+        translator_translate_many = getattr(self._translator, 'translate_many', None)
+        if translator_translate_many is None:
+            # Each text is a separate request.
+            return [self.translate(from_lang, to_lang, text) for text in texts]
+        return self._call(lambda: translator_translate_many(from_lang, to_lang, texts),
+                          from_lang, to_lang, texts)
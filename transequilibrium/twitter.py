@@ -1,13 +1,38 @@
 import collections
+import concurrent.futures
 import json
-import re
 import time
 
 import tweepy
 
-import escaping
+import classifier
 import equilibrium
-import offensive
+import metrics
+import placeholders
+import tracing
+import users
+
+
+_TWEETS_PROCESSED = metrics.REGISTRY.counter(
+    'transequilibrium_tweets_processed_total',
+    'Number of tweets processed, by outcome.')
+_PENDING_TWEETS = metrics.REGISTRY.gauge(
+    'transequilibrium_pending_tweets',
+    'Number of fetched tweets which were not processed yet.')
+
+
+# The result of translating a tweet (before posting it).
+_Translation = collections.namedtuple(
+    '_Translation',
+    ['encoded', 'result', 'restored', 'intermediate_translations'])
+
+
+def _intermediate_translation_entry(counter, language, intermediate_text):
+    return collections.OrderedDict([
+        ('counter', counter),
+        ('language', language),
+        ('text', intermediate_text),
+        ])
 
 
 class Client:
@@ -15,11 +40,64 @@ class Client:
     Twitter client which runs the application.
     '''
 
+    TRANSLATION_MODES = ('serial', 'batch', 'concurrent')
+
+    # How many tweets to ask for in each call to get the user's timeline. This is
+    # the maximum allowed by Twitter.
+    TIMELINE_PAGE_SIZE = 200
+
+    # Tweets are spaced to avoid being suspended: the n-th consecutive post waits
+    # `min(n, POST_SPACING_MAX_MULTIPLIER) * POST_SPACING` seconds after the previous
+    # one. After `POST_IDLE_RESET` seconds without posting, the count starts again.
+    POST_SPACING = 15
+    POST_SPACING_MAX_MULTIPLIER = 5
+    POST_IDLE_RESET = 10 * 60
+
     #pylint: disable=too-many-arguments
-    def __init__(self, translator, auth, my_user_name, target_user_name, last_processed):
+    def __init__(self, translator, auth, my_user_name, target_user_name, last_processed,
+                 translation_mode='serial', translation_workers=4, following_store=None,
+                 user_resolver=None, timeline_backlog=None, offensive_classifier=None,
+                 offensive_policy='log', placeholder_scheme=placeholders.TAG_SCHEME):
         '''
         Initialize a `Client` instance.
+
+        translation_mode:
+            How to translate the new tweets. One of:
+            - 'serial': each tweet is translated just before posting it.
+            - 'batch': all the new tweets are translated together, with a single
+              request per direction for each round.
+            - 'concurrent': all the new tweets are translated in parallel on a pool
+              of threads, while the translated ones are posted. The translator must
+              be thread-safe.
+        translation_workers:
+            The maximum number of threads used in the 'concurrent' mode.
+        following_store:
+            A `following.FollowingStore` used to avoid downloading the followed users
+            every time or `None` to always download them.
+        user_resolver:
+            A `users.UserResolver` used to find the screen names of mentioned users
+            or `None` to use one with an in-memory cache only.
+        timeline_backlog:
+            A `timeline.TimelineBacklog` used to save the fetched tweets which were
+            not processed yet or `None` to keep them only in memory.
+        offensive_classifier:
+            A `classifier.Classifier` used to check whether tweets are offensive or
+            `None` to use a new one.
+        offensive_policy:
+            What to do with tweets which are offensive. One of:
+            - 'log': translate and post them anyway, but write in the log which
+              texts are offensive.
+            - 'skip': don't translate nor post them.
+        placeholder_scheme:
+            The `placeholders.Scheme` used to replace the tweet entities (like URLs)
+            which must not be translated.
         '''
+        assert translation_mode in self.TRANSLATION_MODES
+        assert offensive_policy in classifier.POLICIES
+        assert translation_workers > 0
+        self._translation_mode = translation_mode
+        self._translation_workers = translation_workers
+
         self._translator = translator
         self._target_user_name = target_user_name
         self._last_processed = last_processed
@@ -35,112 +113,363 @@ class Client:
         # how to layer this properly.
         assert self._my_user.screen_name == my_user_name
 
-        self._following = set()
-
-    def process_tweets(self):
+        self._following_store = following_store
+        self._following = None
+        self._last_post_time = None
+        # How many tweets were posted one after the other (possibly by different
+        # calls to `process_tweets`, for instance by a `run.MultiRunner`).
+        self._consecutive_posts = 0
+
+        self._timeline_backlog = timeline_backlog
+        self._pending_tweets = None
+
+        # When tweets pushed by an event source are processed, some older ones may
+        # have been missed, so the timeline must be polled from the last tweet which
+        # was processed before them. Until the client caught up with the timeline,
+        # `_gap_floor` is that tweet and `_processed_ids` are the tweets after it
+        # which were processed.
+        # This is saved with the last processed tweet, so, after a restart, the missed
+        # tweets are still fetched and the processed ones are not posted again.
+        self._gap_floor, self._processed_ids = last_processed.get_processing_gap()
+
+        if user_resolver is None:
+            user_resolver = users.UserResolver()
+        self._user_resolver = user_resolver
+
+        if offensive_classifier is None:
+            offensive_classifier = classifier.Classifier()
+        self._classifier = offensive_classifier
+        self._offensive_policy = offensive_policy
+
+        self._placeholder_scheme = placeholder_scheme
+
+    def process_tweets(self, max_count=10):
         '''
         Run the client on the new tweets available.
+
+        The method can be called multiple times on the same client, for instance to
+        process new tweets in small groups.
+
+        max_count:
+            The maximum number of tweets to process.
+        Return value:
+            The number of tweets processed.
+        '''
+        with tracing.span('sync-following'):
+            self._sync_following()
+
+        with tracing.span('get-tweets', target=self._target_user_name) as span:
+            tweets = self._get_tweets(max_count)
+            span.set(tweets=len(tweets))
+        self._process_new_tweets(tweets)
+
+        if len(tweets) < max_count and self._gap_floor is not None:
+            # Nothing is missing anymore.
+            self._gap_floor = None
+            self._processed_ids.clear()
+            self._save_processing_gap()
+
+        return len(tweets)
+
+    def process_pushed_tweets(self, tweets_json):
+        '''
+        Run the client on tweets pushed by an event source (see `events.EventSource`)
+        instead of fetched from the timeline.
+
+        Tweets by other users or which were already processed are ignored. The
+        tweets are processed immediately, so, if the event source missed one, it's
+        processed after newer ones the next time `process_tweets` is called.
+
+        tweets_json:
+            A list of tweet JSON objects, as returned by the REST API.
+        Return value:
+            The number of tweets processed.
+        '''
+        last_processed = int(self._last_processed.get_last_processed())
+        floor = last_processed if self._gap_floor is None else self._gap_floor
+
+        tweets_by_id = {}
+        for tweet_json in tweets_json:
+            tweet = tweepy.models.Status.parse(self._api, tweet_json)
+            if tweet.user.screen_name.lower() != self._target_user_name.lower():
+                continue
+            if tweet.id <= floor or tweet.id in self._processed_ids:
+                continue
+            tweets_by_id[tweet.id] = tweet
+        tweets = sorted(tweets_by_id.values(), key=lambda tweet: tweet.id)
+
+        if not tweets:
+            return 0
+
+        if self._gap_floor is None:
+            self._gap_floor = floor
+            self._save_processing_gap()
+        with tracing.span('sync-following'):
+            self._sync_following()
+        self._process_new_tweets(tweets)
+        return len(tweets)
+
+    def _save_processing_gap(self):
+        self._last_processed.set_processing_gap(self._gap_floor, self._processed_ids)
+
+    def _process_new_tweets(self, tweets):
+        self._resolve_mentioned_users(tweets)
+
+        if self._translation_mode == 'concurrent':
+            self._process_tweets_concurrently(tweets)
+            return
+
+        if self._translation_mode == 'batch':
+            translations = self._translate_tweets_in_batch(tweets)
+        else:
+            translations = {}
+
+        self._post_tweets(tweets, translations.get)
+
+    def _download_following(self):
+        with metrics.TWITTER_SECONDS.time(method='friends_ids'):
+            return set(tweepy.Cursor(self._api.friends_ids,
+                                     user_id=self._my_user.id_str).items())
+
+    def _sync_following(self):
+        store = self._following_store
+
+        if store is None:
+            if self._following is None:
+                self._following = self._download_following()
+            return
+
+        if self._following is None:
+            # The first time, we can also check the count Twitter gave us.
+            expected_count = getattr(self._my_user, 'friends_count', None)
+        else:
+            expected_count = None
+
+        if store.needs_reconcile(expected_count):
+            store.reconcile(self._download_following())
+        elif self._following is None:
+            # Without the store, the set would have been downloaded only here, when
+            # it's not in memory yet.
+            store.skip_reconcile()
+
+        self._following = store.ids
+
+    def _resolve_mentioned_users(self, tweets):
+        # Find the screen names of all the users we will need to follow in one go,
+        # rather than one by one while processing the tweets.
+        tweets = [tweet for tweet in tweets if not self._is_retweet(tweet)]
+        self._user_resolver.learn_from_tweets(tweets)
+        user_ids = [user_dict['id']
+                    for tweet in tweets
+                    for user_dict in tweet.entities['user_mentions']
+                    if user_dict['id'] not in self._following]
+        with tracing.span('resolve-users', users=len(user_ids)):
+            self._user_resolver.resolve_many(self._api, user_ids)
+
+    def _process_tweets_concurrently(self, tweets):
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._translation_workers)
+        futures = {}
+
+        def get_translation(tweet_id):
+            future = futures.get(tweet_id)
+            if future is None:
+                return None
+            return future.result()
+
+        try:
+            for tweet in tweets:
+                if self._needs_translation(tweet):
+                    futures[tweet.id] = executor.submit(self._translate_tweet, tweet)
+
+            self._post_tweets(tweets, get_translation)
+        finally:
+            # If something failed, there's no point in translating the tweets which
+            # will not be posted.
+            for future in futures.values():
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def _post_tweets(self, tweets, get_translation):
         '''
-        for following in tweepy.Cursor(self._api.friends_ids, user_id=self._my_user.id_str).items():
-            self._following.add(following)
+        Post the translation of `tweets`, one after the other.
+
+        The tweets are processed in order, so, if something fails, the last processed
+        tweet is still correct.
 
-        for i, tweet in enumerate(self._get_tweets(10)):
+        tweets:
+            The tweets to process, sorted from the oldest to the newest.
+        get_translation:
+            A function which, given a tweet ID, returns the already computed
+            `_Translation` for it or `None` if it was not translated yet.
+            The function may block until the translation is available.
+        '''
+        for tweet in tweets:
             # Try to space tweets a bit to avoid being suspended.
-            sleep_multiplier = min(i, 5)
-            time.sleep(sleep_multiplier * 15)
+            with tracing.span('sleep', tweet_id=tweet.id):
+                self._wait_before_posting()
+
+            with tracing.span('process-tweet', tweet_id=tweet.id):
+                with tracing.span('wait-translation', tweet_id=tweet.id):
+                    translation = get_translation(tweet.id)
+                self._process_tweet(tweet, translation)
+            self._consecutive_posts += 1
+            self._last_post_time = time.monotonic()
+
+    def _wait_before_posting(self):
+        if self._last_post_time is None:
+            return
 
-            self._process_tweet(tweet)
+        idle_time = time.monotonic() - self._last_post_time
+        if idle_time >= self.POST_IDLE_RESET:
+            self._consecutive_posts = 0
+            return
+
+        sleep_multiplier = min(self._consecutive_posts, self.POST_SPACING_MAX_MULTIPLIER)
+        time.sleep(max(sleep_multiplier * self.POST_SPACING - idle_time, 0))
+
+    def _fetch_timeline(self, since_id):
+        '''
+        Fetch all the tweets for the user after `since_id`.
+
+        Twitter returns the newest tweets first, so the pages are requested going
+        backwards, each one ending (with `max_id`) just before the oldest tweet in
+        the previous one.
+
+        Return value:
+            A `(tweets, calls)` tuple, where `tweets` is a list of tweets sorted from
+            the newest to the oldest and `calls` is the number of calls done.
+        '''
+        tweets = []
+        calls = 0
+        max_id = None
+
+        while True:
+            with metrics.TWITTER_SECONDS.time(method='user_timeline'), \
+                    tracing.span('fetch-page', since_id=since_id, max_id=max_id):
+                page = self._api.user_timeline(
+                    self._target_user_name,
+                    since_id=since_id,
+                    max_id=max_id,
+                    count=self.TIMELINE_PAGE_SIZE,
+                    tweet_mode='extended')
+            calls += 1
+            if not page:
+                break
+            tweets.extend(page)
+            max_id = min(tweet.id for tweet in page) - 1
+
+        return tweets, calls
+
+    def _get_pending_tweets(self):
+        if self._pending_tweets is None:
+            if self._timeline_backlog is None:
+                self._pending_tweets = []
+            else:
+                self._pending_tweets = [
+                    tweepy.models.Status.parse(self._api, tweet_json)
+                    for tweet_json in self._timeline_backlog.tweets_json]
+        return self._pending_tweets
 
     def _get_tweets(self, max_count):
         '''
         Get tweets for the user since the last tweet which was translated.
 
+        The tweets which were fetched, but not returned yet, are kept (in the
+        timeline backlog, if any) so, if there are many new tweets, they are fetched
+        only once.
+
+        If pushed tweets were processed, the tweets before them which were missed are
+        returned as well.
+
         max_count:
             The maximum number of tweets to get.
         Return value:
             A list of tweets sorted from the oldest to the newest.
         '''
-        cursor = tweepy.Cursor(
-            self._api.user_timeline,
-            self._target_user_name,
-            since_id=self._last_processed.get_last_processed(),
-            tweet_mode='extended')
+        if self._gap_floor is None:
+            floor = int(self._last_processed.get_last_processed())
+        else:
+            floor = self._gap_floor
+
+        def is_new(tweet):
+            return tweet.id > floor and tweet.id not in self._processed_ids
+
+        pending = [tweet for tweet in self._get_pending_tweets() if is_new(tweet)]
+        from_backlog = min(len(pending), max_count)
+
+        calls = 0
+        fetched = []
+        # If we already have enough tweets, newer ones can wait.
+        if len(pending) < max_count:
+            since_id = max([floor] + [tweet.id for tweet in pending])
+            fetched, calls = self._fetch_timeline(since_id)
+
+        tweets_by_id = collections.OrderedDict()
+        for tweet in pending + [tweet for tweet in fetched if is_new(tweet)]:
+            tweets_by_id[tweet.id] = tweet
+        tweets = sorted(tweets_by_id.values(), key=lambda tweet: tweet.id)
 
-        tweets = list(cursor.items())
-        tweets.reverse()
-        del tweets[max_count:]
+        # The returned tweets are kept as well, as we don't know whether they will be
+        # processed. The ones which are will be skipped next time.
+        self._pending_tweets = tweets
+        _PENDING_TWEETS.set(max(len(tweets) - max_count, 0), target=self._target_user_name)
+        if self._timeline_backlog is not None:
+            self._timeline_backlog.save(tweets)
+            self._timeline_backlog.record_fetch(calls, len(fetched), from_backlog,
+                                                max(len(tweets) - max_count, 0))
 
-        return tweets
+        return tweets[:max_count]
 
     @staticmethod
-    def _sanitize_tweet(tweet):
-        # This is inspired by https://github.com/wjt/fewerror/ by Will Thompson.
-        text = tweet.full_text
-        entities = tweet.entities
+    def _get_entity_spans(tweet):
+        '''
+        Get the entities of a tweet which must not be translated.
 
-        # First get all the entities (with information on what is inside).
-        flat_entities = []
+        Return value:
+            A list of `((start, end), placeholders.Entity)` tuples, sorted by
+            position.
+        '''
+        # This is inspired by https://github.com/wjt/fewerror/ by Will Thompson.
+        spans = []
         for entity_type, entity_key, value_key in (('media', 'media', 'media_url'),
                                                    ('url', 'urls', 'url'),
                                                    ('mention', 'user_mentions', 'screen_name'),
                                                    ('hashtag', 'hashtags', 'text')):
-            for entity in entities.get(entity_key, []):
-                flat_entities.append({
-                    'type': entity_type,
-                    'key': entity_key,
-                    'entity': entity,
-                    'value': entity[value_key],
-                    })
-
-        # Sort them so we start from the end (as we are replacing text at a fixed
-        # position.
-        flat_entities.sort(key=lambda item: item['entity']['indices'],
-                           reverse=True)
-
-        # And finally replace the entity with a tag which the translator should
-        # ignore.
-        for info in flat_entities:
-            i, j = info['entity']['indices']
-            assert '"' not in info['value']
-            tag = ('<transequilibrium:escaped ' + \
-                   'type="{type}" value="{value}">' + \
-                   '</transequilibrium:escaped>').format(**info)
-            text = text[:i] + tag + text[j:]
-
-        # Twitter returns HTML-escaped strings, but expects unescaped strings.
-        # Probably this was done to avoid HTML injection.
-        text = escaping.html_unescape(text)
-
-        return text.strip()
+            for entity in tweet.entities.get(entity_key, []):
+                spans.append((tuple(entity['indices']),
+                              placeholders.Entity(entity_type, entity[value_key])))
+
+        spans.sort(key=lambda span: span[0])
+        return spans
 
     @staticmethod
-    def _unsanitize_tweet_text(text):
-        replacements = {
-            'media': '{}',
-            'url': '{}',
-            'mention': '@{}',
-            'hashtag': '#{}',
-            }
-
-        def re_cb(match):
-            entity_type = match.group(1)
-            entity_value = match.group(2)
-            unsanitized_entity = replacements[entity_type].format(entity_value)
-            # The translator tends to eat spaces next to URLs, so we make sure there's
-            # spaces (and the regex eats all nearby spaces anyway).
-            return ' {} '.format(unsanitized_entity)
-
-        # Everybody know that the best way to parse XML/HTML is regexes.
-        text = re.sub(' *<transequilibrium:escaped type="([^"]+)" value="([^"]+)"> *',
-                      re_cb,
-                      text)
-        text = re.sub(' *</transequilibrium:escaped> *',
-                      ' ',
-                      text)
-        text = re.sub(' +', ' ', text)
-        assert '<transequilibrium:escaped' not in text
-        assert '</transequilibrium:escaped' not in text
-        return text
+    def _sanitize_tweet(tweet, scheme=placeholders.TAG_SCHEME):
+        '''
+        Replace the entities of a tweet with placeholders which the translator should
+        ignore.
+
+        tweet:
+            The tweet to sanitize.
+        scheme:
+            The `placeholders.Scheme` to use.
+        Return value:
+            A `placeholders.Encoded` instance.
+        '''
+        return scheme.encode(tweet.full_text, Client._get_entity_spans(tweet))
+
+    @staticmethod
+    def _unsanitize_tweet_text(text, encoded):
+        '''
+        Replace the placeholders in a translated text with the original entities.
+
+        text:
+            The translated text.
+        encoded:
+            The `placeholders.Encoded` instance for the original text.
+        Return value:
+            A `placeholders.Restored` instance.
+        '''
+        return encoded.scheme.restore(text, encoded.entities)
 
     @staticmethod
     def _serialize_json(json_object):
@@ -155,10 +484,11 @@ class Client:
     def _serialize_list_to_ordered_dict(json_list):
         return Client._serialize_json(collections.OrderedDict(json_list))
 
-    def _log(self, log_entry, extra_name=None):
-        self._last_processed.save_last_processed_log(log_entry, extra_name)
+    def _log(self, log_entry, extra_name=None, trace_id=None):
+        with tracing.span('log', extra_name=extra_name):
+            self._last_processed.save_last_processed_log(log_entry, extra_name, trace_id)
 
-    def _log_tweet_json(self, tweet):
+    def _log_tweet_json(self, tweet, trace_id):
         if tweet is None:
             return
 
@@ -169,16 +499,30 @@ class Client:
 
         extra_name = '{}-{}.json'.format(tweet.user.screen_name, tweet.id)
 
-        self._log(serialized_json, extra_name)
+        self._log(serialized_json, extra_name, trace_id)
 
     def _follow_mentions(self, tweet):
         for user_dict in tweet.entities['user_mentions']:
             user_id = user_dict['id']
             if user_id not in self._following:
-                screen_name = self._api.get_user(user_id).screen_name
+                screen_name = self._user_resolver.resolve(self._api, user_id)
+                if screen_name is None:
+                    # Let Twitter give us a proper error.
+                    screen_name = self._api.get_user(user_id).screen_name
                 url = 'https://twitter.com/{}'.format(screen_name)
-                self._api.create_friendship(user_id=user_id)
-                self._following.add(user_id)
+                try:
+                    with metrics.TWITTER_SECONDS.time(method='create_friendship'):
+                        self._api.create_friendship(user_id=user_id)
+                except tweepy.TweepError:
+                    # For instance, we may be already following the user, so our set
+                    # is not correct.
+                    if self._following_store is not None:
+                        self._following_store.mark_stale()
+                    raise
+                if self._following_store is not None:
+                    self._following_store.add(user_id)
+                else:
+                    self._following.add(user_id)
                 self._log(
                     self._serialize_list_to_ordered_dict([
                         ('following-id', user_id),
@@ -208,10 +552,12 @@ class Client:
         # Unfortunately, using a mention at the beginning and in_reply_to_status_id still
         # seems to be affected by the 280 characters limit.
         # Moreover, I'm not sure spamming with replies would always be a good idea.
-        return self._api.update_status(
-            self._limit_text_length(text),
-            tweet_mode='extended',
-            attachment_url=self._get_tweet_url(self._target_user_name, original_tweet_id))
+        with metrics.TWITTER_SECONDS.time(method='update_status'), \
+                tracing.span('post', original_id=original_tweet_id):
+            return self._api.update_status(
+                self._limit_text_length(text),
+                tweet_mode='extended',
+                attachment_url=self._get_tweet_url(self._target_user_name, original_tweet_id))
 
     @staticmethod
     def _get_tweet_url(user_name, tweet_id):
@@ -220,12 +566,107 @@ class Client:
         # retweet, then Twitter redirects you to the original one.
         return 'https://twitter.com/{}/status/{}'.format(user_name, tweet_id)
 
-    def _process_tweet(self, tweet):
+    @staticmethod
+    def _is_retweet(tweet):
+        # Note that retweets with an extra comment don't have retweeted_status, but
+        # they have quoted_status, so we don't skip them.
+        return hasattr(tweet, 'retweeted_status')
+
+    def _get_skip_verdict(self, tweet):
+        '''
+        Check whether a tweet must be skipped (without translating it) because it's
+        offensive.
+
+        Return value:
+            The `classifier.Verdict` for the tweet if it must be skipped, `None`
+            otherwise.
+        '''
+        if self._offensive_policy != 'skip':
+            return None
+        verdict = self._classifier.classify(tweet.full_text)
+        return verdict if verdict.offensive else None
+
+    def _needs_translation(self, tweet):
+        return not self._is_retweet(tweet) and self._get_skip_verdict(tweet) is None
+
+    def _translate_tweet(self, tweet):
+        '''
+        Translate a tweet without posting it.
+
+        tweet:
+            The tweet to translate.
+        Return value:
+            A `_Translation` instance.
+        '''
+        intermediate_translations = []
+        def translation_cb(counter, language, intermediate_text):
+            intermediate_translations.append(
+                _intermediate_translation_entry(counter, language, intermediate_text))
+
+        with tracing.span('translate-tweet', tweet_id=tweet.id) as span:
+            with tracing.span('sanitize', tweet_id=tweet.id):
+                encoded = self._sanitize_tweet(tweet, self._placeholder_scheme)
+            result = equilibrium.find_equilibrium(
+                self._translator,
+                'en', 'ja', encoded.text,
+                translation_cb)
+            span.set(rounds=len(intermediate_translations), equilibrium=result.equilibrium)
+
+            return _Translation(encoded,
+                                result,
+                                self._unsanitize_tweet_text(result.text, encoded),
+                                intermediate_translations)
+
+    def _translate_tweets_in_batch(self, tweets):
+        '''
+        Translate multiple tweets together, without posting them.
+
+        tweets:
+            The tweets to translate. Retweets and tweets which are skipped because
+            offensive are ignored.
+        Return value:
+            A dictionary mapping tweet IDs to `_Translation` instances.
+        '''
+        tweets = [tweet for tweet in tweets if self._needs_translation(tweet)]
+
+        all_intermediate_translations = [[] for tweet in tweets]
+        def translation_cb(index, counter, language, intermediate_text):
+            all_intermediate_translations[index].append(
+                _intermediate_translation_entry(counter, language, intermediate_text))
+
+        with tracing.span('sanitize', tweets=len(tweets)):
+            all_encoded = [self._sanitize_tweet(tweet, self._placeholder_scheme)
+                           for tweet in tweets]
+        if tracing.get_tracer().enabled:
+            span_attributes = {'tweet_ids': [tweet.id for tweet in tweets]}
+        else:
+            # Don't build the list if it's not needed.
+            span_attributes = {}
+        with tracing.span('translate-tweets', **span_attributes):
+            results = equilibrium.find_equilibrium_many(
+                self._translator,
+                'en', 'ja', [encoded.text for encoded in all_encoded],
+                translation_cb)
+
+        translations = {}
+        for tweet, encoded, result, intermediate_translations in zip(
+                tweets, all_encoded, results, all_intermediate_translations):
+            translations[tweet.id] = _Translation(encoded,
+                                                  result,
+                                                  self._unsanitize_tweet_text(result.text, encoded),
+                                                  intermediate_translations)
+
+        return translations
+
+    def _process_tweet(self, tweet, translation=None):
         '''
         Translate a tweet and post the translated one.
 
         tweet:
             The tweet to translate.
+        translation:
+            The `_Translation` for the tweet if it was already translated, `None`
+            otherwise.
         '''
         log_details = [
             ('original-id', tweet.id),
@@ -234,36 +675,37 @@ class Client:
             ('original-text', tweet.full_text),
             ]
 
-        if hasattr(tweet, 'retweeted_status'):
-            # Note that retweets with an extra comment don't have retweeted_status, but
-            # they have quoted_status, so we don't skip them.
+        skip_verdict = None if self._is_retweet(tweet) else self._get_skip_verdict(tweet)
+
+        if self._is_retweet(tweet):
             log_details += [
                 ('skipped-because-retweet', True),
                 ]
             intermediate_translations = None
             new_tweet = None
+            outcome = 'retweet'
+        elif skip_verdict is not None:
+            log_details += [
+                ('skipped-because-offensive', True),
+                ('offensive-term', skip_verdict.term),
+                ]
+            intermediate_translations = None
+            new_tweet = None
+            outcome = 'offensive'
         else:
-            self._follow_mentions(tweet)
-
-            intermediate_translations = []
-            def translation_cb(counter, language, intermediate_text):
-                intermediate_translations.append(collections.OrderedDict([
-                    ('counter', counter),
-                    ('language', language),
-                    ('text', intermediate_text),
-                    ]))
-
-            sanitized_text = self._sanitize_tweet(tweet)
-            equilibrium_reached, sanitized_translated_text = equilibrium.find_equilibrium(
-                self._translator,
-                'en', 'ja', sanitized_text,
-                translation_cb)
-            translated_text = self._unsanitize_tweet_text(sanitized_translated_text)
+            with tracing.span('follow-mentions', tweet_id=tweet.id):
+                self._follow_mentions(tweet)
+
+            if translation is None:
+                translation = self._translate_tweet(tweet)
+            encoded, result, restored, intermediate_translations = translation
+            translated_text = restored.text
             new_tweet = self._post_tweet(translated_text, tweet.id)
+            outcome = 'translated'
 
-            if tweet.full_text != sanitized_text:
+            if tweet.full_text != encoded.text:
                 log_details += [
-                    ('original-sanitized-text', sanitized_text),
+                    ('original-sanitized-text', encoded.text),
                     ]
 
             log_details += [
@@ -280,15 +722,46 @@ class Client:
 
             log_details += [
                 ('translated-text', new_tweet.full_text),
-                ('equilibrium-reached', equilibrium_reached),
+                ('equilibrium-reached', result.equilibrium),
+                ]
+
+            if result.cycle_length > 1:
+                log_details += [
+                    ('cycle-length', result.cycle_length),
+                    ]
+
+            # The translator changed or dropped some placeholders.
+            if restored.missing or restored.unknown:
+                log_details += [
+                    ('placeholders-missing', restored.missing),
+                    ('placeholders-unknown', restored.unknown),
+                    ]
+
+            if encoded.scheme is not placeholders.TAG_SCHEME:
+                log_details += [
+                    ('placeholder-scheme', encoded.scheme.name),
+                    ('placeholder-chars-saved', placeholders.count_saved_chars(
+                        tweet.full_text,
+                        self._get_entity_spans(tweet),
+                        encoded,
+                        len(intermediate_translations))),
+                    ]
+
+            log_details += [
                 ('translator', self._translator.name),
                 ]
 
-            # For now we just log about offensiveness.
-            # Later I can verify how useful this check is and, if needed, not post the
-            # tweets.
-            original_offensive = not offensive.tact(tweet.full_text)
-            new_offensive = not offensive.tact(translated_text)
+            # Unless the offensive tweets are skipped, we just log about offensiveness.
+            # The English intermediate translations are checked too, as they show where
+            # an offensive term appeared or disappeared. (The classifier only knows
+            # English, so the Japanese ones would only waste time.)
+            with tracing.span('classify', tweet_id=tweet.id):
+                verdicts = self._classifier.classify_many(
+                    [tweet.full_text, translated_text] +
+                    [entry['text'] for entry in intermediate_translations
+                     if entry['language'] == 'en'])
+            original_offensive = verdicts[0].offensive
+            new_offensive = verdicts[1].offensive
             if original_offensive and new_offensive:
                 offensiveness = 'both'
             elif original_offensive:
@@ -302,15 +775,29 @@ class Client:
                 ('offensiveness', offensiveness),
                 ]
 
-        self._last_processed.set_last_processed(tweet.id_str)
+            offensive_intermediate = sum(verdict.offensive for verdict in verdicts[2:])
+            if offensive_intermediate:
+                log_details += [
+                    ('offensive-intermediate-translations', offensive_intermediate),
+                    ]
+
+        # A tweet missed by an event source can be processed after newer ones.
+        # The tweet is recorded in the gap first, so, if we stop in between, it's not
+        # processed again.
+        if self._gap_floor is not None:
+            self._processed_ids.add(tweet.id)
+            self._save_processing_gap()
+        if tweet.id > int(self._last_processed.get_last_processed()):
+            self._last_processed.set_last_processed(tweet.id_str)
         # We save logs after the ID, so there's a chance we actually fail to save logs for
         # this tweet. This is better than retweeting the same thing twice.
         self._log(self._serialize_list_to_ordered_dict(log_details))
+        _TWEETS_PROCESSED.inc(outcome=outcome, target=self._target_user_name)
 
-        self._log_tweet_json(tweet)
-        self._log_tweet_json(new_tweet)
+        self._log_tweet_json(tweet, tweet.id)
+        self._log_tweet_json(new_tweet, tweet.id)
 
         if intermediate_translations:
             json_text = self._serialize_json(intermediate_translations)
             extra_name = '{}-{}-translations.json'.format(tweet.user.screen_name, tweet.id)
-            self._log(json_text, extra_name)
+            self._log(json_text, extra_name, tweet.id)
@@ -0,0 +1,157 @@
+import collections
+import sqlite3
+import threading
+import time
+
+import tweepy
+
+import metrics
+
+
+# The maximum number of users Twitter lets us look up with a single call.
+LOOKUP_BATCH_SIZE = 100
+
+
+class UserResolver:
+    '''
+    Find the screen names of users given their IDs.
+
+    Screen names are cached (optionally on disk) for a limited time, as users can
+    change them. The cache is also filled with the users mentioned in tweets, as
+    Twitter already gives us their screen names, and the users which are not cached
+    are looked up in batches.
+    '''
+
+    DB_BASENAME = 'users-cache.sqlite'
+
+    def __init__(self, cache_path=None, ttl=7 * 24 * 60 * 60):
+        '''
+        Initialize a `UserResolver` instance.
+
+        cache_path:
+            The path of the on-disk cache or `None` to keep the cache only in memory.
+        ttl:
+            How many seconds a screen name can be used after it was fetched.
+        '''
+        self._ttl = ttl
+
+        self._lock = threading.Lock()
+        # Maps user IDs to `(screen_name, time)` tuples.
+        self._memory = {}
+
+        self.hits = 0
+        self.lookups = 0
+        self.looked_up_users = 0
+
+        self._db = None
+        if cache_path is not None:
+            self._db = sqlite3.connect(cache_path, check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS users ('
+                '    id INTEGER PRIMARY KEY,'
+                '    screen_name TEXT NOT NULL,'
+                '    time REAL NOT NULL)')
+            self._db.execute('DELETE FROM users WHERE time < ?', (time.time() - ttl,))
+            self._db.commit()
+            for user_id, screen_name, fetch_time in self._db.execute(
+                    'SELECT id, screen_name, time FROM users'):
+                self._memory[user_id] = (screen_name, fetch_time)
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def stats(self):
+        '''
+        Get the resolver counters.
+
+        Return value:
+            A dictionary with the number of users found in the cache, of lookup calls
+            and of users looked up.
+        '''
+        with self._lock:
+            return collections.OrderedDict([
+                ('cache-hits', self.hits),
+                ('lookups', self.lookups),
+                ('looked-up-users', self.looked_up_users),
+                ])
+
+    def _store(self, users):
+        # `users` is a list of `(user_id, screen_name)` tuples.
+        now = time.time()
+        for user_id, screen_name in users:
+            self._memory[user_id] = (screen_name, now)
+
+        if self._db is not None and users:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO users (id, screen_name, time) VALUES (?, ?, ?)',
+                [(user_id, screen_name, now) for user_id, screen_name in users])
+            self._db.commit()
+
+    def learn_from_tweets(self, tweets):
+        '''
+        Cache the screen names of the users mentioned in `tweets`.
+        '''
+        users = {}
+        for tweet in tweets:
+            for user_dict in tweet.entities.get('user_mentions', []):
+                users[user_dict['id']] = user_dict['screen_name']
+
+        with self._lock:
+            self._store(list(users.items()))
+
+    def resolve_many(self, api, user_ids):
+        '''
+        Find the screen names for the users with IDs `user_ids`.
+
+        api:
+            The `tweepy.API` to use to look up the users which are not cached.
+        user_ids:
+            An iterable of user IDs.
+        Return value:
+            A dictionary mapping user IDs to screen names. Users which could not be
+            found (for instance, because they were suspended) are missing.
+        '''
+        screen_names = {}
+        missing = []
+
+        with self._lock:
+            now = time.time()
+            for user_id in set(user_ids):
+                cached = self._memory.get(user_id)
+                if cached is not None and now - cached[1] < self._ttl:
+                    screen_names[user_id] = cached[0]
+                    self.hits += 1
+                else:
+                    missing.append(user_id)
+
+        # Don't hold the lock while doing network requests.
+        for start in range(0, len(missing), LOOKUP_BATCH_SIZE):
+            batch = missing[start:start + LOOKUP_BATCH_SIZE]
+            try:
+                with metrics.TWITTER_SECONDS.time(method='lookup_users'):
+                    found = [(user.id, user.screen_name)
+                             for user in api.lookup_users(user_ids=batch)]
+            except tweepy.TweepError:
+                # Twitter fails if none of the users exist.
+                found = []
+            with self._lock:
+                self.lookups += 1
+                self.looked_up_users += len(batch)
+                self._store(found)
+            screen_names.update(found)
+
+        return screen_names
+
+    def resolve(self, api, user_id):
+        '''
+        Find the screen name of the user with ID `user_id`.
+
+        api:
+            The `tweepy.API` to use if the user is not cached.
+        Return value:
+            The screen name or `None` if the user could not be found.
+        '''
+        return self.resolve_many(api, [user_id]).get(user_id)